@@ -5,15 +5,45 @@ This is a helper script for the Azure AD Synchronization Daemon.
 
 Classes:
     DomainUserAdministration - Object to handle connection to Azure AD
+    DirectoryUser - Azure AD user as returned by the Graph API
+    TokenCache - Expiry-aware token cache with background refresh
+    TokenRequestError - Exception for when Azure AD doesn't issue an API token
+    RetryPolicy - Capped exponential backoff with jitter, honouring Retry-After
+    CircuitBreaker - Stops requests to Azure AD after repeated failures
+    GraphRequestError - Exception for when a request to Azure AD failed
+    CircuitOpenError - Exception for when requests are skipped because the circuit breaker is open
+    GraphBatchClient - Executes Graph API requests in batches of up to 20 on a small thread pool
+    GroupClosure - Memoized transitive closure of Azure AD group memberships, kept up to date via delta queries
+    PageStreamDecoder - Incrementally decodes a Graph API result page
+    DeltaLinkExpiredError - Exception for when a stored deltaLink is no longer accepted by Azure AD
 
 """
 
+import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode, quote
+import simplejson as json
 
-from UserAdministration import UserAdministration
+from UserAdministration import UserAdministration, Record, internName
+from AzureAD.tokencache import TokenCache, REFRESH_MARGIN
+from AzureAD.retry import RetryPolicy, CircuitBreaker, GraphRequestError, CircuitOpenError
+from AzureAD.batch import GraphBatchClient, BATCH_WORKERS
+from AzureAD.groups import GroupClosure, GROUP_STATE_FILE, DELTA_EXPIRED_CODES
+from AzureAD.streaming import PageStreamDecoder
 
 import logging
 
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+MAX_PAGE_SIZE = 999
+DELTA_STATE_FILE = "/var/adsyncd/deltaLink.json"
+USER_SELECT = "id,displayName,userPrincipalName,accountEnabled"
+USER_FIELDS = ("id", "displayName", "userPrincipalName", "accountEnabled", "@removed")
+STREAM_CHUNK_SIZE = 65536
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 60
+
 
 class DomainUserAdministration(UserAdministration):
     """
@@ -25,17 +55,55 @@ class DomainUserAdministration(UserAdministration):
         Azure AD client ID
     __clientSecret : str
         Azure AD client secret
-    __token : str
-        Azure AD client token to be retrieved from Azure
+    __tokenCache : AzureAD.tokencache.TokenCache
+        Caches the Azure AD API token and refreshes it before it expires
+    __session : requests.Session
+        Keep-alive HTTP session used for all requests to Azure AD, connections are reused across syncs
+    __retryPolicy : AzureAD.retry.RetryPolicy
+        Retry policy shared by all requests to Azure AD
+    __circuitBreaker : AzureAD.retry.CircuitBreaker
+        Circuit breaker shared by all requests to Azure AD
+    __batchClient : AzureAD.batch.GraphBatchClient
+        Sends per-user or per-group lookups in $batch requests
+    __groupClosure : AzureAD.groups.GroupClosure
+        Resolves transitive group memberships locally, None to resolve them with transitiveMembers requests
     __ignoreList : list[str]
         List of to be ignored principals
+    __pageSize : int
+        Number of users requested per page ($top), at most 999
+    __userFilter : str
+        OData $filter expression evaluated by the Graph API, None to get all users
+    __allowedGroups : list[str]
+        Object IDs of the groups whose members are synchronized, all users are synchronized if empty
+    __deltaStateFile : str
+        Path to the file the deltaLink and the known directory are persisted in
+    __deltaLink : str
+        deltaLink of the last applied delta round, None if a full enumeration is needed
+    __directory : dict{str:DirectoryUser}
+        Known Azure AD users by object ID as of the last applied delta round
+    __pendingDelta : tuple
+        deltaLink and directory of a fetched but not yet committed delta round
 
     Methods
     -------
     fetchApiToken()
         Get API token from Azure AD
+    close()
+        Stops the token refresh and closes all pooled connections
+    isAvailable()
+        Check if requests to Azure AD are currently made or paused by the circuit breaker
+    batch(requests)
+        Executes Graph API requests in $batch requests
+    getGroupMembers(groupIds)
+        Returns the principals of all (transitive) user members of groups
     syncUsers()
         Get users from Azure AD
+    iterUsers()
+        Generator yielding users from Azure AD page by page
+    syncDelta()
+        Get changes since the last delta round from Azure AD
+    commitDelta()
+        Persist the last fetched delta round after it has been applied
     getUsernameList()
         Returns list of users in Azure AD (which are not in the ignore_list)
     setIgnoreList(ignore_list)
@@ -43,10 +111,24 @@ class DomainUserAdministration(UserAdministration):
     """
     __clientId = ""
     __clientSecret = ""
-    __token = ""
+    __tokenCache = None
+    __session = None
+    __retryPolicy = None
+    __circuitBreaker = None
+    __batchClient = None
+    __groupClosure = None
     __ignoreList = []
+    __pageSize = MAX_PAGE_SIZE
+    __userFilter = None
+    __allowedGroups = []
+    __deltaStateFile = DELTA_STATE_FILE
+    __deltaLink = None
+    __directory = {}
+    __pendingDelta = None
 
-    def __init__(self, client_id, client_secret, ignore_list=[]):
+    def __init__(self, client_id, client_secret, ignore_list=[], page_size=MAX_PAGE_SIZE, delta_state_file=DELTA_STATE_FILE, user_filter=None, pool_size=HTTP_POOL_SIZE, token_cache_file=None, token_refresh_margin=REFRESH_MARGIN,
+                 retry_policy=None, circuit_breaker=None, batch_workers=BATCH_WORKERS, allowed_groups=[],
+                 group_state_file=None):
         """
         Constructor
 
@@ -58,23 +140,257 @@ class DomainUserAdministration(UserAdministration):
             Azure AD client ID
         ignore_list : list[str]
             List of to be ignored principals
+        page_size : int
+            Number of users requested per page, clamped to 1..999, defaults to 999
+        delta_state_file : str
+            Path to the file the deltaLink is persisted in, defaults to '/var/adsyncd/deltaLink.json'
+        user_filter : str
+            OData $filter expression for users, e.g. "accountEnabled eq true", not supported in delta queries, defaults to None
+        pool_size : int
+            Maximum number of pooled connections per host, defaults to 10
+        token_cache_file : str
+            Path to persist the API token in, so restarts don't need a new token, defaults to None (not persisted)
+        token_refresh_margin : int
+            Seconds before expiry at which the API token is refreshed in the background, defaults to 300
+        retry_policy : AzureAD.retry.RetryPolicy
+            Retry policy for all requests, defaults to None (RetryPolicy with default settings)
+        circuit_breaker : AzureAD.retry.CircuitBreaker
+            Circuit breaker for all requests, defaults to None (CircuitBreaker with default settings)
+        batch_workers : int
+            Number of $batch requests sent concurrently, defaults to 4
+        allowed_groups : list[str]
+            Object IDs of the groups whose members are synchronized, not supported in delta queries, defaults to [] (all users)
+        group_state_file : str
+            Path to persist direct group memberships in, enables resolving nested groups locally, defaults to None
+            (transitive members are requested for every group)
         """
         super().__init__()
         self.__clientId = client_id
         self.__clientSecret = client_secret
         self.__ignoreList = ignore_list
-        self.fetchApiToken()
-        self.syncUsers()
+        self.__pageSize = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        self.__deltaStateFile = delta_state_file
+        self.__userFilter = user_filter
+        self.__allowedGroups = allowed_groups
+        self.__directory = {}
+        self.__session = self.__createSession(pool_size)
+        self.__retryPolicy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.__circuitBreaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.__batchClient = GraphBatchClient(self, GRAPH_URL, self.__retryPolicy, batch_workers)
+        if group_state_file is not None:
+            self.__groupClosure = GroupClosure(self, GRAPH_URL, group_state_file, self.__pageSize)
+        self.__loadDeltaState()
+        self.__tokenCache = TokenCache(self.__requestToken, client_id, token_cache_file, token_refresh_margin)
+        self.__tokenCache.start()
+
+    def __createSession(self, poolSize):
+        """
+        Creates the HTTP session shared by all requests to Azure AD
+        Connections to the token and Graph endpoints are kept alive in urllib3 connection pools,
+        so the TLS handshake is only done once per connection instead of once per request
+
+        Parameters
+        ----------
+        poolSize : int
+            Maximum number of pooled connections per host
+
+        Returns
+        -------
+        requests.Session
+            Configured session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(1, int(poolSize)), pool_block=False)
+        session.mount("https://", adapter)
+        session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+        return session
+
+    def close(self):
+        """
+        Stops the token refresh and closes all pooled connections
+
+        Returns
+        -------
+        None
+        """
+        self.__tokenCache.stop()
+        self.__session.close()
+
+    def isAvailable(self):
+        """
+        Check if requests to Azure AD are currently made or paused by the circuit breaker
+
+        Returns
+        -------
+        bool
+            False if requests are paused after repeated failures
+        """
+        return not self.__circuitBreaker.isOpen()
+
+    def batch(self, requests):
+        """
+        Executes Graph API requests in $batch requests of up to 20 sub-requests
+
+        Parameters
+        ----------
+        requests : list[dict]
+            Requests in $batch format, each with a unique 'id', 'method' and a 'url' relative to the Graph API
+
+        Returns
+        -------
+        dict{str:dict}
+            Responses by request ID, each with 'status', 'headers' and 'body'
+
+        Raises
+        ------
+        GraphRequestError
+            A batch request failed as a whole
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        return self.__batchClient.execute(requests)
+
+    def _request(self, method, url, headers=None, authenticate=True, **kwargs):
+        """
+        Makes a request to Azure AD following the shared retry policy
+        Connection errors, throttling and server errors are retried with backoff, honouring Retry-After.
+        A rejected token is refreshed once. Other client errors are not retried.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method
+        url : str
+            Request URL
+        headers : dict{str:str}
+            Additional request headers, defaults to None
+        authenticate : bool
+            Send the API token, defaults to True
+        **kwargs
+            Passed on to requests.Session.request
+
+        Returns
+        -------
+        requests.Response
+            Successful response
+
+        Raises
+        ------
+        GraphRequestError
+            The request failed with a non-retryable error or all attempts failed
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        #Token requests are only made on behalf of Graph requests, which are already subject to the circuit breaker
+        if authenticate and not self.__circuitBreaker.allowRequest():
+            raise CircuitOpenError()
+        tokenRefreshed = False
+        attempt = 0
+        while True:
+            requestHeaders = dict(headers) if headers else {}
+            statusCode = None
+            retryAfter = None
+            try:
+                if authenticate:
+                    requestHeaders['Authorization'] = 'Bearer {}'.format(self.__tokenCache.getToken())
+                r = self.__session.request(method, url, headers=requestHeaders, timeout=HTTP_TIMEOUT, **kwargs)
+                statusCode = r.status_code
+                if statusCode < 400:
+                    self.__circuitBreaker.recordSuccess()
+                    return r
+                try:
+                    result = r.json()
+                except ValueError:
+                    result = r.text
+                retryAfter = self.__retryPolicy.parseRetryAfter(r.headers.get("Retry-After"))
+                if statusCode == 401 and authenticate and not tokenRefreshed:
+                    logging.info("API token rejected, getting new API token")
+                    tokenRefreshed = True
+                    self.__tokenCache.refresh()
+                    continue
+            except requests.RequestException as e:
+                result = e
+            except (GraphRequestError, CircuitOpenError, TokenRequestError):
+                #Getting a token failed, so this request failed as well
+                if authenticate: self.__circuitBreaker.recordFailure()
+                raise
+            if not self.__retryPolicy.isRetryable(statusCode):
+                #The service is reachable, the request itself is faulty
+                self.__circuitBreaker.recordSuccess()
+                raise GraphRequestError(url, statusCode, result)
+            attempt += 1
+            if attempt >= self.__retryPolicy.maxAttempts:
+                self.__circuitBreaker.recordFailure()
+                raise GraphRequestError(url, statusCode, result)
+            delay = self.__retryPolicy.getDelay(attempt - 1, retryAfter)
+            logging.warning("Request to " + url + " failed with status " + str(statusCode) + ", retrying in " + str(round(delay, 1)) + " seconds")
+            time.sleep(delay)
+
+    def _requestJson(self, method, url, headers=None, expectedKey=None, **kwargs):
+        """
+        Makes a request to Azure AD like _request and decodes the JSON response
+        A response that can't be decoded, e.g. because it was truncated, counts as a failed request for the circuit breaker.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method
+        url : str
+            Request URL
+        headers : dict{str:str}
+            Additional request headers, defaults to None
+        expectedKey : str
+            Key the decoded response has to contain, defaults to None
+        **kwargs
+            Passed on to requests.Session.request
+
+        Returns
+        -------
+        dict
+            Decoded response
+
+        Raises
+        ------
+        GraphRequestError
+            The request failed or the response is malformed
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        r = self._request(method, url, headers, **kwargs)
+        try:
+            result = r.json()
+        except ValueError:
+            result = r.text
+        if not isinstance(result, dict) or (expectedKey is not None and expectedKey not in result):
+            self.__circuitBreaker.recordFailure()
+            raise GraphRequestError(url, r.status_code, result)
+        return result
 
     def fetchApiToken(self):
         """
-        Get API token from Azure AD
+        Get a new API token from Azure AD, e.g. after the current one was rejected
         Requires valid client_id and client_secret to be successful
 
         Returns
         -------
         None
         """
+        self.__tokenCache.refresh()
+
+    def __requestToken(self):
+        """
+        Request an API token from Azure AD
+
+        Returns
+        -------
+        tuple(str, int)
+            API token and its lifetime in seconds
+
+        Raises
+        ------
+        TokenRequestError
+            Azure AD did not issue a token
+        """
         logging.info("Getting API token")
         url = 'https://login.microsoftonline.com/xpertnovade.onmicrosoft.com/oauth2/v2.0/token'
         data = {
@@ -83,9 +399,15 @@ class DomainUserAdministration(UserAdministration):
             'scope': 'https://graph.microsoft.com/.default',
             'client_secret': self.__clientSecret
         }
-        r = requests.post(url, data=data)
-        self.__token = r.json().get('access_token')
+        r = self._request("POST", url, authenticate=False, data=data)
+        try:
+            result = r.json()
+        except ValueError:
+            result = r.text
+        if not isinstance(result, dict) or not result.get('access_token'):
+            raise TokenRequestError(result)
         logging.info("Token retrieved")
+        return result['access_token'], int(result.get('expires_in', 3599))
 
     def syncUsers(self):
         """
@@ -96,28 +418,332 @@ class DomainUserAdministration(UserAdministration):
         -------
         None
         """
-
         logging.info("Getting users from Azure AD")
-        url = 'https://graph.microsoft.com/v1.0/users'
-        headers = {
-            'Content-Type': 'application\json',
-            'Authorization': 'Bearer {}'.format(self.__token)
-        }
-        r = requests.get(url, headers=headers)
-        result = r.json()
+        self._users = list(self.iterUsers())
+        logging.info("Detected " + str(len(self._users)) + " Azure AD users")
+
+    def iterUsers(self):
+        """
+        Generator yielding users from Azure AD page by page
+        Follows @odata.nextLink until the whole directory is enumerated, so only one page is held in memory at a time.
+        If allowed groups are set, only their (transitive) members are enumerated, each user is yielded once.
+
+        Yields
+        ------
+        DirectoryUser
+            User not in the ignore list
+        """
+        query = {"$top": self.__pageSize, "$select": USER_SELECT}
+        headers = {}
+        if self.__userFilter:
+            #Filters on most user properties are advanced queries and need eventual consistency with $count
+            query["$filter"] = self.__userFilter
+            query["$count"] = "true"
+            headers["ConsistencyLevel"] = "eventual"
+        query = urlencode(query, quote_via=quote, safe="$,")
+        if not self.__allowedGroups:
+            yield from self.__iterUserPages(GRAPH_URL + "/users?" + query, headers)
+            return
+        seen = set()
+        for groupId in self.__allowedGroups:
+            url = GRAPH_URL + "/groups/" + quote(groupId) + "/transitiveMembers/microsoft.graph.user?" + query
+            yield from self.__iterUserPages(url, headers, seen)
+
+    def __iterUserPages(self, url, headers, seen=None):
+        """
+        Generator yielding the users of all pages starting at url
+
+        Parameters
+        ----------
+        url : str
+            URL of the first page
+        headers : dict{str:str}
+            Additional request headers
+        seen : set[str]
+            Object IDs of users already yielded, updated while iterating, defaults to None (no deduplication)
+
+        Yields
+        ------
+        DirectoryUser
+            User not in the ignore list
+        """
+        while url:
+            decoder = PageStreamDecoder(USER_FIELDS)
+            for u in self.__streamPage(url, headers, decoder):
+                if seen is not None:
+                    if u["id"] in seen: continue
+                    seen.add(u["id"])
+                user = DirectoryUser.fromGraph(u)
+                if user.userPrincipalName not in self.__ignoreList:
+                    yield user
+            url = decoder.properties.get("@odata.nextLink")
+
+    def getGroupMembers(self, groupIds):
+        """
+        Returns the principals of all (transitive) user members of groups
+        With a group closure, memberships are resolved locally after a group delta round. Otherwise, the first page
+        of every group is requested in $batch requests and further pages are followed individually.
+
+        Parameters
+        ----------
+        groupIds : list[str]
+            Object IDs of the groups
+
+        Returns
+        -------
+        dict{str:set[str]}
+            Principals of the members by group ID, groups that could not be read are left out
+
+        Raises
+        ------
+        GraphRequestError
+            A batch request failed as a whole
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        if self.__groupClosure is not None:
+            self.__groupClosure.sync()
+            closures = self.__groupClosure.getTransitiveMembers(groupIds)
+            principals = self.__resolvePrincipals(set().union(*closures.values()))
+            return {g: {principals[u] for u in members if u in principals} for g, members in closures.items()}
+        query = "?$select=id,userPrincipalName&$top=" + str(self.__pageSize)
+        requests = [{"id": str(i), "method": "GET", "url": "/groups/" + quote(g) + "/transitiveMembers/microsoft.graph.user" + query}
+                    for i, g in enumerate(groupIds)]
+        responses = self.batch(requests)
+        members = {}
+        for i, groupId in enumerate(groupIds):
+            response = responses[str(i)]
+            if response["status"] != 200 or not isinstance(response["body"], dict):
+                logging.error("Could not get members of group " + groupId + ". Response: %s", response["body"])
+                continue
+            page = response["body"]
+            principals = set()
+            while True:
+                for u in page.get("value", []):
+                    if u.get("userPrincipalName"): principals.add(u["userPrincipalName"].replace("\n", ""))
+                if "@odata.nextLink" not in page:
+                    break
+                page = self.__fetchPage(page["@odata.nextLink"])
+            members[groupId] = principals
+        return members
+
+    def __resolvePrincipals(self, userIds):
+        """
+        Returns the principals of users by object ID
+        Users known from the last delta round are looked up locally, the others with getByIds requests of up to 1000 IDs
+
+        Parameters
+        ----------
+        userIds : set[str]
+            Object IDs of the users
+
+        Returns
+        -------
+        dict{str:str}
+            Principals by object ID, unknown users are left out
+        """
+        principals = {}
+        unknown = []
+        for userId in userIds:
+            if userId in self.__directory:
+                principals[userId] = self.__directory[userId].userPrincipalName
+            else:
+                unknown.append(userId)
+        for i in range(0, len(unknown), 1000):
+            result = self._requestJson("POST", GRAPH_URL + "/directoryObjects/getByIds", {'Content-Type': 'application/json'},
+                                       "value", json={"ids": unknown[i:i + 1000], "types": ["user"]})
+            for u in result["value"] or []:
+                if u.get("userPrincipalName"): principals[u["id"]] = u["userPrincipalName"].replace("\n", "")
+        return principals
+
+    def syncDelta(self):
+        """
+        Get changes since the last delta round from Azure AD
+        Without a stored deltaLink, or if Azure AD rejects it, all users are enumerated and returned as changed.
+        The new deltaLink only becomes effective after commitDelta() is called, so changes that could not be
+        applied are fetched again in the next round.
+
+        Returns
+        -------
+        tuple(list[DirectoryUser], list[DirectoryUser], bool)
+            Added or changed users, removed users and whether a full enumeration was done
+        """
+        if self.__deltaLink is not None:
+            logging.info("Getting user changes from Azure AD")
+            try:
+                return self.__fetchDelta(self.__deltaLink, self.__directory)
+            except DeltaLinkExpiredError:
+                logging.info("deltaLink expired, falling back to full enumeration")
+        logging.info("Getting all users from Azure AD via delta query")
+        return self.__fetchDelta(GRAPH_URL + "/users/delta?$select=" + USER_SELECT, {})
+
+    def __fetchDelta(self, url, directory):
+        """
+        Runs a delta round starting at url and merges the result into a copy of directory
+
+        Parameters
+        ----------
+        url : str
+            deltaLink of the last round or initial delta query URL
+        directory : dict{str:DirectoryUser}
+            Known users by object ID
+
+        Returns
+        -------
+        tuple(list[DirectoryUser], list[DirectoryUser], bool)
+            Added or changed users, removed users and whether a full enumeration was done
+        """
+        full = not directory
+        directory = dict(directory)
+        changed = {}
+        removed = {}
+        headers = {'Prefer': 'odata.maxpagesize={}'.format(self.__pageSize)}
+        while True:
+            decoder = PageStreamDecoder(USER_FIELDS)
+            for u in self.__streamPage(url, headers, decoder):
+                previous = directory.get(u["id"])
+                if "@removed" in u:
+                    if previous is not None:
+                        del directory[u["id"]]
+                        changed.pop(u["id"], None)
+                        removed[u["id"]] = previous
+                    continue
+                #Changed objects may only contain the properties that were updated
+                current = DirectoryUser.fromGraph(u, previous)
+                if current.userPrincipalName is None: continue
+                directory[u["id"]] = current
+                if previous is not None and previous.userPrincipalName != current.userPrincipalName:
+                    removed[u["id"] + "/" + previous.userPrincipalName] = previous
+                changed[u["id"]] = current
+            page = decoder.properties
+            if "@odata.nextLink" in page:
+                url = page["@odata.nextLink"]
+            elif "@odata.deltaLink" in page:
+                self.__pendingDelta = (page["@odata.deltaLink"], directory)
+                break
+            else:
+                raise GraphRequestError(url, 200, page)
+        self._users = [u for u in directory.values() if u.userPrincipalName not in self.__ignoreList]
+        changedUsers = [u for u in changed.values() if u.userPrincipalName not in self.__ignoreList]
+        removedUsers = [u for u in removed.values() if u.userPrincipalName not in self.__ignoreList]
+        #Users moved onto the ignore list are treated as removed
+        removedUsers += [u for u in changed.values() if u.userPrincipalName in self.__ignoreList and not full]
+        logging.info("Delta round: " + str(len(changedUsers)) + " added or changed, " + str(len(removedUsers)) + " removed users")
+        return changedUsers, removedUsers, full
+
+    def commitDelta(self):
+        """
+        Persist the last fetched delta round after it has been applied
+        The state file is only readable by root, as it contains the names of all users
+
+        Returns
+        -------
+        None
+        """
+        if self.__pendingDelta is None:
+            return
+        self.__deltaLink, self.__directory = self.__pendingDelta
+        self.__pendingDelta = None
+        tmpFile = self.__deltaStateFile + ".tmp"
+        try:
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as stateFile:
+                users = {userId: [u.displayName, u.userPrincipalName, u.accountEnabled] for userId, u in self.__directory.items()}
+                json.dump({"deltaLink": self.__deltaLink, "users": users}, stateFile)
+                stateFile.flush()
+                os.fsync(stateFile.fileno())
+            os.replace(tmpFile, self.__deltaStateFile)
+        except OSError as e:
+            logging.error("Could not persist deltaLink to " + self.__deltaStateFile + ": " + str(e))
+
+    def __loadDeltaState(self):
+        """
+        Loads deltaLink and known users persisted by a previous run
+
+        Returns
+        -------
+        None
+        """
         try:
-            userJson = result["value"]
-            users = []
-            for u in userJson:
-                u["userPrincipalName"].replace("\n", "")
-                if not u["userPrincipalName"] in self.__ignoreList: users.append(
-                    [u["displayName"], u["userPrincipalName"]])
-            self._users = users
-        except:
-            logging.error("Could not get AD users. Response: %s", result)
-            logging.info("Trying again with new API token")
-            self.fetchApiToken()
-            self.syncUsers()
+            with open(self.__deltaStateFile, "r") as stateFile:
+                state = json.load(stateFile)
+            #Older state files only contain display name and principal
+            self.__directory = {userId: DirectoryUser(userId, u[0], internName(u[1]), u[2] if len(u) > 2 else None)
+                                for userId, u in state["users"].items()}
+            self.__deltaLink = state["deltaLink"]
+            logging.info("Loaded deltaLink with " + str(len(self.__directory)) + " known users")
+        except FileNotFoundError:
+            self.__deltaLink = None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error("Could not read delta state from " + self.__deltaStateFile + ", a full enumeration will be done: " + str(e))
+            self.__deltaLink = None
+
+    def __streamPage(self, url, extraHeaders, decoder):
+        """
+        Generator yielding the users of a single result page while it is being received
+        Only the projected user fields are decoded, top-level properties like '@odata.nextLink' are
+        available in decoder.properties after all users have been yielded
+
+        Parameters
+        ----------
+        url : str
+            URL of the page, including query parameters or a @odata.nextLink
+        extraHeaders : dict{str:str}
+            Additional request headers
+        decoder : AzureAD.streaming.PageStreamDecoder
+            Decoder for the page
+
+        Yields
+        ------
+        dict{str:Any}
+            User with only the projected fields
+
+        Raises
+        ------
+        DeltaLinkExpiredError
+            The requested deltaLink is no longer valid and a full enumeration is needed
+        GraphRequestError
+            The page could not be fetched or is malformed
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        try:
+            r = self._request("GET", url, extraHeaders, stream=True)
+        except GraphRequestError as e:
+            if e.statusCode == 410 or e.errorCode in DELTA_EXPIRED_CODES:
+                raise DeltaLinkExpiredError()
+            raise
+        try:
+            yield from decoder.iterItems(r.iter_content(STREAM_CHUNK_SIZE))
+        except (ValueError, requests.RequestException) as e:
+            raise GraphRequestError(url, r.status_code, e)
+        finally:
+            r.close()
+
+    def __fetchPage(self, url, extraHeaders={}):
+        """
+        Get a single result page from the Graph API
+
+        Parameters
+        ----------
+        url : str
+            URL of the page, including query parameters or a @odata.nextLink
+        extraHeaders : dict{str:str}
+            Additional request headers, defaults to {}
+
+        Returns
+        -------
+        dict
+            Decoded result page
+
+        Raises
+        ------
+        GraphRequestError
+            The page could not be fetched or is malformed
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        return self._requestJson("GET", url, extraHeaders, "value")
 
     def getUsernameList(self):
         """
@@ -125,14 +751,11 @@ class DomainUserAdministration(UserAdministration):
 
         Returns
         -------
-        list[list[str]]
-            List of usernames (principals)
+        list[DirectoryUser]
+            List of users
         """
         self.syncUsers()
-        users = []
-        for u in self._users:
-            users.append(u)
-        return users
+        return list(self._users)
 
     def setIgnoreList(self, ignoreList):
         """
@@ -148,3 +771,81 @@ class DomainUserAdministration(UserAdministration):
         None
         """
         self.__ignoreList = ignoreList
+
+
+class DirectoryUser(Record):
+    """
+    Azure AD user as returned by the Graph API
+
+    Attributes
+    ----------
+    id : str
+        Object ID
+    displayName : str
+        Display name, used as GECOS
+    userPrincipalName : str
+        Principal, used as username (interned)
+    accountEnabled : bool
+        Account is enabled, None if unknown
+    """
+    __slots__ = ("id", "displayName", "userPrincipalName", "accountEnabled")
+
+    @classmethod
+    def fromGraph(cls, item, previous=None):
+        """
+        Builds a user from a (projected) user object of the Graph API
+
+        Parameters
+        ----------
+        item : dict{str:Any}
+            User object, changed objects of a delta round may only contain the updated properties
+        previous : DirectoryUser
+            Known state of the user, missing properties are taken from it, defaults to None
+
+        Returns
+        -------
+        DirectoryUser
+            User, principal is None if it is neither in item nor in previous
+        """
+        if previous is None:
+            previous = cls(item["id"], None, None, None)
+        principal = item.get("userPrincipalName")
+        return cls(previous.id,
+                   item.get("displayName", previous.displayName),
+                   internName(principal.replace("\n", "")) if principal else previous.userPrincipalName,
+                   item.get("accountEnabled", previous.accountEnabled))
+
+
+class DeltaLinkExpiredError(Exception):
+    """
+    Exception for when a stored deltaLink is no longer accepted by Azure AD
+    """
+    def __init__(self):
+        """
+        Initializes super constructor
+        """
+        super().__init__()
+
+
+class TokenRequestError(Exception):
+    """
+    Exception for when Azure AD doesn't issue an API token
+
+    Attributes
+    ----------
+    _response : Any
+        Response of the token endpoint
+    """
+    _response = None
+
+    def __init__(self, response):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        response : Any
+            Response of the token endpoint
+        """
+        super().__init__("Could not get API token. Response: " + str(response))
+        self._response = response
@@ -0,0 +1,168 @@
+"""
+Graph API JSON batching
+
+Packs per-user or per-group lookups into $batch requests, so they don't cost one round trip each.
+
+Classes:
+    GraphBatchClient - Executes Graph API requests in batches of up to 20 on a small thread pool
+"""
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from AzureAD.retry import RetryPolicy, GraphRequestError
+
+BATCH_SIZE = 20
+BATCH_WORKERS = 4
+
+
+class GraphBatchClient:
+    """
+    Executes Graph API requests in batches of up to 20 on a small thread pool
+    Sub-requests failing with a retryable status (throttling, server errors) are retried individually
+    with the retry policy of the Azure AD connection.
+
+    Attributes
+    ----------
+    __admin : AzureAD.DomainUserAdministration
+        Azure AD connection used to send the requests
+    __graphUrl : str
+        Base URL of the Graph API, e.g. 'https://graph.microsoft.com/v1.0'
+    __retryPolicy : AzureAD.retry.RetryPolicy
+        Decides which sub-requests are retried and how long to wait first
+    __maxWorkers : int
+        Number of batches sent concurrently
+
+    Methods
+    -------
+    execute(requests)
+        Executes requests and returns their responses by request ID
+    """
+    __admin = None
+    __graphUrl = ""
+    __retryPolicy = None
+    __maxWorkers = BATCH_WORKERS
+
+    def __init__(self, admin, graphUrl, retryPolicy=None, maxWorkers=BATCH_WORKERS):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        admin : AzureAD.DomainUserAdministration
+            Azure AD connection used to send the requests
+        graphUrl : str
+            Base URL of the Graph API
+        retryPolicy : AzureAD.retry.RetryPolicy
+            Retry policy for failed sub-requests, defaults to None (RetryPolicy with default settings)
+        maxWorkers : int
+            Number of batches sent concurrently, defaults to 4
+        """
+        self.__admin = admin
+        self.__graphUrl = graphUrl
+        self.__retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+        self.__maxWorkers = max(1, int(maxWorkers))
+
+    def execute(self, requests):
+        """
+        Executes requests and returns their responses by request ID
+        Responses are not paged, follow '@odata.nextLink' in the body if there is one
+
+        Parameters
+        ----------
+        requests : list[dict]
+            Requests in $batch format, each with 'id', 'method' and a 'url' relative to the Graph API
+            (e.g. '/users/{id}/memberOf'), optionally with 'headers' and 'body'. IDs must be unique.
+
+        Returns
+        -------
+        dict{str:dict}
+            Responses by request ID, each with 'status', 'headers' and 'body'
+
+        Raises
+        ------
+        GraphRequestError
+            A batch request failed as a whole
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        chunks = [requests[i:i + BATCH_SIZE] for i in range(0, len(requests), BATCH_SIZE)]
+        responses = {}
+        if not chunks:
+            return responses
+        with ThreadPoolExecutor(max_workers=min(self.__maxWorkers, len(chunks)), thread_name_prefix="adsyncd-batch") as executor:
+            for chunkResponses in executor.map(self.__executeBatch, chunks):
+                responses.update(chunkResponses)
+        return responses
+
+    def __executeBatch(self, chunk):
+        """
+        Sends a single $batch request and retries failed sub-requests individually
+
+        Parameters
+        ----------
+        chunk : list[dict]
+            Up to 20 requests in $batch format
+
+        Returns
+        -------
+        dict{str:dict}
+            Responses by request ID
+
+        Raises
+        ------
+        GraphRequestError
+            The batch request failed or its response is malformed
+        """
+        url = self.__graphUrl + "/$batch"
+        result = self.__admin._requestJson("POST", url, {'Content-Type': 'application/json'}, "responses", json={"requests": chunk})
+        responses = {}
+        for response in result["responses"] or []:
+            #Sub-responses without an ID are retried like missing ones
+            if not isinstance(response, dict) or "id" not in response: continue
+            responses[str(response["id"])] = {"status": response.get("status"),
+                                              "headers": response.get("headers", {}),
+                                              "body": response.get("body")}
+        failed = []
+        retryAfter = None
+        for request in chunk:
+            response = responses.get(str(request["id"]))
+            if response is None or self.__retryPolicy.isRetryable(response["status"]):
+                failed.append(request)
+                if response is not None:
+                    delay = self.__retryPolicy.parseRetryAfter(response["headers"].get("Retry-After"))
+                    if delay is not None: retryAfter = max(retryAfter or 0, delay)
+        if failed:
+            logging.info("Retrying " + str(len(failed)) + " failed batch sub-requests individually")
+            if retryAfter is not None:
+                time.sleep(self.__retryPolicy.getDelay(0, retryAfter))
+            for request in failed:
+                responses[str(request["id"])] = self.__executeSingle(request)
+        return responses
+
+    def __executeSingle(self, request):
+        """
+        Sends a single sub-request on its own
+
+        Parameters
+        ----------
+        request : dict
+            Request in $batch format
+
+        Returns
+        -------
+        dict
+            Response with 'status', 'headers' and 'body'
+        """
+        kwargs = {}
+        if "body" in request: kwargs["json"] = request["body"]
+        try:
+            r = self.__admin._request(request.get("method", "GET"), self.__graphUrl + request["url"], request.get("headers"), **kwargs)
+        except GraphRequestError as e:
+            return {"status": e.statusCode, "headers": {}, "body": e.response}
+        try:
+            body = r.json()
+        except ValueError:
+            body = r.text
+        return {"status": r.status_code, "headers": dict(r.headers), "body": body}
@@ -0,0 +1,356 @@
+"""
+Azure AD group hierarchy
+
+Resolves transitive group memberships locally from the direct memberships of all groups,
+so nested groups shared by several mapped groups are only resolved once.
+
+Classes:
+    GroupClosure - Memoized transitive closure of Azure AD group memberships, kept up to date via delta queries
+"""
+
+import os
+import logging
+import simplejson as json
+
+from AzureAD.retry import GraphRequestError
+
+GROUP_STATE_FILE = "/var/adsyncd/groupDelta.json"
+DELTA_EXPIRED_CODES = ("syncStateNotFound", "syncStateInvalid", "resyncRequired")
+USER_TYPE = "#microsoft.graph.user"
+GROUP_TYPE = "#microsoft.graph.group"
+
+
+class GroupClosure:
+    """
+    Memoized transitive closure of Azure AD group memberships, kept up to date via delta queries
+    Direct memberships of all groups are pulled with /groups/delta and persisted together with the deltaLink.
+    Transitive members are computed locally with cycle detection and cached until a group in the subgraph changes.
+
+    Attributes
+    ----------
+    __admin : AzureAD.DomainUserAdministration
+        Azure AD connection used to send the requests
+    __graphUrl : str
+        Base URL of the Graph API
+    __stateFile : str
+        Path to the file the deltaLink and the direct memberships are persisted in
+    __pageSize : int
+        Maximum number of groups per page
+    __deltaLink : str
+        deltaLink of the last delta round, None if all groups have to be fetched
+    __userMembers : dict{str:set[str]}
+        Object IDs of direct user members by group ID
+    __groupMembers : dict{str:set[str]}
+        Object IDs of direct group members by group ID
+    __parents : dict{str:set[str]}
+        Object IDs of groups a group is a direct member of, by group ID
+    __closures : dict{str:frozenset[str]}
+        Cached object IDs of transitive user members by group ID
+
+    Methods
+    -------
+    sync()
+        Fetches membership changes since the last sync and invalidates affected closures
+    getTransitiveMembers(groupIds)
+        Returns the object IDs of all transitive user members of groups
+    """
+    __admin = None
+    __graphUrl = ""
+    __stateFile = GROUP_STATE_FILE
+    __pageSize = 999
+    __deltaLink = None
+    __userMembers = {}
+    __groupMembers = {}
+    __parents = {}
+    __closures = {}
+
+    def __init__(self, admin, graphUrl, stateFile=GROUP_STATE_FILE, pageSize=999):
+        """
+        Constructor
+        Loads direct memberships persisted by a previous run
+
+        Parameters
+        ----------
+        admin : AzureAD.DomainUserAdministration
+            Azure AD connection used to send the requests
+        graphUrl : str
+            Base URL of the Graph API
+        stateFile : str
+            Path to the file the deltaLink and the direct memberships are persisted in, defaults to '/var/adsyncd/groupDelta.json'
+        pageSize : int
+            Maximum number of groups per page, defaults to 999
+        """
+        self.__admin = admin
+        self.__graphUrl = graphUrl
+        self.__stateFile = stateFile
+        self.__pageSize = pageSize
+        self.__userMembers = {}
+        self.__groupMembers = {}
+        self.__parents = {}
+        self.__closures = {}
+        self.__load()
+
+    def sync(self):
+        """
+        Fetches membership changes since the last sync and invalidates the closures of changed groups and their ancestors
+        Without a deltaLink, or if Azure AD rejects it, the memberships of all groups are fetched
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        GraphRequestError
+            A page could not be fetched
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        if self.__deltaLink is not None:
+            try:
+                self.__fetchDelta(self.__deltaLink, False)
+                return
+            except GraphRequestError as e:
+                if e.statusCode != 410 and e.errorCode not in DELTA_EXPIRED_CODES:
+                    raise
+                logging.info("Group deltaLink expired, fetching all group memberships")
+        self.__fetchDelta(self.__graphUrl + "/groups/delta?$select=id,members", True)
+
+    def getTransitiveMembers(self, groupIds):
+        """
+        Returns the object IDs of all transitive user members of groups
+        Groups unknown to Azure AD are left out
+
+        Parameters
+        ----------
+        groupIds : list[str]
+            Object IDs of the groups
+
+        Returns
+        -------
+        dict{str:frozenset[str]}
+            Object IDs of the transitive user members by group ID
+        """
+        result = {}
+        for groupId in groupIds:
+            if groupId not in self.__userMembers:
+                continue
+            if groupId not in self.__closures:
+                self.__computeClosure(groupId)
+            result[groupId] = self.__closures[groupId]
+        return result
+
+    def __computeClosure(self, root):
+        """
+        Computes the closures of root and all groups below it that aren't cached yet
+        Uses Tarjan's algorithm, so groups nested in a cycle share the same closure. Iterative to allow deep hierarchies.
+
+        Parameters
+        ----------
+        root : str
+            Object ID of the group
+
+        Returns
+        -------
+        None
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        onStack = set()
+        counter = 0
+        work = [(root, iter(self.__groupMembers.get(root, ())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onStack.add(root)
+        while work:
+            node, children = work[-1]
+            descended = False
+            for child in children:
+                if child not in self.__userMembers or child in self.__closures:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(self.__groupMembers.get(child, ()))))
+                    descended = True
+                    break
+                if child in onStack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if descended:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    onStack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                #Every group outside the component has been finished before, so its closure is cached
+                members = set()
+                for group in component:
+                    members.update(self.__userMembers[group])
+                    for child in self.__groupMembers.get(group, ()):
+                        if child in self.__closures:
+                            members.update(self.__closures[child])
+                closure = frozenset(members)
+                for group in component:
+                    self.__closures[group] = closure
+
+    def __fetchDelta(self, url, full):
+        """
+        Runs a delta round starting at url and applies the membership changes
+
+        Parameters
+        ----------
+        url : str
+            deltaLink of the last round or initial delta query URL
+        full : bool
+            The round starts from scratch, known memberships are replaced
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        GraphRequestError
+            A page could not be fetched or is malformed
+        CircuitOpenError
+            Requests are paused after repeated failures
+        """
+        #Member sets are copied when a group is first changed, so a failed round leaves the known memberships untouched
+        userMembers = {} if full else dict(self.__userMembers)
+        groupMembers = {} if full else dict(self.__groupMembers)
+        changed = set()
+        headers = {'Prefer': 'odata.maxpagesize={}'.format(self.__pageSize)}
+        while True:
+            page = self.__admin._requestJson("GET", url, headers, "value")
+            for g in page["value"] or []:
+                groupId = g["id"]
+                if "@removed" in g:
+                    changed.add(groupId)
+                    userMembers.pop(groupId, None)
+                    groupMembers.pop(groupId, None)
+                    continue
+                if groupId not in changed:
+                    changed.add(groupId)
+                    userMembers[groupId] = set(userMembers.get(groupId, ()))
+                    groupMembers[groupId] = set(groupMembers.get(groupId, ()))
+                users = userMembers[groupId]
+                groups = groupMembers[groupId]
+                #Large groups are split over several pages, every page only contains a part of the members
+                for m in g.get("members@delta", []):
+                    if m.get("@odata.type") == USER_TYPE:
+                        target = users
+                    elif m.get("@odata.type") == GROUP_TYPE:
+                        target = groups
+                    else:
+                        continue
+                    if "@removed" in m:
+                        target.discard(m["id"])
+                    else:
+                        target.add(m["id"])
+            if page.get("@odata.nextLink"):
+                url = page["@odata.nextLink"]
+            elif page.get("@odata.deltaLink"):
+                self.__deltaLink = page["@odata.deltaLink"]
+                break
+            else:
+                raise GraphRequestError(url, 200, page)
+        self.__userMembers = userMembers
+        self.__groupMembers = groupMembers
+        if full:
+            self.__closures = {}
+        self.__buildParents()
+        self.__invalidate(changed)
+        logging.info("Group delta round: " + str(len(changed)) + " groups changed, " + str(len(self.__userMembers)) + " groups known")
+        self.__save()
+
+    def __buildParents(self):
+        """
+        Builds the index of groups a group is a direct member of
+
+        Returns
+        -------
+        None
+        """
+        self.__parents = {}
+        for groupId, children in self.__groupMembers.items():
+            for child in children:
+                self.__parents.setdefault(child, set()).add(groupId)
+
+    def __invalidate(self, groupIds):
+        """
+        Drops the cached closures of groups and all groups they are (transitively) nested in
+
+        Parameters
+        ----------
+        groupIds : Iterable[str]
+            Object IDs of changed groups
+
+        Returns
+        -------
+        None
+        """
+        pending = list(groupIds)
+        visited = set()
+        while pending:
+            groupId = pending.pop()
+            if groupId in visited:
+                continue
+            visited.add(groupId)
+            self.__closures.pop(groupId, None)
+            pending.extend(self.__parents.get(groupId, ()))
+
+    def __load(self):
+        """
+        Loads deltaLink and direct memberships persisted by a previous run
+
+        Returns
+        -------
+        None
+        """
+        try:
+            with open(self.__stateFile, "r") as stateFile:
+                state = json.load(stateFile)
+            self.__userMembers = {g: set(m["users"]) for g, m in state["groups"].items()}
+            self.__groupMembers = {g: set(m["groups"]) for g, m in state["groups"].items()}
+            self.__deltaLink = state["deltaLink"]
+            self.__buildParents()
+            logging.info("Loaded memberships of " + str(len(self.__userMembers)) + " groups")
+        except FileNotFoundError:
+            self.__deltaLink = None
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("Could not read group state from " + self.__stateFile + ", all groups will be fetched: " + str(e))
+            self.__deltaLink = None
+            self.__userMembers = {}
+            self.__groupMembers = {}
+
+    def __save(self):
+        """
+        Persists deltaLink and direct memberships, the file is only readable by root
+
+        Returns
+        -------
+        None
+        """
+        groups = {g: {"users": sorted(self.__userMembers[g]), "groups": sorted(self.__groupMembers.get(g, ()))} for g in self.__userMembers}
+        tmpFile = self.__stateFile + ".tmp"
+        try:
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as stateFile:
+                json.dump({"deltaLink": self.__deltaLink, "groups": groups}, stateFile)
+                stateFile.flush()
+                os.fsync(stateFile.fileno())
+            os.replace(tmpFile, self.__stateFile)
+        except OSError as e:
+            logging.error("Could not persist group state to " + self.__stateFile + ": " + str(e))
@@ -0,0 +1,296 @@
+"""
+Retry handling for requests to Azure AD
+
+Shared by all requests to the token endpoint and the Graph API, so throttling and outages are handled the same way everywhere.
+
+Classes:
+    RetryPolicy - Capped exponential backoff with jitter, honouring Retry-After
+    CircuitBreaker - Stops requests to Azure AD after repeated failures
+    GraphRequestError - Exception for when a request to Azure AD failed
+    CircuitOpenError - Exception for when requests are skipped because the circuit breaker is open
+"""
+
+import time
+import random
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1
+MAX_DELAY = 60
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 300
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter, honouring Retry-After
+
+    Attributes
+    ----------
+    maxAttempts : int
+        Maximum number of attempts per request, including the first one
+    __baseDelay : float
+        Delay in seconds before the first retry, doubled with every further retry
+    __maxDelay : float
+        Upper bound for a single backoff delay in seconds
+
+    Methods
+    -------
+    isRetryable(statusCode)
+        Check if a request failing with this status code should be retried
+    getDelay(attempt, retryAfter=None)
+        Returns the delay before the next attempt
+    parseRetryAfter(value)
+        Parses the value of a Retry-After header
+    """
+    maxAttempts = MAX_ATTEMPTS
+    __baseDelay = BASE_DELAY
+    __maxDelay = MAX_DELAY
+
+    def __init__(self, maxAttempts=MAX_ATTEMPTS, baseDelay=BASE_DELAY, maxDelay=MAX_DELAY):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        maxAttempts : int
+            Maximum number of attempts per request, including the first one, defaults to 5
+        baseDelay : float
+            Delay in seconds before the first retry, defaults to 1
+        maxDelay : float
+            Upper bound for a single backoff delay in seconds, defaults to 60
+        """
+        self.maxAttempts = max(1, int(maxAttempts))
+        self.__baseDelay = baseDelay
+        self.__maxDelay = maxDelay
+
+    def isRetryable(self, statusCode):
+        """
+        Check if a request failing with this status code should be retried
+
+        Parameters
+        ----------
+        statusCode : int
+            HTTP status code, None if no response was received
+
+        Returns
+        -------
+        bool
+            True for connection errors, timeouts, throttling and server errors
+        """
+        return statusCode is None or statusCode in RETRYABLE_STATUS_CODES
+
+    def getDelay(self, attempt, retryAfter=None):
+        """
+        Returns the delay before the next attempt
+        A Retry-After given by the server takes precedence and is waited for in full, retrying earlier would only be
+        throttled again. maxDelay only caps the backoff.
+
+        Parameters
+        ----------
+        attempt : int
+            Number of the failed attempt, starting at 0
+        retryAfter : float
+            Delay in seconds requested by the server, defaults to None
+
+        Returns
+        -------
+        float
+            Delay in seconds
+        """
+        if retryAfter is not None:
+            return max(retryAfter, 0)
+        return random.uniform(0, min(self.__maxDelay, self.__baseDelay * 2 ** attempt))
+
+    @staticmethod
+    def parseRetryAfter(value):
+        """
+        Parses the value of a Retry-After header, which is either a number of seconds or an HTTP date
+
+        Parameters
+        ----------
+        value : str
+            Header value, may be None
+
+        Returns
+        -------
+        float
+            Delay in seconds, None if the value is missing or invalid
+        """
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+
+class CircuitBreaker:
+    """
+    Stops requests to Azure AD after repeated failures
+    After failureThreshold requests failed in a row the circuit opens and all requests are skipped for resetTimeout seconds.
+    Then a single trial request is let through, which closes the circuit again if it succeeds.
+
+    Attributes
+    ----------
+    __failureThreshold : int
+        Number of failed requests in a row that open the circuit
+    __resetTimeout : float
+        Seconds the circuit stays open before a trial request is allowed
+    __failures : int
+        Number of failed requests in a row
+    __openedAt : float
+        Time (monotonic) the circuit was opened, None if closed
+    __trialRunning : bool
+        A trial request is in progress
+    __lock : threading.Lock
+        Guards the state, requests are made from several threads
+
+    Methods
+    -------
+    allowRequest()
+        Check if a request may be made
+    isOpen()
+        Check if the circuit is open
+    recordSuccess()
+        Records a successful request
+    recordFailure()
+        Records a failed request
+    """
+    __failureThreshold = FAILURE_THRESHOLD
+    __resetTimeout = RESET_TIMEOUT
+    __failures = 0
+    __openedAt = None
+    __trialRunning = False
+    __lock = None
+
+    def __init__(self, failureThreshold=FAILURE_THRESHOLD, resetTimeout=RESET_TIMEOUT):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        failureThreshold : int
+            Number of failed requests in a row that open the circuit, defaults to 3
+        resetTimeout : float
+            Seconds the circuit stays open before a trial request is allowed, defaults to 300
+        """
+        self.__failureThreshold = max(1, int(failureThreshold))
+        self.__resetTimeout = resetTimeout
+        self.__lock = threading.Lock()
+
+    def allowRequest(self):
+        """
+        Check if a request may be made
+        Once the reset timeout has passed, exactly one trial request is allowed
+
+        Returns
+        -------
+        bool
+            True if the request may be made
+        """
+        with self.__lock:
+            if self.__openedAt is None:
+                return True
+            if self.__trialRunning or time.monotonic() - self.__openedAt < self.__resetTimeout:
+                return False
+            self.__trialRunning = True
+            return True
+
+    def isOpen(self):
+        """
+        Check if the circuit is open, i.e. requests would be skipped right now
+
+        Returns
+        -------
+        bool
+            True if the circuit is open and the reset timeout hasn't passed yet
+        """
+        with self.__lock:
+            return self.__openedAt is not None and time.monotonic() - self.__openedAt < self.__resetTimeout
+
+    def recordSuccess(self):
+        """
+        Records a successful request and closes the circuit
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            if self.__openedAt is not None:
+                logging.info("Azure AD is reachable again, closing circuit")
+            self.__failures = 0
+            self.__openedAt = None
+            self.__trialRunning = False
+
+    def recordFailure(self):
+        """
+        Records a failed request and opens the circuit if the threshold is reached or a trial request failed
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            self.__failures += 1
+            if self.__trialRunning or self.__failures >= self.__failureThreshold:
+                if self.__openedAt is None or self.__trialRunning:
+                    logging.error("Requests to Azure AD failed " + str(self.__failures) + " times in a row, pausing requests for " + str(self.__resetTimeout) + " seconds")
+                self.__openedAt = time.monotonic()
+                self.__trialRunning = False
+
+
+class GraphRequestError(Exception):
+    """
+    Exception for when a request to Azure AD failed
+
+    Attributes
+    ----------
+    statusCode : int
+        HTTP status code of the last response, None if no response was received
+    errorCode : str
+        Error code given by the Graph API, None if there is none
+    response : Any
+        Decoded body of the last response or the connection error
+    """
+    statusCode = None
+    errorCode = None
+    response = None
+
+    def __init__(self, url, statusCode, response):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        url : str
+            URL of the failed request
+        statusCode : int
+            HTTP status code of the last response, None if no response was received
+        response : Any
+            Decoded body of the last response or the connection error
+        """
+        super().__init__("Request to " + url + " failed with status " + str(statusCode) + ": " + str(response))
+        self.statusCode = statusCode
+        self.response = response
+        if isinstance(response, dict) and isinstance(response.get("error"), dict):
+            self.errorCode = response["error"].get("code")
+
+
+class CircuitOpenError(Exception):
+    """
+    Exception for when requests are skipped because the circuit breaker is open
+    """
+    def __init__(self):
+        """
+        Initializes super constructor
+        """
+        super().__init__("Azure AD requests are paused after repeated failures")
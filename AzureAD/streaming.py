@@ -0,0 +1,233 @@
+"""
+Streaming decoder for Graph API result pages
+
+Decodes a result page while it is being received and only keeps the projected fields of each item,
+so memory use doesn't grow with the size of the raw response.
+
+Classes:
+    PageStreamDecoder - Incrementally decodes a Graph API result page
+"""
+
+import codecs
+import simplejson as json
+from simplejson.scanner import c_make_scanner
+
+WHITESPACE = " \t\n\r"
+TRIM_THRESHOLD = 65536
+
+
+class PageStreamDecoder:
+    """
+    Incrementally decodes a Graph API result page
+    Items of the 'value' array are yielded one by one, all other top-level properties (e.g. '@odata.nextLink')
+    are collected in properties. Items are decoded with simplejson, which uses its C scanner if available.
+
+    Attributes
+    ----------
+    properties : dict{str:Any}
+        Top-level properties of the page except 'value', complete once all items have been read
+    usesCScanner : bool
+        True if simplejson's C scanner is available
+    __fields : frozenset[str]
+        Names of the fields kept in items (on every nesting level)
+    __itemDecoder : simplejson.JSONDecoder
+        Decoder for items, builds only the projected fields
+    __decoder : simplejson.JSONDecoder
+        Decoder for top-level properties
+    __chunks : Iterator[bytes]
+        Remaining chunks of the response body
+    __textDecoder : codecs.IncrementalDecoder
+        Decodes UTF-8 split across chunk boundaries
+    __buffer : str
+        Received but not yet decoded text
+    __pos : int
+        Position of the next character to decode in the buffer
+    __eof : bool
+        True once all chunks have been read
+
+    Methods
+    -------
+    iterItems(chunks)
+        Generator yielding the projected items of a page
+    """
+    properties = {}
+    usesCScanner = c_make_scanner is not None
+    __fields = frozenset()
+    __itemDecoder = None
+    __decoder = None
+    __chunks = None
+    __textDecoder = None
+    __buffer = ""
+    __pos = 0
+    __eof = False
+
+    def __init__(self, fields):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        fields : Iterable[str]
+            Names of the fields kept in items, e.g. ['id', 'displayName', 'userPrincipalName', '@removed']
+        """
+        self.__fields = frozenset(fields)
+        self.__itemDecoder = json.JSONDecoder(object_pairs_hook=self.__project)
+        self.__decoder = json.JSONDecoder()
+        self.properties = {}
+
+    def iterItems(self, chunks):
+        """
+        Generator yielding the projected items of a page
+
+        Parameters
+        ----------
+        chunks : Iterable[bytes]
+            Response body in chunks, e.g. requests.Response.iter_content()
+
+        Yields
+        ------
+        dict{str:Any}
+            Item of the 'value' array with only the projected fields
+
+        Raises
+        ------
+        simplejson.JSONDecodeError
+            The page is not valid JSON or not a JSON object
+        """
+        self.properties = {}
+        self.__chunks = iter(chunks)
+        self.__textDecoder = codecs.getincrementaldecoder("utf-8")()
+        self.__buffer = ""
+        self.__pos = 0
+        self.__eof = False
+        self.__expect("{")
+        if self.__peek() == "}":
+            return
+        while True:
+            key = self.__decode(self.__decoder)
+            self.__expect(":")
+            if key == "value" and self.__peek() == "[":
+                self.__pos += 1
+                if self.__peek() == "]":
+                    self.__pos += 1
+                else:
+                    while True:
+                        yield self.__decode(self.__itemDecoder)
+                        if self.__expect(",]") == "]":
+                            break
+            else:
+                self.properties[key] = self.__decode(self.__decoder)
+            if self.__expect(",}") == "}":
+                return
+
+    def __project(self, pairs):
+        """
+        Builds an object from its key/value pairs, keeping only the projected fields
+
+        Parameters
+        ----------
+        pairs : list[tuple(str, Any)]
+            Key/value pairs of the object
+
+        Returns
+        -------
+        dict{str:Any}
+            Object with only the projected fields
+        """
+        return {k: v for k, v in pairs if k in self.__fields}
+
+    def __fill(self):
+        """
+        Appends the next chunk to the buffer and drops text that has been decoded already
+
+        Returns
+        -------
+        bool
+            False if there are no more chunks
+        """
+        if self.__eof:
+            return False
+        if self.__pos > TRIM_THRESHOLD:
+            self.__buffer = self.__buffer[self.__pos:]
+            self.__pos = 0
+        try:
+            chunk = next(self.__chunks)
+            self.__buffer += self.__textDecoder.decode(chunk)
+        except StopIteration:
+            self.__buffer += self.__textDecoder.decode(b"", final=True)
+            self.__eof = True
+        return True
+
+    def __peek(self):
+        """
+        Skips whitespace and returns the next character without consuming it
+
+        Returns
+        -------
+        str
+            Next character, empty string at the end of the body
+        """
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in WHITESPACE:
+                self.__pos += 1
+            if self.__pos < len(self.__buffer):
+                return self.__buffer[self.__pos]
+            if not self.__fill():
+                return ""
+
+    def __expect(self, characters):
+        """
+        Consumes the next character, which must be one of characters
+
+        Parameters
+        ----------
+        characters : str
+            Allowed characters
+
+        Returns
+        -------
+        str
+            Consumed character
+
+        Raises
+        ------
+        simplejson.JSONDecodeError
+            The next character is not allowed
+        """
+        c = self.__peek()
+        if c == "" or c not in characters:
+            raise json.JSONDecodeError("Expecting one of '" + characters + "'", self.__buffer, self.__pos)
+        self.__pos += 1
+        return c
+
+    def __decode(self, decoder):
+        """
+        Decodes the next JSON value, reading more chunks until it is complete
+
+        Parameters
+        ----------
+        decoder : simplejson.JSONDecoder
+            Decoder to be used
+
+        Returns
+        -------
+        Any
+            Decoded value
+
+        Raises
+        ------
+        simplejson.JSONDecodeError
+            The value is invalid
+        """
+        self.__peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.__buffer, self.__pos)
+                #A number at the end of the buffer might continue in the next chunk
+                if end < len(self.__buffer) or self.__eof:
+                    self.__pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.__eof:
+                    raise
+            self.__fill()
@@ -0,0 +1,233 @@
+"""
+Azure AD API token cache
+
+Keeps the API token together with its expiry and refreshes it in the background before it expires,
+so requests to the Graph API don't have to wait for the token endpoint.
+
+Classes:
+    TokenCache - Expiry-aware token cache with background refresh
+"""
+
+import os
+import time
+import threading
+import logging
+import simplejson as json
+
+REFRESH_MARGIN = 300
+RETRY_INTERVAL = 30
+
+
+class TokenCache:
+    """
+    Expiry-aware token cache with background refresh
+
+    Attributes
+    ----------
+    __fetch : Callable[[], tuple(str, int)]
+        Function requesting a new token, returns the token and its lifetime in seconds
+    __cacheKey : str
+        Identifies the credentials a persisted token belongs to, e.g. the client ID
+    __cacheFile : str
+        Path to the file the token is persisted in, None if the token is not persisted
+    __refreshMargin : int
+        Seconds before expiry at which the token is refreshed
+    __token : str
+        Current token
+    __expiresAt : float
+        Time (epoch seconds) the current token expires at
+    __lock : threading.Lock
+        Serializes token requests
+    __stopEvent : threading.Event
+        Set to stop the refresh thread
+    __thread : threading.Thread
+        Background refresh thread
+
+    Methods
+    -------
+    getToken()
+        Returns a valid token, requesting one only if the cache holds no valid token
+    refresh()
+        Requests a new token
+    isValid()
+        Check if the cached token is still valid
+    start()
+        Starts the background refresh thread
+    stop()
+        Stops the background refresh thread
+    """
+    __fetch = None
+    __cacheKey = ""
+    __cacheFile = None
+    __refreshMargin = REFRESH_MARGIN
+    __token = None
+    __expiresAt = 0
+    __lock = None
+    __stopEvent = None
+    __thread = None
+
+    def __init__(self, fetch, cacheKey, cacheFile=None, refreshMargin=REFRESH_MARGIN):
+        """
+        Constructor
+        Loads a persisted token if there is one for cacheKey
+
+        Parameters
+        ----------
+        fetch : Callable[[], tuple(str, int)]
+            Function requesting a new token, returns the token and its lifetime in seconds
+        cacheKey : str
+            Identifies the credentials a persisted token belongs to
+        cacheFile : str
+            Path to the file the token is persisted in, defaults to None (token is not persisted)
+        refreshMargin : int
+            Seconds before expiry at which the token is refreshed, defaults to 300
+        """
+        self.__fetch = fetch
+        self.__cacheKey = cacheKey
+        self.__cacheFile = cacheFile
+        self.__refreshMargin = refreshMargin
+        self.__lock = threading.Lock()
+        self.__stopEvent = threading.Event()
+        self.__load()
+
+    def getToken(self):
+        """
+        Returns a valid token, requesting one only if the cache holds no valid token
+
+        Returns
+        -------
+        str
+            API token
+        """
+        if not self.isValid():
+            with self.__lock:
+                #Another thread might have refreshed the token while waiting for the lock
+                if not self.isValid():
+                    self.__refreshLocked()
+        return self.__token
+
+    def refresh(self):
+        """
+        Requests a new token, e.g. after the current one was rejected
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            self.__refreshLocked()
+
+    def isValid(self):
+        """
+        Check if the cached token is still valid
+
+        Returns
+        -------
+        bool
+            True if there is a token and it doesn't expire within the next minute
+        """
+        return self.__token is not None and time.time() < self.__expiresAt - 60
+
+    def start(self):
+        """
+        Starts the background refresh thread
+
+        Returns
+        -------
+        None
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stopEvent.clear()
+        self.__thread = threading.Thread(target=self.__refreshLoop, name="adsyncd-token-refresh", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the background refresh thread
+
+        Returns
+        -------
+        None
+        """
+        self.__stopEvent.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __refreshLoop(self):
+        """
+        Refreshes the token refreshMargin seconds before it expires until stopped
+
+        Returns
+        -------
+        None
+        """
+        while True:
+            delay = self.__expiresAt - self.__refreshMargin - time.time()
+            if self.__stopEvent.wait(max(delay, 0)):
+                return
+            if time.time() < self.__expiresAt - self.__refreshMargin:
+                #Token has been refreshed in the meantime
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error("Background token refresh failed: " + str(e))
+                if self.__stopEvent.wait(RETRY_INTERVAL):
+                    return
+
+    def __refreshLocked(self):
+        """
+        Requests a new token and persists it, the caller must hold the lock
+
+        Returns
+        -------
+        None
+        """
+        token, expiresIn = self.__fetch()
+        self.__token = token
+        self.__expiresAt = time.time() + expiresIn
+        self.__save()
+
+    def __load(self):
+        """
+        Loads a persisted token, tokens of other credentials or expired tokens are ignored
+
+        Returns
+        -------
+        None
+        """
+        if self.__cacheFile is None:
+            return
+        try:
+            with open(self.__cacheFile, "r") as cacheFile:
+                cached = json.load(cacheFile)
+            if cached["key"] == self.__cacheKey:
+                self.__token = cached["token"]
+                self.__expiresAt = float(cached["expiresAt"])
+                if self.isValid():
+                    logging.info("Loaded cached API token")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("Could not read token cache " + self.__cacheFile + ": " + str(e))
+
+    def __save(self):
+        """
+        Persists the current token, the file is only readable by root
+
+        Returns
+        -------
+        None
+        """
+        if self.__cacheFile is None:
+            return
+        tmpFile = self.__cacheFile + ".tmp"
+        try:
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as cacheFile:
+                json.dump({"key": self.__cacheKey, "token": self.__token, "expiresAt": self.__expiresAt}, cacheFile)
+            os.replace(tmpFile, self.__cacheFile)
+        except OSError as e:
+            logging.error("Could not write token cache " + self.__cacheFile + ": " + str(e))
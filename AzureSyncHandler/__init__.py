@@ -10,10 +10,14 @@ Classes:
 
 """
 
+import sqlite3
 import configparser
 import simplejson as json
-from LinuxUsers import SystemUserAdministration, UserNotExistingError, UserAlreadyExistsError
-from AzureAD import DomainUserAdministration
+from LinuxUsers import SystemUserAdministration, UserNotExistingError, UserAlreadyExistsError, GroupAlreadyExistsError, AccountLockError, gecosField
+from HomeDirectories import HomeRequestServer, HOME_SOCKET
+from AzureSyncHandler.reconcile import UserReconciler, MergeJoinReconciler
+from SyncState import SyncStateStore, SyncRecord, SYNCED_FIELDS
+from AzureAD import DomainUserAdministration, GROUP_STATE_FILE, RetryPolicy, CircuitBreaker, GraphRequestError, CircuitOpenError, TokenRequestError
 import logging
 
 class AzureSyncHandler:
@@ -34,6 +38,18 @@ class AzureSyncHandler:
         Name of the Linux user group for Azure AD user
     __standardUserConfig : dict{str:str}
         Default config for 'useradd'
+    __deltaSync : bool
+        Only apply changes since the last sync, using Azure AD delta queries
+    __groupMappings : dict{str:list[str]}
+        Names of Linux groups by object ID of the Azure AD group whose members they should contain
+    __homeServer : HomeDirectories.HomeRequestServer
+        Creates home directories on first login, None if they are created with the users
+    __reconciler : AzureSyncHandler.reconcile.UserReconciler
+        Computes the changes between Azure AD and Linux users
+    __state : SyncState.SyncStateStore
+        Linux user and attribute fingerprint of every synchronized Azure AD user, None if no state is kept
+    __lockDisabledUsers : bool
+        Lock the passwords of users disabled in Azure AD
 
     Methods
     -------
@@ -41,6 +57,10 @@ class AzureSyncHandler:
         Synchronize users - creates/deletes Linux users for users in Azure AD
     syncUserLists()
         Syncs the lists of Linux and Domain users
+    syncGroupMemberships()
+        Synchronize memberships of mapped Linux groups with their Azure AD groups
+    close()
+        Stops all background work and closes the connections, e.g. when the daemon terminates
     """
     __config = None
     __blockedUsers = []
@@ -48,6 +68,12 @@ class AzureSyncHandler:
     __domainAdmin = None
     __linuxUserGroupName = "azuread"
     __standardUserConfig = {}
+    __deltaSync = False
+    __groupMappings = {}
+    __homeServer = None
+    __reconciler = None
+    __state = None
+    __lockDisabledUsers = False
 
     def __init__(self, configFile="./config.cfg"):
         """
@@ -66,6 +92,8 @@ class AzureSyncHandler:
                 User group must be contained in user default config
             InvalidUserConfigError
                 User default config is invalid
+            ValueError
+                Unknown diff mode, or lockDisabledUsers is set without stateFile
         """
         logging.info("Initializing sync handler")
 
@@ -74,13 +102,51 @@ class AzureSyncHandler:
         config.read(configFile)
         self.__config = config
         self.__blockedUsers = config["Users"]["blockedPrincipals"].split(", ")
-        self.__domainAdmin = DomainUserAdministration(config["Azure"]["clientId"], config["Azure"]["clientSecret"], self.__blockedUsers)
+        domainAdminConfig = {}
+        if config.has_option("Azure", "pageSize"): domainAdminConfig["page_size"] = config.getint("Azure", "pageSize")
+        if config.has_option("Azure", "httpPoolSize"): domainAdminConfig["pool_size"] = config.getint("Azure", "httpPoolSize")
+        if config.has_option("Azure", "groupDeltaSync") and config.getboolean("Azure", "groupDeltaSync"):
+            domainAdminConfig["group_state_file"] = config.get("Azure", "groupStateFile", fallback=GROUP_STATE_FILE)
+        if config.has_option("Azure", "batchWorkers"): domainAdminConfig["batch_workers"] = config.getint("Azure", "batchWorkers")
+        if config.has_option("Azure", "tokenCacheFile"): domainAdminConfig["token_cache_file"] = config["Azure"]["tokenCacheFile"]
+        if config.has_option("Azure", "tokenRefreshMargin"): domainAdminConfig["token_refresh_margin"] = config.getint("Azure", "tokenRefreshMargin")
+        if config.has_option("Azure", "deltaStateFile"): domainAdminConfig["delta_state_file"] = config["Azure"]["deltaStateFile"]
+        if config.has_option("Azure", "deltaSync"): self.__deltaSync = config.getboolean("Azure", "deltaSync")
+        retryConfig = {}
+        if config.has_option("Azure", "maxAttempts"): retryConfig["maxAttempts"] = config.getint("Azure", "maxAttempts")
+        if config.has_option("Azure", "maxRetryDelay"): retryConfig["maxDelay"] = config.getfloat("Azure", "maxRetryDelay")
+        domainAdminConfig["retry_policy"] = RetryPolicy(**retryConfig)
+        breakerConfig = {}
+        if config.has_option("Azure", "circuitBreakerThreshold"): breakerConfig["failureThreshold"] = config.getint("Azure", "circuitBreakerThreshold")
+        if config.has_option("Azure", "circuitBreakerTimeout"): breakerConfig["resetTimeout"] = config.getfloat("Azure", "circuitBreakerTimeout")
+        domainAdminConfig["circuit_breaker"] = CircuitBreaker(**breakerConfig)
+        if config.has_option("Azure", "userFilter") and config["Azure"]["userFilter"]:
+            domainAdminConfig["user_filter"] = config["Azure"]["userFilter"]
+            if self.__deltaSync:
+                logging.warning("Delta queries do not support userFilter, delta sync is disabled")
+                self.__deltaSync = False
+        if config.has_option("Users", "allowedGroups") and config["Users"]["allowedGroups"].strip():
+            domainAdminConfig["allowed_groups"] = [g.strip() for g in config["Users"]["allowedGroups"].split(",") if g.strip()]
+            if self.__deltaSync:
+                logging.warning("Delta queries do not support allowedGroups, delta sync is disabled")
+                self.__deltaSync = False
+        self.__domainAdmin = DomainUserAdministration(config["Azure"]["clientId"], config["Azure"]["clientSecret"], self.__blockedUsers, **domainAdminConfig)
         linuxAdminConfig = {}
 
         #Set system file paths
         if config.has_option("Linux", "passwdFile"): linuxAdminConfig["passwdFile"] = config["Linux"]["passwdFile"]
         if config.has_option("Linux", "shadowFile"): linuxAdminConfig["shadowFile"] = config["Linux"]["shadowFile"]
         if config.has_option("Linux", "groupFile"): linuxAdminConfig["groupFile"] = config["Linux"]["groupFile"]
+        if config.has_option("Linux", "gshadowFile"): linuxAdminConfig["gshadowFile"] = config["Linux"]["gshadowFile"]
+        if config.has_option("Linux", "userBackend"): linuxAdminConfig["userBackend"] = config["Linux"]["userBackend"]
+        if config.has_option("Linux", "loginDefsFile"): linuxAdminConfig["loginDefsFile"] = config["Linux"]["loginDefsFile"]
+        if config.has_option("Linux", "trashDir"): linuxAdminConfig["trashDir"] = config["Linux"]["trashDir"]
+        if config.has_option("Linux", "homeCleanupBytesPerSecond"): linuxAdminConfig["cleanupBytesPerSecond"] = config.getfloat("Linux", "homeCleanupBytesPerSecond")
+        if config.has_option("Linux", "homeCleanupIops"): linuxAdminConfig["cleanupIops"] = config.getfloat("Linux", "homeCleanupIops")
+        if config.has_option("Linux", "homeProvisionWorkers"): linuxAdminConfig["provisionWorkers"] = config.getint("Linux", "homeProvisionWorkers")
+        if config.has_option("Linux", "hardlinkReadOnlySkeleton"): linuxAdminConfig["hardlinkReadOnlySkeleton"] = config.getboolean("Linux", "hardlinkReadOnlySkeleton")
+        if config.has_option("Linux", "homePoolSize"): linuxAdminConfig["homePoolSize"] = config.getint("Linux", "homePoolSize")
+        if config.has_option("Linux", "lazyHomes"): linuxAdminConfig["lazyHomes"] = config.getboolean("Linux", "lazyHomes")
 
         #Initialize Linux user handler and check if config is valid (only partially)
         self.__linuxAdmin = SystemUserAdministration(**linuxAdminConfig)
@@ -89,6 +155,30 @@ class AzureSyncHandler:
         else: self.__standardUserConfig = {"-m": None, "-g": self.__linuxUserGroupName}
         if ("-g" in self.__standardUserConfig and self.__standardUserConfig["-g"] != self.__linuxUserGroupName) or ("-G" in self.__standardUserConfig and (self.__linuxUserGroupName not in self.__standardUserConfig["-G"])): raise UserGroupNotInConfigError
         if "-g" in self.__standardUserConfig and "-G" in self.__standardUserConfig: raise InvalidUserConfigError
+        if linuxAdminConfig.get("lazyHomes"):
+            #Homes are created on first login by 'adsync mkhome', run by pam_exec
+            self.__homeServer = HomeRequestServer(lambda username: self.__linuxAdmin.createHome(username, self.__standardUserConfig, self.__linuxUserGroupName),
+                                                  config.get("Linux", "homeSocket", fallback=HOME_SOCKET))
+            self.__homeServer.start()
+        self.__linuxAdmin.prepareHomes(self.__standardUserConfig)
+        diffMode = config.get("Users", "diffMode", fallback="hash")
+        if diffMode == "mergejoin":
+            self.__reconciler = MergeJoinReconciler(config.getint("Users", "diffChunkSize", fallback=50000),
+                                                    config.get("Users", "diffTempDir", fallback=None))
+        elif diffMode == "hash":
+            self.__reconciler = UserReconciler()
+        else:
+            raise ValueError("Unknown diff mode " + diffMode)
+        if config.has_option("Users", "lockDisabledUsers"): self.__lockDisabledUsers = config.getboolean("Users", "lockDisabledUsers")
+        if config.has_option("Users", "stateFile") and config["Users"]["stateFile"]:
+            #The enabled state is only part of the fingerprint if it is applied, so switching locking on updates every user once
+            self.__state = SyncStateStore(config["Users"]["stateFile"], SYNCED_FIELDS + ("accountEnabled",) if self.__lockDisabledUsers else SYNCED_FIELDS)
+        elif self.__lockDisabledUsers:
+            raise ValueError("lockDisabledUsers requires stateFile")
+        self.__groupMappings = {}
+        if config.has_section("GroupMappings"):
+            for azureGroup, linuxGroups in config.items("GroupMappings"):
+                self.__groupMappings[azureGroup] = [g.strip() for g in linuxGroups.split(",") if g.strip()]
         logging.info("Sync handler initialized")
 
     def syncUserLists(self):
@@ -105,13 +195,13 @@ class AzureSyncHandler:
     def syncUsers(self):
         """
         Synchronize users - creates/deletes Linux users for users in Azure AD
+        In delta mode only the changes since the last sync are applied
 
         Returns
         -------
         None
         """
         logging.info("Syncing users - users not in AzureAD will be removed from system")
-        azureUsers = self.__domainAdmin.getUsernameList()
         linuxUsers = self.__linuxAdmin.getUsernameList()
         #Check if user group exists
         if self.__linuxUserGroupName not in self.__linuxAdmin.getGroupnameList():
@@ -120,34 +210,231 @@ class AzureSyncHandler:
             except:
                 logging.error("Failed to create standard user group")
 
-        #Create Linux user for every Azure AD principal
-        for u in azureUsers:
-            if u[1] not in linuxUsers:
-                try:
-                    self.__linuxAdmin.addUser(u, config=self.__standardUserConfig)
-                    self.__linuxAdmin.setUserPassword(u[1], self.__config["Linux"]["standardPassword"])
-                except UserNotExistingError:
-                    logging.error("A user under this name does not exist. Please check if user creation is successful manually")
-                except UserAlreadyExistsError:
-                    logging.error("A user already exists under this name. Please make sure that the standard user grop name in config is correct")
-        #Get all linux users
-        linuxAzureUsers = self.__linuxAdmin.getUsersInGroup(self.__linuxUserGroupName)
-
-        #Check if user is to be deleted and delete
-        if len(linuxAzureUsers) != len(azureUsers):
-            logging.info("Detected imbalance in Linux and Azure AD users. Deleting user not in Azure AD")
-            domainPrincipals = []
-            for u in azureUsers:
-                domainPrincipals.append(u[1])
-            for u in linuxAzureUsers:
-                if u not in domainPrincipals:
-                    try:
-                        self.__linuxAdmin.removeUser(u)
-                    except UserNotExistingError:
-                        logging.error("Deleting a user was attempted, but the user couldn't be found")
+        if not self.__domainAdmin.isAvailable():
+            logging.error("Requests to Azure AD are paused after repeated failures, skipping sync")
+            return
+        try:
+            managedUsers = self.__getManagedUsers()
+            if self.__deltaSync:
+                changed, removed, full = self.__domainAdmin.syncDelta()
+                if full:
+                    changesets = self.__reconciler.iterChangesets(changed, linuxUsers, managedUsers, self.__state)
+                else:
+                    changesets = iter([self.__reconciler.diffDelta(changed, removed, linuxUsers, managedUsers, self.__state)])
+            else:
+                changesets = self.__reconciler.iterChangesets(self.__domainAdmin.iterUsers(), linuxUsers, managedUsers, self.__state)
+            #All Azure AD users are fetched before the first changeset, so a failed request can't remove anyone
+            changeset = next(changesets)
+            for following in changesets:
+                #Chunks of a merge join are written one after another, so memory doesn't grow with the directory
+                with self.__linuxAdmin.transaction():
+                    self.__applyChangeset(changeset, managedUsers)
+                self.__saveState(changeset, final=False)
+                changeset = following
+            #Account file changes of the last changeset and the group memberships are written at once
+            with self.__linuxAdmin.transaction():
+                self.__applyChangeset(changeset, managedUsers)
+                self.syncGroupMemberships()
+            self.__saveState(changeset)
+            if self.__deltaSync:
+                self.__domainAdmin.commitDelta()
+        except (GraphRequestError, CircuitOpenError, TokenRequestError) as e:
+            #Without a complete list of Azure AD users no user may be removed
+            logging.error("Could not get users from Azure AD, skipping rest of sync: " + str(e))
+        except (AccountLockError, OSError) as e:
+            logging.error("Could not write account files: " + str(e))
         #Re-sync Linux users
         self.__linuxAdmin.syncUsers()
 
+    def syncGroupMemberships(self):
+        """
+        Synchronize memberships of mapped Linux groups with their Azure AD groups
+        Only users created by this tool are added or removed, other members of the Linux groups are left untouched.
+        All changes are written in a single rewrite of the group file.
+
+        Returns
+        -------
+        None
+        """
+        if not self.__groupMappings:
+            return
+        logging.info("Syncing group memberships")
+        azureMembers = self.__domainAdmin.getGroupMembers(list(self.__groupMappings))
+        self.__linuxAdmin.syncGroups()
+        managedUsers = set(self.__linuxAdmin.getUsersInGroup(self.__linuxUserGroupName))
+        linuxGroups = set(self.__linuxAdmin.getGroupnameList())
+        desired = {}
+        incomplete = set()
+        for azureGroup, groups in self.__groupMappings.items():
+            for g in groups:
+                if azureGroup not in azureMembers:
+                    #Members are unknown, don't remove anyone from this group
+                    incomplete.add(g)
+                    continue
+                desired.setdefault(g, set()).update(azureMembers[azureGroup] & managedUsers)
+        changes = {}
+        for g, members in desired.items():
+            if g not in linuxGroups:
+                try:
+                    self.__linuxAdmin.addGroup(g)
+                except GroupAlreadyExistsError:
+                    pass
+            current = set(self.__linuxAdmin.getUsersInGroup(g)) & managedUsers
+            changes[g] = (members - current, set() if g in incomplete else current - members)
+        self.__linuxAdmin.setGroupMembers(changes)
+
+    def close(self):
+        """
+        Stops all background work and closes the connections, e.g. when the daemon terminates
+
+        Returns
+        -------
+        None
+        """
+        if self.__homeServer is not None:
+            self.__homeServer.stop()
+        self.__linuxAdmin.close()
+        self.__domainAdmin.close()
+        if self.__state is not None:
+            self.__state.close()
+
+    def __getManagedUsers(self):
+        """
+        Returns the Linux users created by this tool, the members of the Azure AD user group and the recorded users
+
+        Returns
+        -------
+        dict{str:str}
+            GECOS field of every managed user, by username
+        """
+        managedUsers = {}
+        usernames = self.__linuxAdmin.getUsersInGroup(self.__linuxUserGroupName)
+        if self.__state is not None:
+            usernames += self.__state.getUsernames()
+        for username in usernames:
+            entry = self.__linuxAdmin.getUserEntry(username)
+            if entry is not None:
+                managedUsers[username] = entry.gecos
+        return managedUsers
+
+    def __applyChangeset(self, changeset, managedUsers):
+        """
+        Applies the changes between Azure AD and Linux users
+
+        Parameters
+        ----------
+        changeset : AzureSyncHandler.reconcile.UserChangeset
+            Users to be added, removed and updated
+        managedUsers : dict{str:str}
+            GECOS field of the managed Linux users, by username
+
+        Returns
+        -------
+        None
+        """
+        if changeset.isEmpty():
+            logging.info("Linux users are in sync with Azure AD")
+            return
+        logging.info("Adding " + str(len(changeset.added)) + ", removing " + str(len(changeset.removed)) + ", updating " + str(len(changeset.updated)) + " and renaming " + str(len(changeset.renamed)) + " users")
+        for previous, u in changeset.renamed:
+            try:
+                self.__linuxAdmin.renameUser(previous, u.userPrincipalName, u.displayName or "")
+                self.__updateUser(u, u.displayName or "")
+            except UserNotExistingError:
+                logging.error("Could not rename user " + previous + ", it doesn't exist anymore")
+            except UserAlreadyExistsError:
+                logging.error("Could not rename user " + previous + ", a user named " + u.userPrincipalName + " already exists")
+        for u in changeset.added:
+            self.__addUser(u)
+        for u in changeset.updated:
+            try:
+                self.__updateUser(u, managedUsers.get(u.userPrincipalName))
+            except UserNotExistingError:
+                logging.error("Could not update user " + u.userPrincipalName + ", it doesn't exist anymore")
+        if changeset.removed:
+            self.__linuxAdmin.removeUsers(list(changeset.removed))
+
+    def __updateUser(self, user, gecos):
+        """
+        Applies changed attributes of an Azure AD user to its Linux user, with the running transaction
+        The display name is written to the GECOS field and, if enabled, the password is locked while the user is
+        disabled. Attributes that didn't change cause no write.
+
+        Parameters
+        ----------
+        user : AzureAD.DirectoryUser
+            Azure AD user
+        gecos : str
+            Current GECOS field of the Linux user
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UserNotExistingError
+            The Linux user doesn't exist
+        """
+        if gecos != gecosField(user.displayName):
+            self.__linuxAdmin.setUserGecos(user.userPrincipalName, user.displayName or "")
+        if self.__lockDisabledUsers and user.accountEnabled is not None:
+            self.__linuxAdmin.setUserLocked(user.userPrincipalName, not user.accountEnabled)
+
+    def __saveState(self, changeset, final=True):
+        """
+        Records the Linux users of added and updated Azure AD users and forgets removed ones, once the account files are written
+
+        Parameters
+        ----------
+        changeset : AzureSyncHandler.reconcile.UserChangeset
+            Applied changes
+        final : bool
+            Last changeset of the cycle, removed users are only forgotten then, defaults to True
+
+        Returns
+        -------
+        None
+        """
+        if self.__state is None:
+            return
+        self.__linuxAdmin.syncUsers()
+        for u in changeset.added + changeset.updated + tuple(u for _, u in changeset.renamed):
+            entry = self.__linuxAdmin.getUserEntry(u.userPrincipalName)
+            if entry is not None:
+                self.__state.put(SyncRecord(u.id, entry.username, entry.uid, entry.homeDir, self.__state.fingerprint(u)))
+        #Users removed in this or an earlier cycle, also by hand
+        for username in self.__state.getUsernames() if final else ():
+            if self.__linuxAdmin.getUserEntry(username) is None:
+                self.__state.remove(self.__state.getByUsername(username).objectId)
+        try:
+            self.__state.commit()
+        except sqlite3.Error as e:
+            logging.error("Could not save sync state: " + str(e))
+
+    def __addUser(self, user):
+        """
+        Creates a Linux user for an Azure AD user and sets the standard password
+
+        Parameters
+        ----------
+        user : AzureAD.DirectoryUser
+            Azure AD user
+
+        Returns
+        -------
+        None
+        """
+        try:
+            self.__linuxAdmin.addUser(user, config=self.__standardUserConfig)
+            self.__linuxAdmin.setUserPassword(user.userPrincipalName, self.__config["Linux"]["standardPassword"])
+            if self.__lockDisabledUsers and user.accountEnabled is False:
+                self.__linuxAdmin.setUserLocked(user.userPrincipalName, True)
+        except UserNotExistingError:
+            logging.error("A user under this name does not exist. Please check if user creation is successful manually")
+        except UserAlreadyExistsError:
+            logging.error("A user already exists under this name. Please make sure that the standard user grop name in config is correct")
+
 class UserGroupNotInConfigError(Exception):
     """
     This is an exception for when the user group name specified in config is not in the default user config
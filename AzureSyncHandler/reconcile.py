@@ -0,0 +1,412 @@
+"""
+User reconciliation
+
+Compares the Azure AD users with the local users and produces the changes needed to bring the local users in line.
+Both sides are turned into hashed sets once, so a diff costs O(N + M) instead of a list search per user.
+For very large directories, the Azure AD users can instead be sorted externally and merge joined with the local users,
+and the changes are handed out in chunks, so memory doesn't grow with the size of the directory.
+
+Classes:
+    UserChangeset - Users to be added, removed and updated
+    UserReconciler - Computes changesets from full user lists or delta rounds
+    MergeJoinReconciler - Computes changesets of full user lists with a merge join in bounded memory
+"""
+
+import heapq
+import tempfile
+import itertools
+import contextlib
+import simplejson as json
+
+from UserAdministration import Record
+from AzureAD import DirectoryUser
+
+SORT_CHUNK_SIZE = 50000
+
+
+def _isUpdated(user, managedUsers, state):
+    """
+    Check if the managed local user of an Azure AD user has to be updated
+    With a state store, users are compared by the fingerprint of their attributes, otherwise by GECOS field
+
+    Parameters
+    ----------
+    user : AzureAD.DirectoryUser
+        Azure AD user, its principal is the name of a managed local user
+    managedUsers : dict{str:str}
+        GECOS field of the managed local users, by username
+    state : SyncState.SyncStateStore
+        State of the synchronized users, None to compare GECOS fields
+
+    Returns
+    -------
+    bool
+        True if the user changed
+    """
+    if state is None:
+        return managedUsers[user.userPrincipalName] != (user.displayName or "")
+    record = state.get(user.id)
+    return record is None or record.username != user.userPrincipalName or record.fingerprint != state.fingerprint(user)
+
+
+def _renamedFrom(user, managedUsers, state, previousNames=None):
+    """
+    Returns the previous username of an Azure AD user whose principal changed
+    The name recorded in the state store is used, without a state store the previous principal reported by a delta round
+
+    Parameters
+    ----------
+    user : AzureAD.DirectoryUser
+        Azure AD user without a local user under its principal
+    managedUsers : dict{str:str}
+        GECOS field of the managed local users, by username
+    state : SyncState.SyncStateStore
+        State of the synchronized users, None if there is no state
+    previousNames : dict{str:str}
+        Previous principals of users removed or renamed in a delta round, by object ID, defaults to None
+
+    Returns
+    -------
+    str
+        Name of the managed local user of the object ID, None if the user is new
+    """
+    if state is not None:
+        record = state.get(user.id)
+        previous = record.username if record is not None else None
+    else:
+        previous = previousNames.get(user.id) if previousNames else None
+    if previous is None or previous == user.userPrincipalName or previous not in managedUsers:
+        return None
+    return previous
+
+
+class UserChangeset(Record):
+    """
+    Users to be added, removed and updated
+
+    Attributes
+    ----------
+    added : tuple(AzureAD.DirectoryUser)
+        Azure AD users without a local user
+    removed : tuple(str)
+        Usernames of managed local users without an Azure AD user
+    updated : tuple(AzureAD.DirectoryUser)
+        Azure AD users whose managed local user may be outdated, e.g. because the display name changed
+    renamed : tuple(tuple(str, AzureAD.DirectoryUser))
+        Previous username and Azure AD user of users whose principal changed
+    """
+    __slots__ = ("added", "removed", "updated", "renamed")
+
+    def isEmpty(self):
+        """
+        Check if there is nothing to change
+
+        Returns
+        -------
+        bool
+            True if no user is added, removed, updated or renamed
+        """
+        return not (self.added or self.removed or self.updated or self.renamed)
+
+
+class UserReconciler:
+    """
+    Computes changesets from full user lists or delta rounds
+    Only managed local users (created by this tool) are removed or updated, other local users only block the
+    creation of an Azure AD user with the same name. If a state store is given, only users whose fingerprint
+    changed since they were last synced are updated, and users are followed by object ID, so a changed principal
+    renames the local user instead of removing it and adding a new one. Without a state store, renames are only
+    found in delta rounds, which report the previous principal of a renamed user.
+
+    Methods
+    -------
+    diff(azureUsers, localUsers, managedUsers, state=None)
+        Compares all Azure AD users with the local users
+    iterChangesets(azureUsers, localUsers, managedUsers, state=None)
+        Compares all Azure AD users with the local users, yielding the changes in chunks
+    diffDelta(changed, removed, localUsers, managedUsers, state=None)
+        Compares the users of a delta round with the local users
+    """
+
+    def iterChangesets(self, azureUsers, localUsers, managedUsers, state=None):
+        """
+        Compares all Azure AD users with the local users, yielding the changes in chunks that can be applied one after
+        another. All changes are yielded at once, see MergeJoinReconciler for chunks of bounded size.
+
+        Parameters
+        ----------
+        azureUsers : Iterable[AzureAD.DirectoryUser]
+            All Azure AD users, consumed once
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, defaults to None (compare GECOS fields)
+
+        Yields
+        ------
+        UserChangeset
+            Changes
+        """
+        yield self.diff(azureUsers, localUsers, managedUsers, state)
+
+    def diff(self, azureUsers, localUsers, managedUsers, state=None):
+        """
+        Compares all Azure AD users with the local users
+
+        Parameters
+        ----------
+        azureUsers : Iterable[AzureAD.DirectoryUser]
+            All Azure AD users, consumed once
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, defaults to None (compare GECOS fields)
+
+        Returns
+        -------
+        UserChangeset
+            Changes, added and updated users in Azure AD order
+        """
+        desired = {u.userPrincipalName: u for u in azureUsers if u.userPrincipalName}
+        added, updated, renamed = self.__compare(desired, localUsers, managedUsers, state)
+        return UserChangeset(added, tuple(u for u in managedUsers if u not in desired and u not in renamed), updated, tuple(renamed.items()))
+
+    def diffDelta(self, changed, removed, localUsers, managedUsers, state=None):
+        """
+        Compares the users of a delta round with the local users
+        A user both removed and changed in the same round (e.g. re-created with the same principal) is kept.
+
+        Parameters
+        ----------
+        changed : Iterable[AzureAD.DirectoryUser]
+            Added or changed Azure AD users
+        removed : Iterable[AzureAD.DirectoryUser]
+            Removed Azure AD users
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, defaults to None (compare GECOS fields)
+
+        Returns
+        -------
+        UserChangeset
+            Changes
+        """
+        desired = {u.userPrincipalName: u for u in changed if u.userPrincipalName}
+        removed = list(removed)
+        #A renamed user is reported as changed under the new and as removed under the previous principal
+        previousNames = {u.id: u.userPrincipalName for u in removed}
+        added, updated, renamed = self.__compare(desired, localUsers, managedUsers, state, previousNames)
+        gone = dict.fromkeys(u.userPrincipalName for u in removed if u.userPrincipalName in managedUsers
+                             and u.userPrincipalName not in desired and u.userPrincipalName not in renamed)
+        return UserChangeset(added, tuple(gone), updated, tuple(renamed.items()))
+
+    @staticmethod
+    def __compare(desired, localUsers, managedUsers, state, previousNames=None):
+        """
+        Finds the Azure AD users to be added, updated and renamed
+
+        Parameters
+        ----------
+        desired : dict{str:AzureAD.DirectoryUser}
+            Azure AD users by principal
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, None to compare GECOS fields
+        previousNames : dict{str:str}
+            Previous principals of users removed or renamed in a delta round, by object ID, defaults to None
+
+        Returns
+        -------
+        tuple(tuple(AzureAD.DirectoryUser), tuple(AzureAD.DirectoryUser), dict{str:AzureAD.DirectoryUser})
+            Users to be added, users to be updated and users to be renamed by previous username
+        """
+        if not isinstance(localUsers, (set, frozenset, dict)):
+            localUsers = set(localUsers)
+        added = []
+        updated = []
+        renamed = {}
+        for username, u in desired.items():
+            if username not in localUsers:
+                previous = _renamedFrom(u, managedUsers, state, previousNames)
+                #The previous name may have been taken over by another Azure AD user
+                if previous is not None and previous not in desired and previous not in renamed:
+                    renamed[previous] = u
+                else:
+                    added.append(u)
+            elif username in managedUsers and _isUpdated(u, managedUsers, state):
+                updated.append(u)
+        return tuple(added), tuple(updated), renamed
+
+
+class MergeJoinReconciler(UserReconciler):
+    """
+    Computes changesets of full user lists with a merge join in bounded memory
+    The Azure AD users are sorted by principal in chunks, chunks are spilled to temporary files and merged, so at most
+    one chunk of users is held in memory. The sorted users are then joined with the sorted local usernames and
+    iterChangesets() yields the users to be added and updated in chunks of the same size while joining. Removed and
+    renamed users refer to local users, which are in memory anyway, and follow in the last chunk, as a rename can only
+    be told apart from a removal once all users are joined. Delta rounds are small and are compared like in UserReconciler.
+
+    Attributes
+    ----------
+    __chunkSize : int
+        Number of Azure AD users sorted in memory at once
+    __tempDir : str
+        Directory for the sorted chunks, None for the system default
+
+    Methods
+    -------
+    diff(azureUsers, localUsers, managedUsers, state=None)
+        Compares all Azure AD users with the local users
+    iterChangesets(azureUsers, localUsers, managedUsers, state=None)
+        Compares all Azure AD users with the local users, yielding the changes in chunks
+    """
+    __chunkSize = SORT_CHUNK_SIZE
+    __tempDir = None
+
+    def __init__(self, chunkSize=SORT_CHUNK_SIZE, tempDir=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        chunkSize : int
+            Number of Azure AD users sorted in memory at once and added or updated per changeset, defaults to 50000
+        tempDir : str
+            Directory for the sorted chunks, defaults to None (system default)
+        """
+        self.__chunkSize = max(1, int(chunkSize))
+        self.__tempDir = tempDir
+
+    def diff(self, azureUsers, localUsers, managedUsers, state=None):
+        """
+        Compares all Azure AD users with the local users
+        Collects the chunks of iterChangesets(), so memory grows with the number of changes
+
+        Parameters
+        ----------
+        azureUsers : Iterable[AzureAD.DirectoryUser]
+            All Azure AD users, consumed once
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, defaults to None (compare GECOS fields)
+
+        Returns
+        -------
+        UserChangeset
+            Changes
+        """
+        changesets = list(self.iterChangesets(azureUsers, localUsers, managedUsers, state))
+        return UserChangeset(*(tuple(itertools.chain.from_iterable(getattr(c, field) for c in changesets)) for field in UserChangeset.__slots__))
+
+    def iterChangesets(self, azureUsers, localUsers, managedUsers, state=None):
+        """
+        Compares all Azure AD users with the local users, yielding the changes in chunks
+        All Azure AD users are consumed before the first chunk is yielded
+
+        Parameters
+        ----------
+        azureUsers : Iterable[AzureAD.DirectoryUser]
+            All Azure AD users, consumed once
+        localUsers : Iterable[str]
+            Usernames of all local users
+        managedUsers : dict{str:str}
+            GECOS field of the managed local users, by username
+        state : SyncState.SyncStateStore
+            State of the synchronized users, defaults to None (compare GECOS fields)
+
+        Yields
+        ------
+        UserChangeset
+            Up to chunkSize users to be added or updated, the last changeset also holds the users to be removed and renamed
+        """
+        added = []
+        removed = []
+        updated = []
+        renamed = {}
+        #Local names still in use by another Azure AD user than the recorded one, they can't be renamed
+        taken = set()
+        with contextlib.ExitStack() as stack:
+            remote = self.__sorted(azureUsers, stack)
+            local = iter(sorted(localUsers))
+            u = next(remote, None)
+            username = next(local, None)
+            while u is not None or username is not None:
+                if username is None or (u is not None and u.userPrincipalName < username):
+                    previous = _renamedFrom(u, managedUsers, state)
+                    if previous is not None and previous not in renamed:
+                        renamed[previous] = u
+                    else:
+                        added.append(u)
+                    u = next(remote, None)
+                elif u is None or username < u.userPrincipalName:
+                    if username in managedUsers:
+                        removed.append(username)
+                    username = next(local, None)
+                else:
+                    if username in managedUsers and _isUpdated(u, managedUsers, state):
+                        updated.append(u)
+                    if state is not None:
+                        record = state.getByUsername(username)
+                        if record is not None and record.objectId != u.id:
+                            taken.add(username)
+                    u = next(remote, None)
+                    username = next(local, None)
+                if len(added) + len(updated) >= self.__chunkSize:
+                    yield UserChangeset(tuple(added), (), tuple(updated), ())
+                    added = []
+                    updated = []
+        for previous in taken.intersection(renamed):
+            added.append(renamed.pop(previous))
+        yield UserChangeset(tuple(added), tuple(u for u in removed if u not in renamed), tuple(updated), tuple(renamed.items()))
+
+    def __sorted(self, azureUsers, stack):
+        """
+        Sorts Azure AD users by principal, spilling sorted chunks to temporary files
+        Of several users with the same principal, the last one is kept
+
+        Parameters
+        ----------
+        azureUsers : Iterable[AzureAD.DirectoryUser]
+            Azure AD users
+        stack : contextlib.ExitStack
+            Temporary files are closed (and thereby removed) with it
+
+        Returns
+        -------
+        Iterator[AzureAD.DirectoryUser]
+            Users in principal order
+        """
+        key = lambda u: u.userPrincipalName
+        users = (u for u in azureUsers if u.userPrincipalName)
+        chunks = []
+        while True:
+            chunk = sorted(itertools.islice(users, self.__chunkSize), key=key)
+            if len(chunk) < self.__chunkSize and not chunks:
+                #Everything fits into one chunk, no need to spill
+                merged = iter(chunk)
+                break
+            if chunk:
+                chunkFile = stack.enter_context(tempfile.TemporaryFile("w+", dir=self.__tempDir))
+                for u in chunk:
+                    chunkFile.write(json.dumps(u.toTuple()) + "\n")
+                chunkFile.seek(0)
+                chunks.append((DirectoryUser(*json.loads(line)) for line in chunkFile))
+            if len(chunk) < self.__chunkSize:
+                merged = heapq.merge(*chunks, key=key)
+                break
+        #heapq.merge is stable, the last user of every principal is the most recent one
+        return (list(group)[-1] for _, group in itertools.groupby(merged, key=key))
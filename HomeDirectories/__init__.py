@@ -0,0 +1,18 @@
+"""
+Home Directories
+
+Handles the home directories of users created and removed by adsyncd, outside of the account files.
+
+Classes:
+    HomeCleanupQueue - Moves home directories of removed users to the trash and deletes them in the background
+    HomeProvisioner - Creates home directories from a skeleton in parallel
+    HomePool - Creates home directories by claiming pre-built ones, refilled in the background
+    HomeRequestServer - Serves home directory requests on a Unix socket
+    TokenBucket - Limits the rate of an operation, e.g. bytes or I/O operations per second
+"""
+
+from HomeDirectories.cleanup import HomeCleanupQueue, TRASH_DIR
+from HomeDirectories.provisioner import HomeProvisioner, PROVISION_WORKERS
+from HomeDirectories.pool import HomePool
+from HomeDirectories.service import HomeRequestServer, HOME_SOCKET
+from HomeDirectories.throttle import TokenBucket
@@ -0,0 +1,354 @@
+"""
+Asynchronous home directory cleanup
+
+Removing a user only drops the account entries and moves the home directory into a trash area with a single rename.
+A background thread deletes the trash afterwards within an I/O budget, so a sync removing users with large homes
+isn't held up by recursive deletes and doesn't cause I/O spikes on the host.
+
+Classes:
+    HomeCleanupQueue - Moves home directories of removed users to the trash and deletes them in the background
+"""
+
+import os
+import stat
+import time
+import queue
+import errno
+import logging
+import threading
+import simplejson as json
+
+from HomeDirectories.throttle import TokenBucket
+
+TRASH_DIR = "/var/adsyncd/trash"
+FALLBACK_TRASH_NAME = ".adsyncd-trash"
+QUEUE_FILE = ".queue.json"
+PROTECTED_PATHS = ("/", "/home", "/root", "/var", "/usr", "/etc", "/nonexistent")
+
+
+class HomeCleanupQueue:
+    """
+    Moves home directories of removed users to the trash and deletes them in the background
+    Like userdel -r, a directory is only removed if it is still owned by the removed user. Homes on another filesystem
+    than the trash directory are moved into a trash directory next to them instead. Queued directories are persisted
+    in the trash directory, so the deletion is resumed after a restart.
+
+    Attributes
+    ----------
+    __trashDir : str
+        Directory removed homes are moved to
+    __queueFile : str
+        Path to the file the queued directories are persisted in
+    __pending : list[str]
+        Trash directories not deleted yet, in queue order
+    __bytesBucket : HomeDirectories.throttle.TokenBucket
+        Limits the bytes deleted per second
+    __iopsBucket : HomeDirectories.throttle.TokenBucket
+        Limits the files and directories deleted per second
+    __queue : queue.Queue
+        Trash directories to be deleted by the worker thread
+    __thread : threading.Thread
+        Worker thread, started with the first queued directory
+    __lock : threading.Lock
+        Guards the pending list and starting the worker thread
+    __stopEvent : threading.Event
+        Set to make the worker thread stop
+    __DEBUG : bool
+        Print the directories that would be removed instead of removing them
+
+    Methods
+    -------
+    enqueue(path, uid)
+        Moves the home directory of a removed user to the trash and queues it for deletion
+    join()
+        Waits until all queued directories are deleted
+    stop()
+        Stops the worker thread, directories not deleted yet are resumed after a restart
+    """
+    __trashDir = TRASH_DIR
+    __queueFile = ""
+    __pending = []
+    __bytesBucket = None
+    __iopsBucket = None
+    __queue = None
+    __thread = None
+    __lock = None
+    __stopEvent = None
+    __DEBUG = False
+
+    def __init__(self, trashDir=TRASH_DIR, bytesPerSecond=0, iops=0, DEBUG=False):
+        """
+        Constructor
+        Resumes the deletion of directories queued by a previous run
+
+        Parameters
+        ----------
+        trashDir : str
+            Directory removed homes are moved to, defaults to '/var/adsyncd/trash'
+        bytesPerSecond : float
+            Maximum bytes deleted per second, defaults to 0 (no limit)
+        iops : float
+            Maximum files and directories deleted per second, defaults to 0 (no limit)
+        DEBUG : bool
+            Print the directories that would be removed instead of removing them, defaults to False
+        """
+        self.__trashDir = trashDir
+        self.__queueFile = os.path.join(trashDir, QUEUE_FILE)
+        self.__pending = []
+        self.__bytesBucket = TokenBucket(bytesPerSecond)
+        self.__iopsBucket = TokenBucket(iops)
+        self.__queue = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__stopEvent = threading.Event()
+        self.__DEBUG = DEBUG
+        self.__load()
+
+    def enqueue(self, path, uid):
+        """
+        Moves the home directory of a removed user to the trash and queues it for deletion
+
+        Parameters
+        ----------
+        path : str
+            Home directory
+        uid : int
+            UID of the removed user, the directory is left alone if it is owned by someone else
+
+        Returns
+        -------
+        None
+        """
+        path = os.path.normpath(path) if path else ""
+        if not os.path.isabs(path) or path in PROTECTED_PATHS:
+            logging.warning("Not removing home directory '" + path + "'")
+            return
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            logging.warning("Home directory " + path + " is not a directory, not removing")
+            return
+        if st.st_uid != uid:
+            logging.warning("Home directory " + path + " is not owned by UID " + str(uid) + ", not removing")
+            return
+        if self.__DEBUG:
+            print("mv " + path + " " + self.__trashDir)
+            return
+        name = os.path.basename(path) + "." + str(uid) + "." + str(time.time_ns())
+        try:
+            target = self.__moveToTrash(path, self.__trashDir, name)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                logging.error("Could not move home directory " + path + " to the trash: " + str(e))
+                return
+            #Renames don't cross filesystems, use a trash directory on the filesystem of the home
+            try:
+                target = self.__moveToTrash(path, os.path.join(os.path.dirname(path), FALLBACK_TRASH_NAME), name)
+            except OSError as e:
+                logging.error("Could not move home directory " + path + " to the trash: " + str(e))
+                return
+        logging.info("Moved home directory " + path + " to " + target)
+        with self.__lock:
+            self.__pending.append(target)
+            self.__save()
+        self.__put(target)
+
+    def join(self):
+        """
+        Waits until all queued directories are deleted
+
+        Returns
+        -------
+        None
+        """
+        self.__queue.join()
+
+    def stop(self):
+        """
+        Stops the worker thread and persists the directories not deleted yet, so their deletion is resumed after a
+        restart. A directory being deleted is left partly deleted.
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            thread = self.__thread
+            self.__stopEvent.set()
+        if thread is not None:
+            self.__queue.put(None)
+            thread.join()
+        with self.__lock:
+            self.__thread = None
+            if self.__pending:
+                self.__save()
+
+    def __moveToTrash(self, path, trashDir, name):
+        """
+        Renames a directory into a trash directory, which is created if needed
+
+        Parameters
+        ----------
+        path : str
+            Directory
+        trashDir : str
+            Trash directory
+        name : str
+            Name in the trash directory
+
+        Returns
+        -------
+        str
+            New path of the directory
+
+        Raises
+        ------
+        OSError
+            The directory could not be renamed, e.g. because the trash is on another filesystem (EXDEV)
+        """
+        os.makedirs(trashDir, mode=0o700, exist_ok=True)
+        target = os.path.join(trashDir, name)
+        os.rename(path, target)
+        return target
+
+    def __put(self, target):
+        """
+        Hands a trash directory to the worker thread, starting it if needed
+
+        Parameters
+        ----------
+        target : str
+            Trash directory
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            if self.__stopEvent.is_set():
+                return
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__work, name="adsyncd-home-cleanup", daemon=True)
+                self.__thread.start()
+        self.__queue.put(target)
+
+    def __work(self):
+        """
+        Deletes queued trash directories one by one
+
+        Returns
+        -------
+        None
+        """
+        while True:
+            target = self.__queue.get()
+            if target is None or self.__stopEvent.is_set():
+                self.__queue.task_done()
+                return
+            try:
+                if not self.__delete(target):
+                    continue
+                logging.info("Deleted " + target)
+                with self.__lock:
+                    if target in self.__pending:
+                        self.__pending.remove(target)
+                    self.__save()
+            except Exception as e:
+                logging.error("Could not delete " + target + ": " + str(e))
+            finally:
+                self.__queue.task_done()
+
+    def __delete(self, root):
+        """
+        Deletes a directory tree within the I/O budget
+        Directories are listed with os.scandir, so no per-file stat is needed to tell files and directories apart.
+
+        Parameters
+        ----------
+        root : str
+            Directory
+
+        Returns
+        -------
+        bool
+            False if stopped before the tree was deleted
+        """
+        directories = []
+        pending = [root]
+        while pending:
+            if self.__stopEvent.is_set():
+                return False
+            directory = pending.pop()
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError:
+                continue
+            directories.append(directory)
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+                    try:
+                        self.__bytesBucket.consume(entry.stat(follow_symlinks=False).st_blocks * 512, self.__stopEvent)
+                    except FileNotFoundError:
+                        continue
+                    self.__iopsBucket.consume(1, self.__stopEvent)
+                    if self.__stopEvent.is_set():
+                        return False
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+        #Subdirectories were listed after their parents, so they are removed first
+        for directory in reversed(directories):
+            self.__iopsBucket.consume(1, self.__stopEvent)
+            if self.__stopEvent.is_set():
+                return False
+            try:
+                os.rmdir(directory)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def __load(self):
+        """
+        Loads directories queued by a previous run and resumes their deletion
+
+        Returns
+        -------
+        None
+        """
+        try:
+            with open(self.__queueFile, "r") as queueFile:
+                pending = json.load(queueFile)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error("Could not read home cleanup queue from " + self.__queueFile + ": " + str(e))
+            return
+        self.__pending = [p for p in pending if isinstance(p, str) and os.path.lexists(p)]
+        if self.__pending:
+            logging.info("Resuming deletion of " + str(len(self.__pending)) + " removed home directories")
+        for target in self.__pending:
+            self.__put(target)
+
+    def __save(self):
+        """
+        Persists the queued directories, the file is only readable by root
+
+        Returns
+        -------
+        None
+        """
+        tmpFile = self.__queueFile + ".tmp"
+        try:
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as queueFile:
+                json.dump(self.__pending, queueFile)
+                queueFile.flush()
+                os.fsync(queueFile.fileno())
+            os.replace(tmpFile, self.__queueFile)
+        except OSError as e:
+            logging.error("Could not persist home cleanup queue to " + self.__queueFile + ": " + str(e))
@@ -0,0 +1,306 @@
+"""
+Warm pool of home directories
+
+Keeps a number of anonymous home directories built from the skeleton ready next to the homes, so a new user's home
+is taken from the pool with a rename and a chown instead of copying the skeleton while the sync waits.
+
+Classes:
+    HomePool - Creates home directories by claiming pre-built ones, refilled in the background
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+POOL_DIR_NAME = ".adsyncd-pool"
+BUILD_PREFIX = ".build-"
+
+
+class HomePool:
+    """
+    Creates home directories by claiming pre-built ones, refilled in the background
+    There is a pool per base directory, skeleton and permissions in '<base directory>/.adsyncd-pool', so claiming is a
+    rename on the same filesystem. Pooled homes are owned by root and only readable by root until they are claimed.
+    Changes to the skeleton only reach homes built afterwards, remove the pool directory after changing the skeleton.
+
+    Attributes
+    ----------
+    __size : int
+        Number of homes kept ready per pool
+    __provisioner : HomeDirectories.HomeProvisioner
+        Builds pooled homes and the homes that couldn't be claimed
+    __pools : dict{str:tuple(str, int)}
+        Skeleton and permissions of every known pool, by pool directory
+    __wakeup : threading.Event
+        Set to make the worker thread refill the pools
+    __thread : threading.Thread
+        Worker thread, started with the first known pool
+    __lock : threading.Lock
+        Guards the known pools and starting the worker thread
+    __stopped : bool
+        The worker thread has been stopped
+    __DEBUG : bool
+        Print the homes that would be created instead of creating them
+
+    Methods
+    -------
+    register(baseDir, skeleton, mode)
+        Makes sure a pool for homes in a base directory is filled
+    provision(homes)
+        Creates home directories, from the pool where possible
+    stop()
+        Stops refilling the pools
+    """
+    __size = 0
+    __provisioner = None
+    __pools = {}
+    __wakeup = None
+    __thread = None
+    __lock = None
+    __stopped = False
+    __DEBUG = False
+
+    def __init__(self, provisioner, size, DEBUG=False):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        provisioner : HomeDirectories.HomeProvisioner
+            Builds pooled homes and the homes that couldn't be claimed
+        size : int
+            Number of homes kept ready per pool
+        DEBUG : bool
+            Print the homes that would be created instead of creating them, defaults to False
+        """
+        self.__size = max(0, int(size))
+        self.__provisioner = provisioner
+        self.__pools = {}
+        self.__wakeup = threading.Event()
+        self.__lock = threading.Lock()
+        self.__DEBUG = DEBUG
+
+    def register(self, baseDir, skeleton, mode):
+        """
+        Makes sure a pool for homes in a base directory is filled, e.g. at startup before the first user is created
+
+        Parameters
+        ----------
+        baseDir : str
+            Directory the homes are created in
+        skeleton : str
+            Skeleton directory, None for empty homes
+        mode : int
+            Permissions of the homes
+
+        Returns
+        -------
+        None
+        """
+        if self.__DEBUG or self.__size == 0:
+            return
+        directory = self.__poolDir(baseDir, skeleton, mode)
+        with self.__lock:
+            self.__pools[directory] = (skeleton, mode)
+            if self.__stopped:
+                return
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__work, name="adsyncd-home-pool", daemon=True)
+                self.__thread.start()
+        self.__wakeup.set()
+
+    def provision(self, homes):
+        """
+        Creates home directories, from the pool where possible, and refills the pools in the background
+        Homes that couldn't be claimed are created from the skeleton, existing homes are left untouched
+
+        Parameters
+        ----------
+        homes : list[tuple(str, str, int, int, int)]
+            Home directory, skeleton directory (None for an empty home), UID, GID and permissions of each home
+
+        Returns
+        -------
+        None
+        """
+        homes = [h for h in homes if not os.path.lexists(h[0])]
+        if self.__DEBUG or self.__size == 0 or not homes:
+            self.__provisioner.provision(homes)
+            return
+        remaining = []
+        for home in homes:
+            self.register(os.path.dirname(home[0]), home[1], home[4])
+            if not self.__claim(home):
+                remaining.append(home)
+        if len(remaining) < len(homes):
+            logging.info("Took " + str(len(homes) - len(remaining)) + " home directories from the pool")
+        self.__provisioner.provision(remaining)
+
+    def stop(self):
+        """
+        Stops refilling the pools and waits for a running refill, leftover builds are removed by the next refill
+
+        Returns
+        -------
+        None
+        """
+        with self.__lock:
+            self.__stopped = True
+            thread = self.__thread
+        self.__wakeup.set()
+        if thread is not None:
+            thread.join()
+
+    def __poolDir(self, baseDir, skeleton, mode):
+        """
+        Returns the pool directory for homes in a base directory built from a skeleton
+
+        Parameters
+        ----------
+        baseDir : str
+            Directory the homes are created in
+        skeleton : str
+            Skeleton directory, None for empty homes
+        mode : int
+            Permissions of the homes
+
+        Returns
+        -------
+        str
+            Pool directory
+        """
+        key = hashlib.sha1((str(skeleton) + ":" + oct(mode)).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(baseDir, POOL_DIR_NAME, key)
+
+    def __claim(self, home):
+        """
+        Moves a pooled home into place and hands it to the user
+
+        Parameters
+        ----------
+        home : tuple(str, str, int, int, int)
+            Home directory, skeleton directory, UID, GID and permissions
+
+        Returns
+        -------
+        bool
+            True if a pooled home was claimed, False if the home has to be built from the skeleton
+        """
+        homeDir, skeleton, uid, gid, mode = home
+        directory = self.__poolDir(os.path.dirname(homeDir), skeleton, mode)
+        try:
+            names = sorted(n for n in os.listdir(directory) if not n.startswith("."))
+        except FileNotFoundError:
+            return False
+        for name in names:
+            try:
+                os.rename(os.path.join(directory, name), homeDir)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logging.error("Could not take " + homeDir + " from the pool: " + str(e))
+                return False
+            try:
+                self.__chown(homeDir, uid, gid)
+                os.chmod(homeDir, mode)
+            except OSError as e:
+                logging.error("Could not hand pooled home directory " + homeDir + " over: " + str(e))
+                #Moved back as leftover build, the refill removes it, and the home is built from the skeleton instead
+                try:
+                    os.rename(homeDir, os.path.join(directory, BUILD_PREFIX + "failed-" + name))
+                except OSError:
+                    shutil.rmtree(homeDir, ignore_errors=True)
+                self.__wakeup.set()
+                return False
+            return True
+        return False
+
+    def __chown(self, root, uid, gid):
+        """
+        Changes the owner of a directory tree
+        Hard linked files are shared with the skeleton and keep their owner
+
+        Parameters
+        ----------
+        root : str
+            Directory
+        uid : int
+            New owner
+        gid : int
+            New group
+
+        Returns
+        -------
+        None
+        """
+        os.chown(root, uid, gid)
+        pending = [root]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_nlink > 1:
+                        continue
+                    os.lchown(entry.path, uid, gid)
+
+    def __work(self):
+        """
+        Refills the pools whenever woken up
+
+        Returns
+        -------
+        None
+        """
+        while True:
+            self.__wakeup.wait()
+            self.__wakeup.clear()
+            with self.__lock:
+                if self.__stopped:
+                    return
+                pools = dict(self.__pools)
+            for directory, (skeleton, mode) in pools.items():
+                if self.__stopped:
+                    return
+                try:
+                    self.__refill(directory, skeleton, mode)
+                except Exception as e:
+                    logging.error("Could not refill home directory pool " + directory + ": " + str(e))
+
+    def __refill(self, directory, skeleton, mode):
+        """
+        Builds pooled homes until the pool is full
+        Leftovers of builds interrupted by a restart are removed first
+
+        Parameters
+        ----------
+        directory : str
+            Pool directory
+        skeleton : str
+            Skeleton directory, None for empty homes
+        mode : int
+            Permissions of the homes
+
+        Returns
+        -------
+        None
+        """
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(os.path.dirname(directory), 0o700)
+        names = os.listdir(directory)
+        for name in names:
+            if name.startswith(BUILD_PREFIX):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        missing = self.__size - len([n for n in names if not n.startswith(".")])
+        if missing <= 0:
+            return
+        prefix = str(time.time_ns()) + "-"
+        builds = [os.path.join(directory, BUILD_PREFIX + prefix + str(i)) for i in range(missing)]
+        self.__provisioner.provision([(path, skeleton, 0, 0, 0o700) for path in builds])
+        for i, path in enumerate(builds):
+            if os.path.isdir(path):
+                os.rename(path, os.path.join(directory, prefix + str(i).zfill(6)))
+        logging.info("Refilled home directory pool " + directory)
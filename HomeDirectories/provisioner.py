@@ -0,0 +1,228 @@
+"""
+Parallel home directory provisioning
+
+Creates home directories from a skeleton on a small thread pool. The skeleton is scanned once per batch and files are
+copied with the cheapest method the filesystem supports (reflink, then copy_file_range, then a plain copy), with
+ownership and permissions set on the open file in the same pass.
+
+Classes:
+    HomeProvisioner - Creates home directories from a skeleton in parallel
+"""
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+PROVISION_WORKERS = 4
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1 << 30
+#Errors meaning a copy method isn't supported between these files, the next method is tried
+UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+
+
+class HomeProvisioner:
+    """
+    Creates home directories from a skeleton in parallel
+    Existing home directories are left untouched, like useradd does. Optionally, read-only skeleton files are
+    hard linked instead of copied, they then stay owned by the owner of the skeleton.
+    Whether reflinks and copy_file_range work is decided per file, so a skeleton file on another filesystem
+    doesn't make the workers fall back to plain copies for all other files.
+
+    Attributes
+    ----------
+    __workers : int
+        Number of homes created at the same time
+    __hardlinkReadOnly : bool
+        Hard link skeleton files without write permission instead of copying them
+    __DEBUG : bool
+        Print the homes that would be created instead of creating them
+
+    Methods
+    -------
+    provision(homes)
+        Creates home directories from their skeletons
+    """
+    __workers = PROVISION_WORKERS
+    __hardlinkReadOnly = False
+    __DEBUG = False
+
+    def __init__(self, workers=PROVISION_WORKERS, hardlinkReadOnly=False, DEBUG=False):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        workers : int
+            Number of homes created at the same time, defaults to 4
+        hardlinkReadOnly : bool
+            Hard link skeleton files without write permission instead of copying them, defaults to False
+        DEBUG : bool
+            Print the homes that would be created instead of creating them, defaults to False
+        """
+        self.__workers = max(1, int(workers))
+        self.__hardlinkReadOnly = hardlinkReadOnly
+        self.__DEBUG = DEBUG
+
+    def provision(self, homes):
+        """
+        Creates home directories from their skeletons and waits until all are done
+        Failures are logged, a partially created home is removed again
+
+        Parameters
+        ----------
+        homes : list[tuple(str, str, int, int, int)]
+            Home directory, skeleton directory (None for an empty home), UID, GID and permissions of each home
+
+        Returns
+        -------
+        None
+        """
+        homes = [h for h in homes if not os.path.lexists(h[0])]
+        if not homes:
+            return
+        if self.__DEBUG:
+            for home in homes:
+                print("Creating " + home[0] + " from " + str(home[1]))
+            return
+        skeletons = {}
+        for home in homes:
+            if home[1] and home[1] not in skeletons:
+                skeletons[home[1]] = self.__scan(home[1])
+        with ThreadPoolExecutor(max_workers=min(self.__workers, len(homes)), thread_name_prefix="adsyncd-home") as executor:
+            for home, result in zip(homes, executor.map(lambda h: self.__create(h, skeletons.get(h[1], [])), homes)):
+                if result is not None:
+                    logging.error("Could not create home directory " + home[0] + ": " + str(result))
+        logging.info("Created " + str(len(homes)) + " home directories")
+
+    def __scan(self, skeleton):
+        """
+        Lists the contents of a skeleton directory, parents before their children
+
+        Parameters
+        ----------
+        skeleton : str
+            Skeleton directory
+
+        Returns
+        -------
+        list[tuple(str, os.stat_result)]
+            Paths relative to the skeleton with their lstat results
+        """
+        plan = []
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            try:
+                entries = os.scandir(os.path.join(skeleton, relative))
+            except OSError as e:
+                logging.error("Could not read skeleton directory " + skeleton + ": " + str(e))
+                continue
+            with entries:
+                for entry in entries:
+                    path = os.path.join(relative, entry.name)
+                    plan.append((path, entry.stat(follow_symlinks=False)))
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(path)
+        return plan
+
+    def __create(self, home, plan):
+        """
+        Creates a single home directory
+
+        Parameters
+        ----------
+        home : tuple(str, str, int, int, int)
+            Home directory, skeleton directory, UID, GID and permissions
+        plan : list[tuple(str, os.stat_result)]
+            Contents of the skeleton
+
+        Returns
+        -------
+        Exception
+            Error that occurred, None on success
+        """
+        homeDir, skeleton, uid, gid, mode = home
+        try:
+            os.makedirs(os.path.dirname(homeDir), exist_ok=True)
+            os.mkdir(homeDir, 0o700)
+        except OSError as e:
+            return e
+        try:
+            for relative, st in plan:
+                source = os.path.join(skeleton, relative)
+                target = os.path.join(homeDir, relative)
+                if stat.S_ISDIR(st.st_mode):
+                    os.mkdir(target, 0o700)
+                    os.chown(target, uid, gid)
+                    os.chmod(target, stat.S_IMODE(st.st_mode))
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(source), target)
+                    os.lchown(target, uid, gid)
+                elif stat.S_ISREG(st.st_mode):
+                    self.__copyFile(source, target, st, uid, gid)
+            os.chown(homeDir, uid, gid)
+            os.chmod(homeDir, mode)
+        except OSError as e:
+            shutil.rmtree(homeDir, ignore_errors=True)
+            return e
+        return None
+
+    def __copyFile(self, source, target, st, uid, gid):
+        """
+        Copies a regular file with the cheapest supported method and sets owner and permissions on the open file
+
+        Parameters
+        ----------
+        source : str
+            Skeleton file
+        target : str
+            File in the new home
+        st : os.stat_result
+            lstat result of the skeleton file
+        uid : int
+            Owner of the new file
+        gid : int
+            Group of the new file
+
+        Returns
+        -------
+        None
+        """
+        if self.__hardlinkReadOnly and not st.st_mode & 0o222:
+            try:
+                os.link(source, target)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        with open(source, "rb") as src, open(target, "xb") as dst:
+            os.fchown(dst.fileno(), uid, gid)
+            os.fchmod(dst.fileno(), stat.S_IMODE(st.st_mode))
+            if st.st_size == 0:
+                return
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+            if hasattr(os, "copy_file_range"):
+                try:
+                    copied = 0
+                    while copied < st.st_size:
+                        n = os.copy_file_range(src.fileno(), dst.fileno(), min(COPY_CHUNK_SIZE, st.st_size - copied))
+                        if n == 0:
+                            break
+                        copied += n
+                    return
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRORS:
+                        raise
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+            shutil.copyfileobj(src, dst, 1 << 20)
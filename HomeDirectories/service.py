@@ -0,0 +1,126 @@
+"""
+Home directory requests
+
+Lets a PAM session helper (adsync mkhome) ask the running daemon to create a user's home on first login, so the sync
+only has to write the account entries. Requests are single lines over a Unix socket only root can connect to.
+
+Classes:
+    HomeRequestServer - Serves home directory requests on a Unix socket
+"""
+
+import os
+import logging
+import threading
+import socketserver
+
+HOME_SOCKET = "/var/run/adsyncd.sock"
+REQUEST_TIMEOUT = 30
+MAX_REQUEST_LENGTH = 256
+
+
+class HomeRequestServer:
+    """
+    Serves home directory requests on a Unix socket
+    A request is a username followed by a newline, the answer is 'OK' or 'ERROR <reason>' followed by a newline.
+
+    Attributes
+    ----------
+    __socketPath : str
+        Path of the socket
+    __callback : Callable
+        Creates the home of a username, returns True on success, False if no home was created, and raises an
+        exception with the reason if it failed
+    __server : socketserver.ThreadingUnixStreamServer
+        Server, None until started
+    __thread : threading.Thread
+        Thread accepting connections, None until started
+
+    Methods
+    -------
+    start()
+        Starts serving requests in the background
+    stop()
+        Stops serving requests and removes the socket
+    """
+    __socketPath = HOME_SOCKET
+    __callback = None
+    __server = None
+    __thread = None
+
+    def __init__(self, callback, socketPath=HOME_SOCKET):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        callback : Callable
+            Creates the home of a username, returns True on success, False if no home was created, and raises an
+            exception with the reason if it failed
+        socketPath : str
+            Path of the socket, defaults to '/var/run/adsyncd.sock'
+        """
+        self.__callback = callback
+        self.__socketPath = socketPath
+
+    def start(self):
+        """
+        Starts serving requests in the background, a socket left by a previous run is replaced
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        OSError
+            The socket could not be created
+        """
+        callback = self.__callback
+
+        class Handler(socketserver.StreamRequestHandler):
+            timeout = REQUEST_TIMEOUT
+
+            def handle(self):
+                username = self.rfile.readline(MAX_REQUEST_LENGTH).decode("utf-8", "replace").strip()
+                try:
+                    if callback(username):
+                        answer = "OK"
+                    else:
+                        logging.error("Could not create home directory of " + username)
+                        answer = "ERROR no home directory created"
+                except Exception as e:
+                    reason = str(e) or type(e).__name__
+                    logging.error("Could not create home directory of " + username + ": " + reason)
+                    answer = "ERROR " + reason
+                self.wfile.write((answer.replace("\n", " ") + "\n").encode("utf-8"))
+
+        if os.path.exists(self.__socketPath):
+            os.unlink(self.__socketPath)
+        #Only root may connect, the socket is created with the right permissions right away
+        umask = os.umask(0o177)
+        try:
+            self.__server = socketserver.ThreadingUnixStreamServer(self.__socketPath, Handler)
+        finally:
+            os.umask(umask)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="adsyncd-home-requests", daemon=True)
+        self.__thread.start()
+        logging.info("Serving home directory requests on " + self.__socketPath)
+
+    def stop(self):
+        """
+        Stops serving requests and removes the socket
+
+        Returns
+        -------
+        None
+        """
+        if self.__server is None:
+            return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+        try:
+            os.unlink(self.__socketPath)
+        except FileNotFoundError:
+            pass
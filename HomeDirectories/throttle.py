@@ -0,0 +1,73 @@
+"""
+I/O throttling
+
+Classes:
+    TokenBucket - Limits the rate of an operation, e.g. bytes or I/O operations per second
+"""
+
+import time
+
+
+class TokenBucket:
+    """
+    Limits the rate of an operation, e.g. bytes or I/O operations per second
+    Tokens refill continuously at the given rate up to a burst of one second. Taking more tokens than available
+    sleeps until the debt is paid back, so a single large request is allowed but slows down the following ones.
+
+    Attributes
+    ----------
+    __rate : float
+        Tokens per second, 0 for no limit
+    __tokens : float
+        Available tokens, negative while in debt
+    __last : float
+        Time (monotonic) of the last refill
+
+    Methods
+    -------
+    consume(amount, interrupt=None)
+        Takes tokens, sleeping if the rate is exceeded
+    """
+    __rate = 0
+    __tokens = 0
+    __last = 0
+
+    def __init__(self, rate):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        rate : float
+            Tokens per second, 0 or None for no limit
+        """
+        self.__rate = rate or 0
+        self.__tokens = self.__rate
+        self.__last = time.monotonic()
+
+    def consume(self, amount, interrupt=None):
+        """
+        Takes tokens, sleeping if the rate is exceeded
+
+        Parameters
+        ----------
+        amount : float
+            Number of tokens
+        interrupt : threading.Event
+            Ends the sleep early when set, defaults to None
+
+        Returns
+        -------
+        None
+        """
+        if self.__rate <= 0:
+            return
+        now = time.monotonic()
+        self.__tokens = min(self.__rate, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+        self.__tokens -= amount
+        if self.__tokens < 0:
+            if interrupt is not None:
+                interrupt.wait(-self.__tokens / self.__rate)
+            else:
+                time.sleep(-self.__tokens / self.__rate)
@@ -6,63 +6,143 @@ Handles Linux user administration
 Classes:
     SystemUserAdministration - Class to handle Linux user administration
     User - Provides an interface for user defined hooks
+    PasswdEntry - Entry of the passwd file
+    ShadowEntry - Entry of the shadow file
+    GroupEntry - Entry of the group file
+    GroupShadowEntry - Entry of the gshadow file
+    PosixAccountDatabase - Indexed in-memory copy of the local account files
+    AccountTransaction - Collects account file changes and writes them at once
+    NativeUserBackend - Creates users in-process, following the useradd defaults of the system
     UserNotExistingError - Exception for when user not exists
     UserAlreadyExistsError - Exception for when the user already exists
     GroupAlreadyExistsError - Exception for when group already exists
+    AccountLockError - Exception for when the account files cannot be locked
 """
 
 
 from UserAdministration import UserAdministration
+from LinuxUsers.records import PasswdEntry, ShadowEntry, GroupEntry, GroupShadowEntry, gecosField
+from LinuxUsers.database import PosixAccountDatabase
+from LinuxUsers.transaction import AccountTransaction, AccountLockError, PASSWD, SHADOW, GROUP, GSHADOW
+from LinuxUsers.native import NativeUserBackend, LOGIN_DEFS_FILE
+from HomeDirectories import HomeCleanupQueue, HomeProvisioner, HomePool, TRASH_DIR, PROVISION_WORKERS
 import os
 import logging
 import crypt
+import contextlib
+import threading
 class SystemUserAdministration(UserAdministration):
     """
     Class to handle Linux user administration
 
     Attributes
     ----------
-    _groups : list[str]
-        Groups in system
+    _database : LinuxUsers.database.PosixAccountDatabase
+        Indexed copy of the account files, only reloaded if a file changed
+    _transaction : LinuxUsers.transaction.AccountTransaction
+        Changes of the running transaction, None outside of transaction()
+    _pendingHooks : list[str]
+        Usernames of created users whose post creation hook runs after the transaction is written
+    _nativeBackend : LinuxUsers.native.NativeUserBackend
+        Creates users without useradd, None to use useradd
+    _pendingUsers : dict{str:tuple(LinuxUsers.records.PasswdEntry, dict)}
+        passwd entry and useradd config of natively created users that aren't written yet, by username
+    _removedHomes : list[tuple(str, int)]
+        Home directory and UID of natively removed users, handed to the cleanup queue after the transaction is written
+    _renamedUsers : dict{str:str}
+        Previous names of users renamed in the running transaction, by new name
+    _movedHomes : list[tuple(str, str)]
+        Previous and new home directory of renamed users, moved after the transaction is written
+    _homeCleanup : HomeDirectories.HomeCleanupQueue
+        Moves home directories of removed users to the trash and deletes them in the background
+    _homeProvisioner : HomeDirectories.HomeProvisioner
+        Creates the home directories of natively created users in parallel
+    _homePool : HomeDirectories.HomePool
+        Creates the home directories of natively created users from pre-built ones, None if there is no pool
+    _homeTemplates : LinuxUsers.native.NativeUserBackend
+        Tells where and from what home directories are created on first login, None if homes are created with the user
+    _homeDatabase : LinuxUsers.database.PosixAccountDatabase
+        Copy of the account files for home directory requests, which are served outside of the sync
+    _homeLock : threading.Lock
+        Serializes home directory requests
     _passwdFile : str
         Path to passwd file
     _shadowFile : str
         Path to shadow file
     _groupFile : str
         Path to group file
+    _gshadowFile : str
+        Path to gshadow file, member lists are kept in sync with the group file if it exists
     _DEBUG : bool
         Methods in this class will print commands instead of executing them if set to True
 
     Methods
     -------
+    transaction()
+        Context manager collecting all account file changes and writing them at once
+    prepareHomes(config)
+        Fills the home directory pool for users created with a config
+    createHome(username, config, groupname=None)
+        Creates the home directory of an existing user on first login
     getUsernameList()
         Returns list of all usernames
     getGroupnameList()
         Returns list of all group names
+    getUserEntry(username)
+        Returns the passwd entry of a user
     addUser(user, config={"-m": None})
         Adds a user to the system
     removeUser(username)
         Removes a user from the system
+    removeUsers(usernames)
+        Removes several users from the system at once
+    renameUser(username, newName, gecos=None)
+        Renames a user in place
     setUserPassword(username, password)
         Sets a password for user
+    setUserGecos(username, gecos)
+        Sets the GECOS field of a user
+    setUserLocked(username, locked)
+        Locks or unlocks the password of a user
     getGroupsForUser(username)
         Get list of groups the user is in
     getUsersInGroup(groupname)
         Get list of users in group
     syncUsers()
-        Read users from passwd file
+        Reads users from passwd file if it changed
     syncGroups()
-        Read groups from group file
+        Reads groups from group file if it changed
     addGroup(groupname, config={})
         Adds a group to the system
+    setGroupMembers(changes)
+        Adds and removes group members in a single rewrite of the group file
+    close()
+        Stops the background deletion of removed home directories and refilling the home directory pool
     """
-    __groups = []
+    __database = None
+    __transaction = None
+    __pendingHooks = []
+    __nativeBackend = None
+    __pendingUsers = {}
+    __removedHomes = []
+    __renamedUsers = {}
+    __movedHomes = []
+    __homeCleanup = None
+    __homeProvisioner = None
+    __homePool = None
+    __homeTemplates = None
+    __homeDatabase = None
+    __homeLock = None
     __passwdFile = ""
     __shadowFile = ""
     __groupFile = ""
+    __gshadowFile = ""
     DEBUG = False
 
-    def __init__(self, passwdFile="/etc/passwd", shadowFile="/etc/shadow", groupFile="/etc/group", DEBUG=False):
+    def __init__(self, passwdFile="/etc/passwd", shadowFile="/etc/shadow", groupFile="/etc/group", gshadowFile=None, DEBUG=False,
+                 userBackend="useradd", loginDefsFile=LOGIN_DEFS_FILE, trashDir=TRASH_DIR, cleanupBytesPerSecond=0, cleanupIops=0,
+                 provisionWorkers=PROVISION_WORKERS, hardlinkReadOnlySkeleton=False, homePoolSize=0,
+                 lazyHomes=False):
         """
         Constructor
 
@@ -74,19 +154,176 @@ class SystemUserAdministration(UserAdministration):
             Path to shadow file, defaults to '/etc/shadow'
         groupFile : str
             Path to group file, defaults to '/etc/group'
+        gshadowFile : str
+            Path to gshadow file, defaults to None (the gshadow file next to the group file)
         DEBUG : bool
             Methods in this class will print commands instead of executing them if set to True, defaults to False
+        userBackend : str
+            'native' to create users in-process with the account transaction, 'useradd' to run useradd, defaults to 'useradd'
+        loginDefsFile : str
+            Path to login.defs, used by the native backend for ID ranges and defaults, defaults to '/etc/login.defs'
+        trashDir : str
+            Directory home directories of natively removed users are moved to before deletion, defaults to '/var/adsyncd/trash'
+        cleanupBytesPerSecond : float
+            Maximum bytes of removed home directories deleted per second, defaults to 0 (no limit)
+        cleanupIops : float
+            Maximum files of removed home directories deleted per second, defaults to 0 (no limit)
+        provisionWorkers : int
+            Number of home directories of natively created users created at the same time, defaults to 4
+        hardlinkReadOnlySkeleton : bool
+            Hard link read-only skeleton files into new home directories instead of copying them, defaults to False
+        homePoolSize : int
+            Number of pre-built home directories kept ready for natively created users, defaults to 0 (no pool)
+        lazyHomes : bool
+            Only write the account entries and create home directories on first login with createHome(), defaults to False
         """
         super().__init__()
+        if gshadowFile is None:
+            gshadowFile = os.path.join(os.path.dirname(groupFile), "gshadow")
         self.__passwdFile = passwdFile
         self.__shadowFile = shadowFile
         self.__groupFile = groupFile
+        self.__gshadowFile = gshadowFile
         self.DEBUG = DEBUG
+        self.__database = PosixAccountDatabase(passwdFile, shadowFile, groupFile, gshadowFile)
+        self.__transaction = None
+        self.__pendingHooks = []
+        self.__pendingUsers = {}
+        self.__removedHomes = []
+        self.__renamedUsers = {}
+        self.__movedHomes = []
+        self.__homeCleanup = HomeCleanupQueue(trashDir, cleanupBytesPerSecond, cleanupIops, DEBUG=DEBUG)
+        self.__homeProvisioner = HomeProvisioner(provisionWorkers, hardlinkReadOnlySkeleton, DEBUG=DEBUG)
+        self.__homePool = HomePool(self.__homeProvisioner, homePoolSize, DEBUG=DEBUG) if homePoolSize > 0 else None
+        if userBackend == "native":
+            self.__nativeBackend = NativeUserBackend(self.__database, loginDefsFile)
+        elif userBackend != "useradd":
+            raise ValueError("Unknown user backend " + userBackend)
+        if lazyHomes:
+            self.__homeDatabase = PosixAccountDatabase(passwdFile, shadowFile, groupFile, gshadowFile)
+            self.__homeTemplates = NativeUserBackend(self.__homeDatabase, loginDefsFile)
+            self.__homeLock = threading.Lock()
         logging.info(
             "System user administration initialized with passwd file " + self.__passwdFile + ", shadow file " + self.__shadowFile + " and group file " + self.__groupFile)
         self.syncUsers()
         self.syncGroups()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager collecting all account file changes and writing them at once
+        Every account file is written at most once when the outermost block is left, also if it is left by an
+        exception, as users created with useradd in the meantime already exist. Home directories of natively
+        created users are created in parallel (unless they are created on first login), home directories of renamed
+        users are moved, home directories of natively removed users are queued for deletion and
+        post user creation hooks run after the changes are written.
+        Lookups only see written changes, except for the existence checks of natively created users.
+
+        Yields
+        ------
+        LinuxUsers.transaction.AccountTransaction
+            Changes of the running transaction
+
+        Raises
+        ------
+        AccountLockError
+            The account files could not be locked to write the changes
+        """
+        if self.__transaction is not None:
+            yield self.__transaction
+            return
+        self.__transaction = AccountTransaction({PASSWD: self.__passwdFile, SHADOW: self.__shadowFile,
+                                                 GROUP: self.__groupFile, GSHADOW: self.__gshadowFile}, DEBUG=self.DEBUG)
+        try:
+            yield self.__transaction
+        finally:
+            transaction, self.__transaction = self.__transaction, None
+            created, self.__pendingUsers = self.__pendingUsers, {}
+            removedHomes, self.__removedHomes = self.__removedHomes, []
+            movedHomes, self.__movedHomes = self.__movedHomes, []
+            self.__renamedUsers = {}
+            try:
+                for path in transaction.commit():
+                    self.__database.invalidate(path)
+                for path, newPath in movedHomes:
+                    self.__moveHome(path, newPath)
+                if self.__homeTemplates is None:
+                    homes = [self.__nativeBackend.getHome(entry, config) for entry, config in created.values()]
+                    (self.__homePool or self.__homeProvisioner).provision([h for h in homes if h is not None])
+                for path, uid in removedHomes:
+                    self.__homeCleanup.enqueue(path, uid)
+            finally:
+                if self.__nativeBackend is not None:
+                    self.__nativeBackend.release()
+                hooks, self.__pendingHooks = self.__pendingHooks, []
+                self.__runHooks(hooks)
+
+    def prepareHomes(self, config):
+        """
+        Fills the home directory pool for users created with a config in the background, so the first users
+        created don't wait for the skeleton to be copied. Does nothing without a pool or the native backend.
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd'
+
+        Returns
+        -------
+        None
+        """
+        backend = self.__homeTemplates or self.__nativeBackend
+        if self.__homePool is None or backend is None or not backend.supports(config):
+            return
+        template = backend.getHomeTemplate(config)
+        if template is not None:
+            self.__homePool.register(*template)
+
+    def createHome(self, username, config, groupname=None):
+        """
+        Creates the home directory of an existing user on first login, if homes aren't created with the users
+        Can be called while a sync is running, an existing home directory is left untouched
+
+        Parameters
+        ----------
+        username : str
+            Username
+        config : dict
+            Configuration for 'useradd' the user was created with, tells if and from which skeleton the home is created
+        groupname : str
+            Group the user has to be in, e.g. the group of all users created by this tool, defaults to None (any user)
+
+        Returns
+        -------
+        bool
+            True if the user has a home directory afterwards
+
+        Raises
+        ------
+        UserNotExistingError
+            User does not exist or is not in the group
+        ValueError
+            Home directories are created with the users
+        """
+        if self.__homeTemplates is None:
+            raise ValueError("Home directories are created with the users")
+        with self.__homeLock:
+            self.__homeDatabase.refresh()
+            entry = self.__homeDatabase.getUser(username)
+            if entry is None:
+                raise UserNotExistingError(username)
+            if groupname is not None:
+                group = self.__homeDatabase.getGroup(groupname)
+                if group is None or (entry.gid != group.gid and username not in group.members):
+                    raise UserNotExistingError(username)
+            home = self.__homeTemplates.getHome(entry, config)
+            if home is None:
+                return False
+            if not os.path.lexists(entry.homeDir):
+                logging.info("Creating home directory of " + username + " on first login")
+                (self.__homePool or self.__homeProvisioner).provision([home])
+            return os.path.isdir(entry.homeDir)
+
     def getUsernameList(self):
         """
         Returns list of all usernames
@@ -97,10 +334,7 @@ class SystemUserAdministration(UserAdministration):
             List of usernames
         """
         self.syncUsers()
-        usernames = []
-        for u in self._users:
-            usernames.append(u["username"])
-        return usernames
+        return [u.username for u in self.__database.getUsers()]
 
     def getGroupnameList(self):
         """
@@ -112,19 +346,34 @@ class SystemUserAdministration(UserAdministration):
             List of group names
         """
         self.syncGroups()
-        groupnames = []
-        for g in self.__groups:
-            groupnames.append(g["name"])
-        return groupnames
+        return [g.name for g in self.__database.getGroups()]
+
+    def getUserEntry(self, username):
+        """
+        Returns the passwd entry of a user
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        LinuxUsers.records.PasswdEntry
+            Entry, None if the user doesn't exist
+        """
+        return self.__database.getUser(username)
 
     def addUser(self, user, config={"-m": None}):
         """
         Adds a user to the system
+        With the native backend, the entries are written with the running transaction and the home directory is
+        created afterwards, otherwise useradd is run
 
         Parameters
         ----------
-        user : list[str]
-            User display name (GECOS) [0] and username [1] of user to be created
+        user : AzureAD.DirectoryUser
+            User to be created, the principal is used as username and the display name as GECOS
         config : dict
             Configuration for 'useradd' command. If an option needs no argument, use it as key and None or an empty string as value
 
@@ -137,22 +386,40 @@ class SystemUserAdministration(UserAdministration):
         UserAlreadyExistsError
             User is already existing and cannot be added
         """
+        username = user.userPrincipalName
         self.syncUsers()
-        logging.info("Adding user " + user[1] + " with config %s", config)
-        if user[1] in self.getUsernameList(): raise UserAlreadyExistsError(user[1])
-        if user[1] in self.getGroupnameList():
+        logging.info("Adding user " + username + " with config %s", config)
+        if self.__userExists(username): raise UserAlreadyExistsError(username)
+        if self.__nativeBackend is not None:
+            if self.__nativeBackend.supports(config):
+                with self.transaction() as transaction:
+                    try:
+                        entry = self.__nativeBackend.createUser(transaction, username, gecosField(user.displayName), config)
+                    except ValueError as e:
+                        logging.error("Could not add user " + username + ": " + str(e))
+                        return
+                    self.__pendingUsers[username] = (entry, config)
+                    self.__pendingHooks.append(username)
+                return
+            logging.warning("Native user backend doesn't support all options of %s, using useradd", config)
+        if self.__database.getGroup(username) is not None:
             #A user group with that name exists, remove
             if self.DEBUG:
-                print("groupdel " + user[1])
+                print("groupdel " + username)
             else:
-                os.system("groupdel " + user[1])
+                os.system("groupdel " + username)
+
+        if self.__homeTemplates is not None:
+            #The home directory is created on first login
+            config = {o: v for o, v in config.items() if o not in ("-m", "--create-home", "-k", "--skel")}
+            config["-M"] = ""
 
         #Composing command
         command = "useradd "
         for option in config:
             command = command + option + " "
             if config[option] or config[option] != "": command = command + config[option] + " "
-        command = command + user[1]
+        command = command + username
 
         #Execute command
         if self.DEBUG:
@@ -160,40 +427,15 @@ class SystemUserAdministration(UserAdministration):
         else:
             os.system(command)
 
-        #Set GECOS string in passwd
-        with open(self.__passwdFile, "r") as passwdFile:
-            passwdData = passwdFile.readlines()
-            for line in passwdData:
-                passwdString = line.split(":")
-                if passwdString[0] == user[1]:
-                    passwdString[4] = user[0]
-                    entryString = ""
-                    for s in passwdString:
-                        if not s.endswith("\n"):
-                            entryString = entryString + s + ":"
-                        else:
-                            entryString = entryString + s
-                    passwdData[passwdData.index(line)] = entryString
-        with open(self.__passwdFile, "w") as passwdFile:
-            passwdFile.writelines(passwdData)
-
-        #Re-sync users and fetch userconfig for current user
-        self.syncUsers()
-        userconfig = ""
-
-        #Execute post-user creation hook, defined in UserCreatedHooks.py
-        for u in self._users:
-            if u["username"] == user:
-                userconfig = u
-        try:
-            from UserDefinedHooks import postUserCreationHook
-            postUserCreationHook(User(user[1], self, userconfig))
-        except Exception as e:
-            logging.error("Execution of post user creation hook failed with: " + str(e))
+        #Set GECOS string in passwd, the hook runs once it is written
+        with self.transaction() as transaction:
+            transaction.update(PASSWD, username, gecos=gecosField(user.displayName))
+            self.__pendingHooks.append(username)
 
     def removeUser(self, username):
         """
         Removes a user from the system
+        The home directory is moved to the trash and deleted in the background
 
         Parameters
         ----------
@@ -210,13 +452,130 @@ class SystemUserAdministration(UserAdministration):
             The user to be removed does not exist and cannot be removed
         """
         logging.info("Removing user " + username)
-        if username not in self.getUsernameList(): raise UserNotExistingError(username)
+        self.syncUsers()
+        if not self.__userExists(username): raise UserNotExistingError(username)
+        if self.__nativeBackend is not None:
+            self.removeUsers([username])
+            return
+        entry = self.__database.getUser(username)
+        sharedHomes = {u.homeDir for u in self.__database.getUsers() if u.username != entry.username}
         if self.DEBUG:
-            print("userdel -r " + username)
+            print("userdel " + username)
             print("groupdel " + username)
         else:
-            os.system("userdel -r " + username)
+            os.system("userdel " + username)
             os.system("groupdel " + username)
+            self.__database.invalidate()
+        #Like with the native backend, the home directory is deleted in the background instead of by userdel -r
+        if entry.homeDir not in sharedHomes:
+            self.__homeCleanup.enqueue(entry.homeDir, entry.uid)
+
+    def removeUsers(self, usernames):
+        """
+        Removes several users from the system at once
+        With the native backend, the passwd and shadow entries, group memberships and private groups of all users
+        are dropped in a single transaction. Afterwards, the home directories are moved to the trash and deleted in the background.
+        Otherwise userdel is run for every user and the home directories are handed to the cleanup queue as well.
+        Users that don't exist are skipped.
+
+        Parameters
+        ----------
+        usernames : list[str]
+            Usernames of users to be removed
+
+        Returns
+        -------
+        None
+        """
+        self.syncUsers()
+        entries = []
+        for username in usernames:
+            entry = self.__database.getUser(username)
+            if entry is None:
+                logging.error("Deleting user " + username + " was attempted, but the user couldn't be found")
+                continue
+            entries.append(entry)
+        if not entries:
+            return
+        if self.__nativeBackend is None:
+            for entry in entries:
+                self.removeUser(entry.username)
+            return
+        removed = frozenset(e.username for e in entries)
+        remaining = [u for u in self.__database.getUsers() if u.username not in removed]
+        primaryGids = {u.gid for u in remaining}
+        sharedHomes = {u.homeDir for u in remaining}
+        groups = set()
+        with self.transaction() as transaction:
+            for entry in entries:
+                logging.info("Removing user " + entry.username)
+                transaction.remove(PASSWD, entry.username)
+                transaction.remove(SHADOW, entry.username)
+                groups.update(self.__database.getGroupsForUser(entry.username))
+                #Private group, unless another user still uses it (like userdel)
+                group = self.__database.getGroup(entry.username)
+                if group is not None and group.gid == entry.gid and entry.gid not in primaryGids and removed.issuperset(group.members):
+                    transaction.remove(GROUP, entry.username)
+                    transaction.remove(GSHADOW, entry.username)
+                    groups.discard(entry.username)
+                if entry.homeDir not in sharedHomes:
+                    self.__removedHomes.append((entry.homeDir, entry.uid))
+            for g in groups:
+                transaction.modify(GROUP, g, lambda e: _changeMembers(e, set(), removed))
+                transaction.modify(GSHADOW, g, lambda e: _changeMembers(e, set(), removed).replace(admins=tuple(a for a in e.admins if a not in removed)))
+
+    def renameUser(self, username, newName, gecos=None):
+        """
+        Renames a user in place, like usermod -l -d -m
+        The passwd and shadow entries, the private group and group memberships are renamed with the running
+        transaction, UID and files are kept. A home directory named after the user is moved afterwards.
+
+        Parameters
+        ----------
+        username : str
+            Current username
+        newName : str
+            New username
+        gecos : str
+            New GECOS field, defaults to None (unchanged), characters not allowed in it are replaced by spaces
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UserNotExistingError
+            User does not exist
+        UserAlreadyExistsError
+            A user with the new name exists
+        """
+        self.syncUsers()
+        entry = self.__database.getUser(username)
+        if entry is None or username in self.__renamedUsers.values(): raise UserNotExistingError(username)
+        if self.__userExists(newName): raise UserAlreadyExistsError(newName)
+        logging.info("Renaming user " + username + " to " + newName)
+        changes = {"username": newName}
+        if gecos is not None:
+            changes["gecos"] = gecosField(gecos)
+        homeDir = os.path.normpath(entry.homeDir)
+        if os.path.basename(homeDir) == username:
+            changes["homeDir"] = os.path.join(os.path.dirname(homeDir), newName)
+        with self.transaction() as transaction:
+            #Changes are keyed by the name in the file, so the entries are renamed where they are
+            transaction.update(PASSWD, username, **changes)
+            transaction.update(SHADOW, username, username=newName)
+            group = self.__database.getGroup(username)
+            if group is not None and group.gid == entry.gid and self.__database.getGroup(newName) is None:
+                transaction.modify(GROUP, username, lambda e: e.replace(name=newName))
+                transaction.modify(GSHADOW, username, lambda e: e.replace(name=newName))
+            for g in self.__database.getGroupsForUser(username):
+                transaction.modify(GROUP, g, lambda e: _renameMember(e, username, newName))
+                transaction.modify(GSHADOW, g, lambda e: _renameMember(e, username, newName).replace(
+                    admins=tuple(newName if a == username else a for a in e.admins)))
+            self.__renamedUsers[newName] = username
+            if "homeDir" in changes:
+                self.__movedHomes.append((entry.homeDir, changes["homeDir"]))
 
     def setUserPassword(self, username, password):
         """
@@ -239,49 +598,66 @@ class SystemUserAdministration(UserAdministration):
             User does not exist and their password cannot be set
         """
         logging.info("Setting new password for user " + username)
-        modifyPasswd = False
-        if not username in self.getUsernameList(): raise UserNotExistingError(username)
-
-        #Check if passwd needs to be modified (if 'x' is set)
-        with open(self.__passwdFile, "r") as passwdFile:
-            passwdData = passwdFile.readlines()
-            for line in passwdData:
-                passwdString = line.split(":")
-                if passwdString[0] == username:
-                    if passwdString[1] != "x":
-                        passwdString[1] = "x"
-                        entryString = ""
-                        for s in passwdString:
-                            if not s == "\n":
-                                entryString = entryString + s + ":"
-                            else:
-                                entryString = entryString + s
-                        passwdData[passwdData.index(line)] = entryString
-                        modifyPasswd = True
-                        break
-                    else:
-                        break
-        if modifyPasswd:
-            #passwd needs to be re-written
-            with open(self.__passwdFile, "w") as passwdFile:
-                passwdFile.writelines(passwdData)
-        #Set password in shadow
-        with open(self.__shadowFile, "r") as shadowFile:
-            data = shadowFile.readlines()
-            for line in data:
-                shadowString = line.split(":")
-                if shadowString[0] == username:
-                    shadowString[1] = crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
-                    entryString = ""
-                    for s in shadowString:
-                        if not s == "\n":
-                            entryString = entryString + s + ":"
-                        else:
-                            entryString = entryString + s
-                    data[data.index(line)] = entryString
-                    break
-        with open(self.__shadowFile, "w") as shadowFile:
-            shadowFile.writelines(data)
+        self.syncUsers()
+        if not self.__userExists(username): raise UserNotExistingError(username)
+        passwordHash = crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
+        with self.transaction() as transaction:
+            #Password is moved to shadow if passwd doesn't point there ('x')
+            name = self.__renamedUsers.get(username, username)
+            transaction.modify(PASSWD, name, lambda entry: entry if entry.hasPassword else entry.replace(password="x"))
+            transaction.update(SHADOW, name, password=passwordHash)
+
+    def setUserGecos(self, username, gecos):
+        """
+        Sets the GECOS field of a user, written with the running transaction
+
+        Parameters
+        ----------
+        username : str
+            Username
+        gecos : str
+            GECOS field, e.g. the display name, characters not allowed in it are replaced by spaces
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UserNotExistingError
+            User does not exist
+        """
+        if not self.__userExists(username): raise UserNotExistingError(username)
+        logging.info("Setting GECOS of user " + username)
+        with self.transaction() as transaction:
+            transaction.update(PASSWD, self.__renamedUsers.get(username, username), gecos=gecosField(gecos))
+
+    def setUserLocked(self, username, locked):
+        """
+        Locks or unlocks the password of a user like usermod -L/-U, written with the running transaction
+        Applied on top of the changes queued before, e.g. a password set in the same transaction. A password that
+        would be empty after unlocking stays locked.
+
+        Parameters
+        ----------
+        username : str
+            Username
+        locked : bool
+            True to lock the password, False to unlock it
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UserNotExistingError
+            User does not exist
+        """
+        if not self.__userExists(username): raise UserNotExistingError(username)
+        logging.info(("Locking" if locked else "Unlocking") + " password of user " + username)
+        with self.transaction() as transaction:
+            transaction.modify(SHADOW, self.__renamedUsers.get(username, username), lambda e: _lockPassword(e, locked))
 
     def getGroupsForUser(self, username):
         """
@@ -298,11 +674,8 @@ class SystemUserAdministration(UserAdministration):
         list[str]
             List of group names
         """
-        groups = []
-        for g in self.__groups:
-            if username in g["members"]:
-                groups.append(g["name"])
-        return groups
+        self.syncGroups()
+        return self.__database.getGroupsForUser(username)
 
     def getUsersInGroup(self, groupname):
         """
@@ -319,50 +692,28 @@ class SystemUserAdministration(UserAdministration):
         list[str]
             List of usernames in group
         """
-        for g in self.__groups:
-            if groupname == g["name"]:
-                return g["members"].split(",")
-        return []
+        self.syncGroups()
+        return self.__database.getUsersInGroup(groupname)
 
     def syncUsers(self):
         """
-        Reads users from passwd file
+        Reads users from passwd file, if it changed since it was last read
 
         Returns
         -------
         None
         """
-        logging.info("Reading users from " + self.__passwdFile)
-        self._users = []
-        with open(self.__passwdFile, "r") as passwdFile:
-            for entry in passwdFile:
-                if not entry == "":
-                    passwdString = entry.split(":")
-                    self._users.append({"username": passwdString[0],
-                                        "hasPassword": (True if passwdString[1] == "x" else False),
-                                        "uid": passwdString[2],
-                                        "gid": passwdString[3],
-                                        "gecos": passwdString[4],
-                                        "homeDir": passwdString[5],
-                                        "shell": passwdString[6]})
-        logging.info("Detected " + str(len(self._users)) + " users")
+        self.__database.refresh()
+
     def syncGroups(self):
         """
-        Read groups from group file
+        Read groups from group file, if it changed since it was last read
 
         Returns
         -------
         None
         """
-        self.__groups = []
-        logging.info("Reading groups from " + self.__groupFile)
-        with open(self.__groupFile, "r") as groupFile:
-            for entry in groupFile:
-                if not (entry == "" or entry == "\n"):
-                    entry = entry.replace("\n", "")
-                    groupString = entry.split(":")
-                    self.__groups.append({"name": groupString[0], "gid": groupString[2], "members": groupString[3]})
-        logging.info(str(len(self.__groups)) + " groups detected")
+        self.__database.refresh()
 
     def addGroup(self, groupname, config={}):
         """
@@ -386,7 +737,7 @@ class SystemUserAdministration(UserAdministration):
         """
         self.syncGroups()
         logging.info("Adding group " + groupname + " with config %s", config)
-        if groupname in self.getGroupnameList():
+        if self.__database.getGroup(groupname) is not None:
             logging.error("CRITICAL: Group already exists. Raising error.")
             raise GroupAlreadyExistsError(groupname)
         #Composing command
@@ -400,8 +751,185 @@ class SystemUserAdministration(UserAdministration):
         else:
             logging.info("Adding group with command " + command)
             os.system(command)
+            self.__database.invalidate()
         self.syncGroups()
 
+    def setGroupMembers(self, changes):
+        """
+        Adds and removes group members in a single rewrite of the group file (and gshadow file, if it exists)
+        Groups that don't exist are skipped. Within transaction(), the changes are written with the transaction.
+
+        Parameters
+        ----------
+        changes : dict{str:tuple(set[str], set[str])}
+            Usernames to be added [0] and removed [1] by group name
+
+        Returns
+        -------
+        None
+        """
+        changes = {g: c for g, c in changes.items() if c[0] or c[1]}
+        if not changes:
+            return
+        for g in changes:
+            logging.info("Changing members of group " + g + ": adding %s, removing %s", sorted(changes[g][0]), sorted(changes[g][1]))
+        with self.transaction() as transaction:
+            for g, (add, remove) in changes.items():
+                for kind in (GROUP, GSHADOW):
+                    transaction.modify(kind, g, lambda entry, add=add, remove=remove: _changeMembers(entry, add, remove))
+
+    def close(self):
+        """
+        Stops the background deletion of removed home directories and refilling the home directory pool,
+        e.g. when the daemon terminates. Home directories not deleted yet stay in the trash and are deleted after a restart
+
+        Returns
+        -------
+        None
+        """
+        self.__homeCleanup.stop()
+        if self.__homePool is not None:
+            self.__homePool.stop()
+
+    def __userExists(self, username):
+        """
+        Check if a user exists or is created or renamed in the running transaction
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        bool
+            True if the user exists
+        """
+        if username in self.__pendingUsers or username in self.__renamedUsers:
+            return True
+        return self.__database.getUser(username) is not None and username not in self.__renamedUsers.values()
+
+    def __moveHome(self, path, newPath):
+        """
+        Moves the home directory of a renamed user, an existing directory at the new path is left alone
+
+        Parameters
+        ----------
+        path : str
+            Previous home directory
+        newPath : str
+            New home directory
+
+        Returns
+        -------
+        None
+        """
+        if not os.path.isdir(path):
+            return
+        if os.path.lexists(newPath):
+            logging.error("Not moving home directory " + path + ", " + newPath + " already exists")
+            return
+        if self.DEBUG:
+            print("mv " + path + " " + newPath)
+            return
+        try:
+            os.rename(path, newPath)
+            logging.info("Moved home directory " + path + " to " + newPath)
+        except OSError as e:
+            logging.error("Could not move home directory " + path + " to " + newPath + ": " + str(e))
+
+    def __runHooks(self, usernames):
+        """
+        Executes the post user creation hook, defined in UserDefinedHooks.py, for created users
+
+        Parameters
+        ----------
+        usernames : list[str]
+            Usernames of the created users
+
+        Returns
+        -------
+        None
+        """
+        if not usernames:
+            return
+        self.syncUsers()
+        for username in usernames:
+            if self.__database.getUser(username) is None:
+                continue
+            try:
+                from UserDefinedHooks import postUserCreationHook
+                postUserCreationHook(User(username, self, self.__database.getUser(username)))
+            except Exception as e:
+                logging.error("Execution of post user creation hook failed with: " + str(e))
+
+
+def _changeMembers(entry, add, remove):
+    """
+    Adds and removes supplementary members of a group or gshadow entry, keeping the order of the remaining members
+
+    Parameters
+    ----------
+    entry : LinuxUsers.records.GroupEntry | LinuxUsers.records.GroupShadowEntry
+        Current entry
+    add : set[str]
+        Usernames to be added
+    remove : set[str]
+        Usernames to be removed
+
+    Returns
+    -------
+    LinuxUsers.records.GroupEntry | LinuxUsers.records.GroupShadowEntry
+        Changed entry
+    """
+    members = [m for m in entry.members if m not in remove]
+    members += sorted(add.difference(members))
+    return entry.replace(members=tuple(members))
+
+
+def _lockPassword(entry, locked):
+    """
+    Locks or unlocks the password of a shadow entry by adding or removing a leading '!'
+
+    Parameters
+    ----------
+    entry : LinuxUsers.records.ShadowEntry
+        Current entry
+    locked : bool
+        True to lock the password, False to unlock it
+
+    Returns
+    -------
+    LinuxUsers.records.ShadowEntry
+        Changed entry, the same entry if nothing changed
+    """
+    if locked and not entry.password.startswith("!"):
+        return entry.replace(password="!" + entry.password)
+    if not locked and entry.password.startswith("!") and len(entry.password) > 1:
+        return entry.replace(password=entry.password[1:])
+    return entry
+
+
+def _renameMember(entry, username, newName):
+    """
+    Renames a supplementary member of a group or gshadow entry in place
+
+    Parameters
+    ----------
+    entry : LinuxUsers.records.GroupEntry | LinuxUsers.records.GroupShadowEntry
+        Current entry
+    username : str
+        Current username
+    newName : str
+        New username
+
+    Returns
+    -------
+    LinuxUsers.records.GroupEntry | LinuxUsers.records.GroupShadowEntry
+        Changed entry
+    """
+    return entry.replace(members=tuple(dict.fromkeys(newName if m == username else m for m in entry.members)))
+
 
 class User:
     """
@@ -413,7 +941,7 @@ class User:
         Username
     __admin : SystemUserAdministration
         Active linux system user handler, private
-    _properties : dict
+    _properties : LinuxUsers.records.PasswdEntry
         Properties as defined in the passwd file
 
     Methods
@@ -437,7 +965,7 @@ class User:
             Username
         admin : SystemUserAdministration
             Active linux system user handler
-        properties : dict
+        properties : LinuxUsers.records.PasswdEntry
             Properties of user as in passwd file
         """
         self._username = username
@@ -0,0 +1,368 @@
+"""
+POSIX account database
+
+Keeps the entries of the passwd, shadow, group and gshadow files in memory, indexed for lookups by name and ID.
+A file is only parsed again once its modification time, size or inode changed.
+
+Classes:
+    PosixAccountDatabase - Indexed in-memory copy of the local account files
+"""
+
+import os
+import logging
+
+from LinuxUsers.records import PasswdEntry, ShadowEntry, GroupEntry, GroupShadowEntry
+
+
+class PosixAccountDatabase:
+    """
+    Indexed in-memory copy of the local account files
+    passwd and group are reloaded by refresh(), shadow and gshadow only when one of their entries is requested.
+    Lookups don't check the files, call refresh() once before a series of lookups.
+
+    Attributes
+    ----------
+    __passwdFile : str
+        Path to passwd file
+    __shadowFile : str
+        Path to shadow file
+    __groupFile : str
+        Path to group file
+    __gshadowFile : str
+        Path to gshadow file, treated as empty if it doesn't exist
+    __signatures : dict{str:tuple(int, int, int)}
+        Modification time, size and inode of every file as of its last parse, by path
+    __users : dict{str:LinuxUsers.records.PasswdEntry}
+        passwd entries by username, in file order
+    __usersByUid : dict{int:LinuxUsers.records.PasswdEntry}
+        passwd entries by UID, the first entry wins for duplicate UIDs
+    __groups : dict{str:LinuxUsers.records.GroupEntry}
+        group entries by group name, in file order
+    __groupsByGid : dict{int:LinuxUsers.records.GroupEntry}
+        group entries by GID, the first entry wins for duplicate GIDs
+    __userGroups : dict{str:list[str]}
+        Names of the groups a user is a supplementary member of, by username
+    __shadow : dict{str:LinuxUsers.records.ShadowEntry}
+        shadow entries by username
+    __gshadow : dict{str:LinuxUsers.records.GroupShadowEntry}
+        gshadow entries by group name
+
+    Methods
+    -------
+    refresh()
+        Parses passwd and group again if they changed since they were last read
+    invalidate(path=None)
+        Forces a file to be parsed again on the next refresh
+    getUsers()
+        Returns all passwd entries
+    getUser(username)
+        Returns the passwd entry of a user
+    getUserByUid(uid)
+        Returns the passwd entry of a UID
+    getShadowEntry(username)
+        Returns the shadow entry of a user
+    getGroups()
+        Returns all group entries
+    getGroup(groupname)
+        Returns the group entry of a group
+    getGroupByGid(gid)
+        Returns the group entry of a GID
+    getGroupShadowEntry(groupname)
+        Returns the gshadow entry of a group
+    getGroupsForUser(username)
+        Returns the names of the groups a user is a supplementary member of
+    getUsersInGroup(groupname)
+        Returns the supplementary members of a group
+    """
+    __passwdFile = ""
+    __shadowFile = ""
+    __groupFile = ""
+    __gshadowFile = ""
+    __signatures = {}
+    __users = {}
+    __usersByUid = {}
+    __groups = {}
+    __groupsByGid = {}
+    __userGroups = {}
+    __shadow = {}
+    __gshadow = {}
+
+    def __init__(self, passwdFile="/etc/passwd", shadowFile="/etc/shadow", groupFile="/etc/group", gshadowFile="/etc/gshadow"):
+        """
+        Constructor
+        Files are read on the first refresh()
+
+        Parameters
+        ----------
+        passwdFile : str
+            Path to passwd file, defaults to '/etc/passwd'
+        shadowFile : str
+            Path to shadow file, defaults to '/etc/shadow'
+        groupFile : str
+            Path to group file, defaults to '/etc/group'
+        gshadowFile : str
+            Path to gshadow file, defaults to '/etc/gshadow'
+        """
+        self.__passwdFile = passwdFile
+        self.__shadowFile = shadowFile
+        self.__groupFile = groupFile
+        self.__gshadowFile = gshadowFile
+        self.__signatures = {}
+        self.__users = {}
+        self.__usersByUid = {}
+        self.__groups = {}
+        self.__groupsByGid = {}
+        self.__userGroups = {}
+        self.__shadow = {}
+        self.__gshadow = {}
+
+    def refresh(self):
+        """
+        Parses passwd and group again if they changed since they were last read
+
+        Returns
+        -------
+        None
+        """
+        lines = self.__readIfChanged(self.__passwdFile)
+        if lines is not None:
+            logging.info("Reading users from " + self.__passwdFile)
+            self.__users = {}
+            self.__usersByUid = {}
+            for line in lines:
+                if line.strip():
+                    entry = PasswdEntry.fromLine(line)
+                    self.__users.setdefault(entry.username, entry)
+                    self.__usersByUid.setdefault(entry.uid, entry)
+            logging.info("Detected " + str(len(self.__users)) + " users")
+        lines = self.__readIfChanged(self.__groupFile)
+        if lines is not None:
+            logging.info("Reading groups from " + self.__groupFile)
+            self.__groups = {}
+            self.__groupsByGid = {}
+            self.__userGroups = {}
+            for line in lines:
+                if line.strip():
+                    entry = GroupEntry.fromLine(line)
+                    if entry.name in self.__groups:
+                        continue
+                    self.__groups[entry.name] = entry
+                    self.__groupsByGid.setdefault(entry.gid, entry)
+                    for m in entry.members:
+                        self.__userGroups.setdefault(m, []).append(entry.name)
+            logging.info(str(len(self.__groups)) + " groups detected")
+
+    def invalidate(self, path=None):
+        """
+        Forces a file to be parsed again on the next refresh (or lookup for shadow and gshadow)
+        Needed after writing a file, as a rewrite within the timestamp granularity might keep size and inode
+
+        Parameters
+        ----------
+        path : str
+            Path of the file, defaults to None (all files)
+
+        Returns
+        -------
+        None
+        """
+        if path is None:
+            self.__signatures = {}
+        else:
+            self.__signatures.pop(path, None)
+
+    def getUsers(self):
+        """
+        Returns all passwd entries
+
+        Returns
+        -------
+        list[LinuxUsers.records.PasswdEntry]
+            Entries in file order
+        """
+        return list(self.__users.values())
+
+    def getUser(self, username):
+        """
+        Returns the passwd entry of a user
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        LinuxUsers.records.PasswdEntry
+            Entry, None if the user doesn't exist
+        """
+        return self.__users.get(username)
+
+    def getUserByUid(self, uid):
+        """
+        Returns the passwd entry of a UID
+
+        Parameters
+        ----------
+        uid : int
+            User ID
+
+        Returns
+        -------
+        LinuxUsers.records.PasswdEntry
+            Entry, None if no user has this UID
+        """
+        return self.__usersByUid.get(uid)
+
+    def getShadowEntry(self, username):
+        """
+        Returns the shadow entry of a user, the shadow file is parsed again if it changed
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        LinuxUsers.records.ShadowEntry
+            Entry, None if the user has no shadow entry
+        """
+        lines = self.__readIfChanged(self.__shadowFile)
+        if lines is not None:
+            self.__shadow = {}
+            for line in lines:
+                if line.strip():
+                    entry = ShadowEntry.fromLine(line)
+                    self.__shadow.setdefault(entry.username, entry)
+        return self.__shadow.get(username)
+
+    def getGroups(self):
+        """
+        Returns all group entries
+
+        Returns
+        -------
+        list[LinuxUsers.records.GroupEntry]
+            Entries in file order
+        """
+        return list(self.__groups.values())
+
+    def getGroup(self, groupname):
+        """
+        Returns the group entry of a group
+
+        Parameters
+        ----------
+        groupname : str
+            Group name
+
+        Returns
+        -------
+        LinuxUsers.records.GroupEntry
+            Entry, None if the group doesn't exist
+        """
+        return self.__groups.get(groupname)
+
+    def getGroupByGid(self, gid):
+        """
+        Returns the group entry of a GID
+
+        Parameters
+        ----------
+        gid : int
+            Group ID
+
+        Returns
+        -------
+        LinuxUsers.records.GroupEntry
+            Entry, None if no group has this GID
+        """
+        return self.__groupsByGid.get(gid)
+
+    def getGroupShadowEntry(self, groupname):
+        """
+        Returns the gshadow entry of a group, the gshadow file is parsed again if it changed
+
+        Parameters
+        ----------
+        groupname : str
+            Group name
+
+        Returns
+        -------
+        LinuxUsers.records.GroupShadowEntry
+            Entry, None if the group has no gshadow entry or there is no gshadow file
+        """
+        lines = self.__readIfChanged(self.__gshadowFile)
+        if lines is not None:
+            self.__gshadow = {}
+            for line in lines:
+                if line.strip():
+                    entry = GroupShadowEntry.fromLine(line)
+                    self.__gshadow.setdefault(entry.name, entry)
+        return self.__gshadow.get(groupname)
+
+    def getGroupsForUser(self, username):
+        """
+        Returns the names of the groups a user is a supplementary member of
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        list[str]
+            Group names in file order, empty if the user is in no group or doesn't exist
+        """
+        return list(self.__userGroups.get(username, ()))
+
+    def getUsersInGroup(self, groupname):
+        """
+        Returns the supplementary members of a group
+
+        Parameters
+        ----------
+        groupname : str
+            Group name
+
+        Returns
+        -------
+        list[str]
+            Usernames, empty if the group has no members or doesn't exist
+        """
+        group = self.__groups.get(groupname)
+        return list(group.members) if group is not None else []
+
+    def __readIfChanged(self, path):
+        """
+        Reads a file if its modification time, size or inode changed since it was last read
+
+        Parameters
+        ----------
+        path : str
+            Path of the file
+
+        Returns
+        -------
+        list[str]
+            Lines of the file, None if it is unchanged. A missing file is read as empty.
+        """
+        try:
+            st = os.stat(path)
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            signature = None
+        if path in self.__signatures and self.__signatures[path] == signature:
+            return None
+        lines = []
+        if signature is not None:
+            with open(path, "r") as accountFile:
+                #The file might have been replaced since stat, remember what was actually read
+                st = os.fstat(accountFile.fileno())
+                signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+                lines = accountFile.readlines()
+        self.__signatures[path] = signature
+        return lines
@@ -0,0 +1,351 @@
+"""
+Native user creation
+
+Creates users without forking useradd: IDs are allocated from the account database and the passwd, shadow and
+group entries are queued in the running account transaction, so creating many users costs one write per file.
+
+Classes:
+    NativeUserBackend - Creates users in-process, following the useradd defaults of the system
+"""
+
+import os
+import time
+import logging
+import itertools
+
+from LinuxUsers.records import PasswdEntry, ShadowEntry, GroupEntry, GroupShadowEntry
+from LinuxUsers.transaction import PASSWD, SHADOW, GROUP, GSHADOW
+
+LOGIN_DEFS_FILE = "/etc/login.defs"
+USERADD_DEFAULTS_FILE = "/etc/default/useradd"
+SUPPORTED_OPTIONS = ("-m", "--create-home", "-M", "--no-create-home", "-k", "--skel", "-s", "--shell", "-g", "--gid",
+                     "-G", "--groups", "-d", "--home-dir", "-b", "--base-dir", "-N", "--no-user-group", "-U", "--user-group")
+
+
+def _readSettings(path, separator=None):
+    """
+    Reads a settings file like login.defs ('KEY VALUE') or /etc/default/useradd ('KEY=VALUE')
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    separator : str
+        Separator between key and value, defaults to None (whitespace)
+
+    Returns
+    -------
+    dict{str:str}
+        Values by key, empty if the file doesn't exist
+    """
+    settings = {}
+    try:
+        with open(path, "r") as settingsFile:
+            for line in settingsFile:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split(separator, 1)
+                if len(parts) == 2:
+                    settings[parts[0].strip()] = parts[1].strip().strip('"')
+    except FileNotFoundError:
+        pass
+    return settings
+
+
+class NativeUserBackend:
+    """
+    Creates users in-process, following the useradd defaults of the system
+    Understands the useradd options -m, -M, -k, -s, -g, -G, -d, -b, -N and -U (and their long forms).
+    UIDs and GIDs are allocated like useradd does, above the highest ID in use, so IDs of removed users
+    aren't handed out again while there is room above.
+
+    Attributes
+    ----------
+    __database : LinuxUsers.database.PosixAccountDatabase
+        Account database IDs are allocated from
+    __loginDefs : dict{str:str}
+        Settings from login.defs
+    __defaults : dict{str:str}
+        Settings from /etc/default/useradd
+    __reservedUids : set[int]
+        UIDs allocated for users that aren't written yet
+    __reservedGids : set[int]
+        GIDs allocated for groups that aren't written yet
+    __nextUid : int
+        UID the search for a free UID starts at, None before the first allocation
+    __nextGid : int
+        GID the search for a free GID starts at, None before the first allocation
+
+    Methods
+    -------
+    supports(config)
+        Check if a useradd config can be handled natively
+    createUser(transaction, username, gecos, config)
+        Queues passwd, shadow and group entries of a new user
+    getHome(entry, config)
+        Returns what the home directory of a user is created from
+    getHomeTemplate(config)
+        Returns where home directories are created and what from
+    release()
+        Forgets IDs reserved for entries that have been written or discarded
+    """
+    __database = None
+    __loginDefs = {}
+    __defaults = {}
+    __reservedUids = set()
+    __reservedGids = set()
+    __nextUid = None
+    __nextGid = None
+
+    def __init__(self, database, loginDefsFile=LOGIN_DEFS_FILE, defaultsFile=USERADD_DEFAULTS_FILE):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        database : LinuxUsers.database.PosixAccountDatabase
+            Account database IDs are allocated from
+        loginDefsFile : str
+            Path to login.defs, defaults to '/etc/login.defs'
+        defaultsFile : str
+            Path to the useradd defaults, defaults to '/etc/default/useradd'
+        """
+        self.__database = database
+        self.__loginDefs = _readSettings(loginDefsFile)
+        self.__defaults = _readSettings(defaultsFile, "=")
+        self.__reservedUids = set()
+        self.__reservedGids = set()
+
+    def supports(self, config):
+        """
+        Check if a useradd config can be handled natively
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd'
+
+        Returns
+        -------
+        bool
+            True if all options are understood
+        """
+        return all(option in SUPPORTED_OPTIONS for option in config)
+
+    def createUser(self, transaction, username, gecos, config):
+        """
+        Queues passwd, shadow and group entries of a new user
+        The database has to be refreshed before. The account is locked ('!') until a password is set.
+
+        Parameters
+        ----------
+        transaction : LinuxUsers.transaction.AccountTransaction
+            Transaction the entries are queued in
+        username : str
+            Username
+        gecos : str
+            GECOS field, e.g. the display name
+        config : dict
+            Configuration for 'useradd', see supports()
+
+        Returns
+        -------
+        LinuxUsers.records.PasswdEntry
+            passwd entry of the user
+
+        Raises
+        ------
+        ValueError
+            The primary group doesn't exist or no UID/GID is free
+        """
+        uid = self.__allocate(self.__reservedUids, self.__database.getUserByUid, "UID")
+        primaryGroup = self.__option(config, "-g", "--gid")
+        if primaryGroup:
+            group = self.__database.getGroupByGid(int(primaryGroup)) if primaryGroup.isdigit() else self.__database.getGroup(primaryGroup)
+            if group is None:
+                raise ValueError("Primary group " + primaryGroup + " doesn't exist")
+            gid = group.gid
+        elif self.__userGroups(config):
+            #Private group, with the same ID as the user if possible
+            if self.__database.getGroupByGid(uid) is None and uid not in self.__reservedGids:
+                gid = uid
+                self.__reservedGids.add(gid)
+            else:
+                gid = self.__allocate(self.__reservedGids, self.__database.getGroupByGid, "GID")
+            transaction.put(GROUP, GroupEntry(username, "x", gid, ()))
+            transaction.put(GSHADOW, GroupShadowEntry(username, "!", (), ()))
+        else:
+            gid = int(self.__defaults.get("GROUP", 100))
+        homeDir = self.__option(config, "-d", "--home-dir")
+        if not homeDir:
+            homeDir = os.path.join(self.__option(config, "-b", "--base-dir") or self.__defaults.get("HOME", "/home"), username)
+        shell = self.__option(config, "-s", "--shell") or self.__defaults.get("SHELL", "/bin/sh")
+        entry = PasswdEntry(username, "x", uid, gid, gecos, homeDir, shell)
+        transaction.put(PASSWD, entry)
+        transaction.put(SHADOW, ShadowEntry(username, "!", str(int(time.time() // 86400)),
+                                            self.__loginDefs.get("PASS_MIN_DAYS", "0"), self.__loginDefs.get("PASS_MAX_DAYS", "99999"),
+                                            self.__loginDefs.get("PASS_WARN_AGE", "7"), "", "", ""))
+        for g in (self.__option(config, "-G", "--groups") or "").split(","):
+            g = g.strip()
+            if not g:
+                continue
+            if self.__database.getGroup(g) is None:
+                logging.error("Group " + g + " doesn't exist, " + username + " is not added to it")
+                continue
+            for kind in (GROUP, GSHADOW):
+                transaction.modify(kind, g, lambda e: e if username in e.members else e.replace(members=e.members + (username,)))
+        return entry
+
+    def getHome(self, entry, config):
+        """
+        Returns what the home directory of a user is created from, if the config asks for one
+
+        Parameters
+        ----------
+        entry : LinuxUsers.records.PasswdEntry
+            passwd entry of the user
+        config : dict
+            Configuration for 'useradd', see supports()
+
+        Returns
+        -------
+        tuple(str, str, int, int, int)
+            Home directory, skeleton directory (None if it doesn't exist), UID, GID and permissions,
+            None if no home directory is created
+        """
+        template = self.getHomeTemplate(config)
+        if template is None:
+            return None
+        return entry.homeDir, template[1], entry.uid, entry.gid, template[2]
+
+    def getHomeTemplate(self, config):
+        """
+        Returns where home directories are created and what from, if the config asks for them
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd', see supports()
+
+        Returns
+        -------
+        tuple(str, str, int)
+            Base directory, skeleton directory (None if it doesn't exist) and permissions,
+            None if no home directories are created
+        """
+        if not self.__createsHome(config):
+            return None
+        baseDir = self.__option(config, "-b", "--base-dir") or self.__defaults.get("HOME", "/home")
+        skeleton = self.__option(config, "-k", "--skel") or self.__defaults.get("SKEL", "/etc/skel")
+        mode = int(self.__loginDefs["HOME_MODE"], 8) if "HOME_MODE" in self.__loginDefs else 0o777 & ~int(self.__loginDefs.get("UMASK", "022"), 8)
+        return baseDir, skeleton if os.path.isdir(skeleton) else None, mode
+
+    def release(self):
+        """
+        Forgets IDs reserved for entries that have been written or discarded
+
+        Returns
+        -------
+        None
+        """
+        self.__reservedUids = set()
+        self.__reservedGids = set()
+
+    def __allocate(self, reserved, lookup, kind):
+        """
+        Allocates a free UID or GID above the highest one in use, or the lowest free one if there is none above
+
+        Parameters
+        ----------
+        reserved : set[int]
+            IDs allocated but not written yet, the new ID is added
+        lookup : Callable
+            Returns the entry using an ID, e.g. PosixAccountDatabase.getUserByUid
+        kind : str
+            'UID' or 'GID'
+
+        Returns
+        -------
+        int
+            Allocated ID
+
+        Raises
+        ------
+        ValueError
+            No ID is free
+        """
+        low = int(self.__loginDefs.get(kind + "_MIN", 1000))
+        high = int(self.__loginDefs.get(kind + "_MAX", 60000))
+        start = self.__nextUid if kind == "UID" else self.__nextGid
+        if start is None:
+            entries = self.__database.getUsers() if kind == "UID" else self.__database.getGroups()
+            used = [e.uid if kind == "UID" else e.gid for e in entries]
+            start = max([i for i in used if low <= i <= high], default=low - 1) + 1
+        for i in itertools.chain(range(max(start, low), high + 1), range(low, min(start, high + 1))):
+            if lookup(i) is None and i not in reserved:
+                reserved.add(i)
+                if kind == "UID":
+                    self.__nextUid = i + 1
+                else:
+                    self.__nextGid = i + 1
+                return i
+        raise ValueError("No free " + kind + " between " + str(low) + " and " + str(high))
+
+    def __userGroups(self, config):
+        """
+        Check if a private group is created for the user
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd'
+
+        Returns
+        -------
+        bool
+            True if a group with the name of the user is created
+        """
+        if "-N" in config or "--no-user-group" in config:
+            return False
+        return "-U" in config or "--user-group" in config or self.__loginDefs.get("USERGROUPS_ENAB", "yes").lower() == "yes"
+
+    def __createsHome(self, config):
+        """
+        Check if the home directory is created
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd'
+
+        Returns
+        -------
+        bool
+            True if the home directory is created
+        """
+        if "-M" in config or "--no-create-home" in config:
+            return False
+        return "-m" in config or "--create-home" in config or self.__loginDefs.get("CREATE_HOME", "no").lower() == "yes"
+
+    @staticmethod
+    def __option(config, short, long):
+        """
+        Returns the value of a useradd option given in short or long form
+
+        Parameters
+        ----------
+        config : dict
+            Configuration for 'useradd'
+        short : str
+            Short form, e.g. '-s'
+        long : str
+            Long form, e.g. '--shell'
+
+        Returns
+        -------
+        str
+            Value, None if the option isn't set
+        """
+        value = config.get(short, config.get(long))
+        return value.strip() if isinstance(value, str) else value
@@ -0,0 +1,305 @@
+"""
+POSIX account records
+
+Compact immutable records for the entries of the passwd, shadow, group and gshadow files.
+
+Classes:
+    PasswdEntry - Entry of the passwd file
+    ShadowEntry - Entry of the shadow file
+    GroupEntry - Entry of the group file
+    GroupShadowEntry - Entry of the gshadow file
+"""
+
+from UserAdministration import Record, internName
+
+
+def _splitLine(line, fieldCount):
+    """
+    Splits a line of a colon separated account file
+
+    Parameters
+    ----------
+    line : str
+        Line, with or without trailing newline
+    fieldCount : int
+        Expected number of fields, missing trailing fields are filled with empty strings
+
+    Returns
+    -------
+    list[str]
+        Fields
+    """
+    fields = line.rstrip("\n").split(":")
+    if len(fields) < fieldCount:
+        fields += [""] * (fieldCount - len(fields))
+    return fields
+
+
+def _toInt(value):
+    """
+    Converts an ID field to int
+
+    Parameters
+    ----------
+    value : str
+        Field value
+
+    Returns
+    -------
+    int
+        ID, -1 if the field is empty or not a number (e.g. NIS compat entries)
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return -1
+
+
+def _splitNames(names):
+    """
+    Splits a comma separated list of user names into a tuple of interned names
+
+    Parameters
+    ----------
+    names : str
+        Comma separated names
+
+    Returns
+    -------
+    tuple(str)
+        Interned names
+    """
+    return tuple(internName(n) for n in names.split(",") if n)
+
+
+def gecosField(text):
+    """
+    Turns a text like a display name into a GECOS field
+    Colons and newlines would break the passwd line and commas separate GECOS subfields, so they are replaced by spaces
+    like all other control characters. Runs of spaces are collapsed.
+
+    Parameters
+    ----------
+    text : str
+        Text, may be None
+
+    Returns
+    -------
+    str
+        GECOS field
+    """
+    if not text:
+        return ""
+    return " ".join("".join(" " if c in ":," or ord(c) < 32 or ord(c) == 127 else c for c in text).split())
+
+
+class PasswdEntry(Record):
+    """
+    Entry of the passwd file
+
+    Attributes
+    ----------
+    username : str
+        Username (interned)
+    password : str
+        Password field, 'x' if the password is in the shadow file
+    uid : int
+        User ID
+    gid : int
+        Primary group ID
+    gecos : str
+        GECOS field, e.g. the display name
+    homeDir : str
+        Home directory
+    shell : str
+        Login shell
+    """
+    __slots__ = ("username", "password", "uid", "gid", "gecos", "homeDir", "shell")
+
+    @classmethod
+    def fromLine(cls, line):
+        """
+        Parses a line of the passwd file
+
+        Parameters
+        ----------
+        line : str
+            Line, with or without trailing newline
+
+        Returns
+        -------
+        PasswdEntry
+            Parsed entry
+        """
+        f = _splitLine(line, 7)
+        return cls(internName(f[0]), f[1], _toInt(f[2]), _toInt(f[3]), f[4], f[5], ":".join(f[6:]))
+
+    @property
+    def hasPassword(self):
+        """
+        True if the password is stored in the shadow file
+        """
+        return self.password == "x"
+
+    def toLine(self):
+        """
+        Formats the entry as line of the passwd file
+
+        Returns
+        -------
+        str
+            Line including trailing newline
+        """
+        return ":".join((self.username, self.password, str(self.uid), str(self.gid), self.gecos, self.homeDir, self.shell)) + "\n"
+
+
+class ShadowEntry(Record):
+    """
+    Entry of the shadow file
+    Aging fields are kept as strings, as they are often empty
+
+    Attributes
+    ----------
+    username : str
+        Username (interned)
+    password : str
+        Password hash
+    lastChange : str
+        Days since epoch of the last password change
+    minAge : str
+        Minimum password age in days
+    maxAge : str
+        Maximum password age in days
+    warnPeriod : str
+        Password warning period in days
+    inactivity : str
+        Password inactivity period in days
+    expiration : str
+        Days since epoch the account expires at
+    reserved : str
+        Reserved field
+    """
+    __slots__ = ("username", "password", "lastChange", "minAge", "maxAge", "warnPeriod", "inactivity", "expiration", "reserved")
+
+    @classmethod
+    def fromLine(cls, line):
+        """
+        Parses a line of the shadow file
+
+        Parameters
+        ----------
+        line : str
+            Line, with or without trailing newline
+
+        Returns
+        -------
+        ShadowEntry
+            Parsed entry
+        """
+        f = _splitLine(line, 9)
+        return cls(internName(f[0]), *f[1:8], ":".join(f[8:]))
+
+    def toLine(self):
+        """
+        Formats the entry as line of the shadow file
+
+        Returns
+        -------
+        str
+            Line including trailing newline
+        """
+        return ":".join(self.toTuple()) + "\n"
+
+
+class GroupEntry(Record):
+    """
+    Entry of the group file
+
+    Attributes
+    ----------
+    name : str
+        Group name (interned)
+    password : str
+        Password field
+    gid : int
+        Group ID
+    members : tuple(str)
+        Usernames of supplementary members (interned)
+    """
+    __slots__ = ("name", "password", "gid", "members")
+
+    @classmethod
+    def fromLine(cls, line):
+        """
+        Parses a line of the group file
+
+        Parameters
+        ----------
+        line : str
+            Line, with or without trailing newline
+
+        Returns
+        -------
+        GroupEntry
+            Parsed entry
+        """
+        f = _splitLine(line, 4)
+        return cls(internName(f[0]), f[1], _toInt(f[2]), _splitNames(f[3]))
+
+    def toLine(self):
+        """
+        Formats the entry as line of the group file
+
+        Returns
+        -------
+        str
+            Line including trailing newline
+        """
+        return ":".join((self.name, self.password, str(self.gid), ",".join(self.members))) + "\n"
+
+
+class GroupShadowEntry(Record):
+    """
+    Entry of the gshadow file
+
+    Attributes
+    ----------
+    name : str
+        Group name (interned)
+    password : str
+        Password hash
+    admins : tuple(str)
+        Usernames of group administrators (interned)
+    members : tuple(str)
+        Usernames of supplementary members (interned)
+    """
+    __slots__ = ("name", "password", "admins", "members")
+
+    @classmethod
+    def fromLine(cls, line):
+        """
+        Parses a line of the gshadow file
+
+        Parameters
+        ----------
+        line : str
+            Line, with or without trailing newline
+
+        Returns
+        -------
+        GroupShadowEntry
+            Parsed entry
+        """
+        f = _splitLine(line, 4)
+        return cls(internName(f[0]), f[1], _splitNames(f[2]), _splitNames(f[3]))
+
+    def toLine(self):
+        """
+        Formats the entry as line of the gshadow file
+
+        Returns
+        -------
+        str
+            Line including trailing newline
+        """
+        return ":".join((self.name, self.password, ",".join(self.admins), ",".join(self.members))) + "\n"
@@ -0,0 +1,414 @@
+"""
+Batched writes to the account files
+
+Collects changes to passwd, shadow, group and gshadow and writes every file once, atomically and under the
+same locks shadow-utils uses, so tools like useradd or passwd running at the same time don't lose changes.
+
+Classes:
+    AccountTransaction - Collects account file changes and writes them at once
+    AccountLockError - Exception for when the account files cannot be locked
+"""
+
+import os
+import time
+import errno
+import fcntl
+import logging
+import contextlib
+
+from LinuxUsers.records import PasswdEntry, ShadowEntry, GroupEntry, GroupShadowEntry
+
+PASSWD = "passwd"
+SHADOW = "shadow"
+GROUP = "group"
+GSHADOW = "gshadow"
+ENTRY_TYPES = {PASSWD: PasswdEntry, SHADOW: ShadowEntry, GROUP: GroupEntry, GSHADOW: GroupShadowEntry}
+LOCK_TIMEOUT = 15
+LOCK_RETRY_INTERVAL = 0.1
+
+
+class AccountTransaction:
+    """
+    Collects account file changes and writes them at once
+    Changes are keyed by user or group name and applied to a fresh read of the file while it is locked,
+    so lines changed by other tools in the meantime are kept. Every file is written to a temporary file,
+    synced and renamed over the original, a crash leaves either the old or the new file.
+
+    Attributes
+    ----------
+    __files : dict{str:str}
+        Paths of the account files by kind ('passwd', 'shadow', 'group', 'gshadow')
+    __operations : dict{str:dict{str:list[Callable]}}
+        Changes by kind and entry name, each taking the current entry (None if missing) and returning the new one (None to remove it)
+    __lockTimeout : float
+        Seconds to wait for the locks
+    __DEBUG : bool
+        Print the files that would be written instead of writing them
+
+    Methods
+    -------
+    put(kind, entry)
+        Adds an entry or replaces the entry with the same name
+    update(kind, name, **changes)
+        Changes fields of an existing entry
+    modify(kind, name, function)
+        Changes an existing entry with a function
+    remove(kind, name)
+        Removes an entry
+    isEmpty()
+        Check if there are changes to be written
+    commit()
+        Writes all changes, each file once
+    """
+    __files = {}
+    __operations = {}
+    __lockTimeout = LOCK_TIMEOUT
+    __DEBUG = False
+
+    def __init__(self, files, lockTimeout=LOCK_TIMEOUT, DEBUG=False):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        files : dict{str:str}
+            Paths of the account files by kind ('passwd', 'shadow', 'group', 'gshadow')
+        lockTimeout : float
+            Seconds to wait for the locks, defaults to 15 (as lckpwdf)
+        DEBUG : bool
+            Print the files that would be written instead of writing them, defaults to False
+        """
+        self.__files = dict(files)
+        self.__operations = {}
+        self.__lockTimeout = lockTimeout
+        self.__DEBUG = DEBUG
+
+    def put(self, kind, entry):
+        """
+        Adds an entry or replaces the entry with the same name
+
+        Parameters
+        ----------
+        kind : str
+            Account file, one of 'passwd', 'shadow', 'group' and 'gshadow'
+        entry : UserAdministration.Record
+            Entry of the matching type, e.g. LinuxUsers.records.PasswdEntry for 'passwd'
+
+        Returns
+        -------
+        None
+        """
+        self.__add(kind, entry.toTuple()[0], lambda current: entry)
+
+    def update(self, kind, name, **changes):
+        """
+        Changes fields of an existing entry, nothing is changed if the entry doesn't exist at commit time
+
+        Parameters
+        ----------
+        kind : str
+            Account file, one of 'passwd', 'shadow', 'group' and 'gshadow'
+        name : str
+            User or group name
+        **changes
+            New field values by field name
+
+        Returns
+        -------
+        None
+        """
+        self.modify(kind, name, lambda current: current.replace(**changes))
+
+    def modify(self, kind, name, function):
+        """
+        Changes an existing entry with a function, nothing is changed if the entry doesn't exist at commit time
+
+        Parameters
+        ----------
+        kind : str
+            Account file, one of 'passwd', 'shadow', 'group' and 'gshadow'
+        name : str
+            User or group name
+        function : Callable
+            Takes the current entry and returns the new one
+
+        Returns
+        -------
+        None
+        """
+        self.__add(kind, name, lambda current: function(current) if current is not None else None)
+
+    def remove(self, kind, name):
+        """
+        Removes an entry
+
+        Parameters
+        ----------
+        kind : str
+            Account file, one of 'passwd', 'shadow', 'group' and 'gshadow'
+        name : str
+            User or group name
+
+        Returns
+        -------
+        None
+        """
+        self.__add(kind, name, lambda current: None)
+
+    def isEmpty(self):
+        """
+        Check if there are changes to be written
+
+        Returns
+        -------
+        bool
+            True if nothing has been changed
+        """
+        return not self.__operations
+
+    def commit(self):
+        """
+        Writes all changes, each file once
+        A missing gshadow file is not created and files whose entries are all unchanged are not rewritten.
+        The transaction is empty afterwards, also if writing failed.
+
+        Returns
+        -------
+        list[str]
+            Paths of the written files
+
+        Raises
+        ------
+        AccountLockError
+            The account files could not be locked in time
+        OSError
+            A file could not be read or written
+        """
+        operations, self.__operations = self.__operations, {}
+        kinds = [k for k in (PASSWD, SHADOW, GROUP, GSHADOW) if k in operations]
+        if kinds and kinds[-1] == GSHADOW and not os.path.exists(self.__files[GSHADOW]):
+            kinds.pop()
+        if not kinds:
+            return []
+        paths = [self.__files[k] for k in kinds]
+        if self.__DEBUG:
+            for path in paths:
+                print("Rewriting " + path)
+            return []
+        with self.__lock(paths):
+            paths = [self.__files[k] for k in kinds if self.__apply(self.__files[k], ENTRY_TYPES[k], operations[k])]
+            #Make the renames durable, the account files usually share a directory
+            for directory in set(os.path.dirname(os.path.abspath(p)) for p in paths):
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        if paths:
+            logging.info("Wrote " + ", ".join(paths))
+        return paths
+
+    def __add(self, kind, name, function):
+        """
+        Queues a change of an entry
+
+        Parameters
+        ----------
+        kind : str
+            Account file
+        name : str
+            User or group name
+        function : Callable
+            Takes the current entry (None if missing) and returns the new one (None to remove it)
+
+        Returns
+        -------
+        None
+        """
+        if kind not in ENTRY_TYPES:
+            raise ValueError("Unknown account file " + kind)
+        self.__operations.setdefault(kind, {}).setdefault(name, []).append(function)
+
+    def __apply(self, path, entryType, operations):
+        """
+        Applies changes to a file and replaces it atomically, keeping its permissions and owner
+        The file is left alone if no entry changed
+
+        Parameters
+        ----------
+        path : str
+            Path of the file
+        entryType : type
+            Record type of the entries
+        operations : dict{str:list[Callable]}
+            Changes by entry name
+
+        Returns
+        -------
+        bool
+            True if the file was rewritten
+        """
+        pending = dict(operations)
+        changed = False
+        with open(path, "r") as accountFile:
+            st = os.fstat(accountFile.fileno())
+            data = []
+            for line in accountFile:
+                name = line.split(":", 1)[0]
+                if name not in pending or not line.strip():
+                    data.append(line)
+                    continue
+                current = entry = entryType.fromLine(line)
+                for function in pending.pop(name):
+                    entry = function(entry)
+                if entry == current:
+                    data.append(line)
+                    continue
+                changed = True
+                if entry is not None:
+                    data.append(entry.toLine())
+        if data and not data[-1].endswith("\n"):
+            data[-1] += "\n"
+        #Entries not in the file yet are appended
+        for name, functions in pending.items():
+            entry = None
+            for function in functions:
+                entry = function(entry)
+            if entry is not None:
+                changed = True
+                data.append(entry.toLine())
+        if not changed:
+            return False
+        tmpFile = path + "+"
+        fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o7777)
+        try:
+            with os.fdopen(fd, "w") as newFile:
+                os.fchmod(newFile.fileno(), st.st_mode & 0o7777)
+                if os.geteuid() == 0:
+                    os.fchown(newFile.fileno(), st.st_uid, st.st_gid)
+                newFile.writelines(data)
+                newFile.flush()
+                os.fsync(newFile.fileno())
+            os.replace(tmpFile, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmpFile)
+            raise
+        return True
+
+    @contextlib.contextmanager
+    def __lock(self, paths):
+        """
+        Holds the locks of the account files
+        Takes the lckpwdf lock (fcntl lock on .pwd.lock) and the '<file>.lock' lock files of shadow-utils
+
+        Parameters
+        ----------
+        paths : list[str]
+            Paths of the files to be written
+
+        Yields
+        ------
+        None
+
+        Raises
+        ------
+        AccountLockError
+            A lock could not be taken in time
+        """
+        deadline = time.monotonic() + self.__lockTimeout
+        lockPath = os.path.join(os.path.dirname(os.path.abspath(paths[0])), ".pwd.lock")
+        fd = os.open(lockPath, os.O_WRONLY | os.O_CREAT, 0o600)
+        locked = []
+        try:
+            while True:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    if time.monotonic() > deadline:
+                        raise AccountLockError(lockPath)
+                    time.sleep(LOCK_RETRY_INTERVAL)
+            for path in paths:
+                self.__lockFile(path, deadline)
+                locked.append(path)
+            yield
+        finally:
+            for path in reversed(locked):
+                with contextlib.suppress(OSError):
+                    os.unlink(path + ".lock")
+            os.close(fd)
+
+    def __lockFile(self, path, deadline):
+        """
+        Creates the lock file of an account file the way shadow-utils does
+        The PID is written to '<file>.<pid>', which is then hard linked to '<file>.lock'.
+        Lock files of processes that don't exist anymore are removed.
+
+        Parameters
+        ----------
+        path : str
+            Path of the account file
+        deadline : float
+            Time (monotonic) until which to retry
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        AccountLockError
+            The lock file is held by another process after the deadline
+        """
+        pidFile = path + "." + str(os.getpid())
+        lockFile = path + ".lock"
+        with open(pidFile, "w") as f:
+            f.write(str(os.getpid()))
+        try:
+            while True:
+                try:
+                    os.link(pidFile, lockFile)
+                    return
+                except FileExistsError:
+                    pass
+                try:
+                    with open(lockFile, "r") as f:
+                        pid = int(f.read().strip() or 0)
+                except (OSError, ValueError):
+                    pid = 0
+                if pid > 0 and pid != os.getpid():
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        pid = 0
+                    except PermissionError:
+                        pass
+                if pid <= 0:
+                    logging.info("Removing stale lock file " + lockFile)
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(lockFile)
+                    continue
+                if time.monotonic() > deadline:
+                    raise AccountLockError(lockFile)
+                time.sleep(LOCK_RETRY_INTERVAL)
+        finally:
+            os.unlink(pidFile)
+
+
+class AccountLockError(Exception):
+    """
+    Exception for when the account files cannot be locked, e.g. because useradd or passwd is running
+    """
+    def __init__(self, lockFile):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        lockFile : str
+            Path of the lock that couldn't be taken
+        """
+        super().__init__("Could not lock " + lockFile)
@@ -0,0 +1,283 @@
+"""
+Sync State
+
+Remembers between sync cycles which Linux user belongs to which Azure AD object, together with a fingerprint of the
+synced attributes, so a cycle only has to touch principals that changed in Azure AD.
+
+Classes:
+    SyncRecord - State of a synchronized user
+    SyncStateStore - On-disk store of the synchronized users, kept in SQLite
+
+Functions:
+    fingerprint(user, fields=SYNCED_FIELDS) - Hash of the synced attributes of an Azure AD user
+"""
+
+import os
+import sqlite3
+import hashlib
+import logging
+import simplejson as json
+
+from UserAdministration import Record, internName
+
+STATE_FILE = "/var/adsyncd/state.db"
+SYNCED_FIELDS = ("userPrincipalName", "displayName")
+
+
+def fingerprint(user, fields=SYNCED_FIELDS):
+    """
+    Hash of the synced attributes of an Azure AD user
+    Only attributes that are applied to the Linux user may be hashed, a change of any other attribute would be
+    recorded without ever being applied.
+
+    Parameters
+    ----------
+    user : AzureAD.DirectoryUser
+        Azure AD user
+    fields : tuple(str)
+        Names of the synced attributes, defaults to principal and display name
+
+    Returns
+    -------
+    str
+        Hex digest, changes whenever one of the attributes changes
+    """
+    data = json.dumps([getattr(user, f) for f in fields])
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SyncRecord(Record):
+    """
+    State of a synchronized user
+
+    Attributes
+    ----------
+    objectId : str
+        Object ID of the Azure AD user
+    username : str
+        Name of the Linux user (interned)
+    uid : int
+        UID of the Linux user, -1 if unknown
+    home : str
+        Home directory of the Linux user
+    fingerprint : str
+        Fingerprint of the Azure AD attributes the Linux user was last synced with
+    """
+    __slots__ = ("objectId", "username", "uid", "home", "fingerprint")
+
+
+class SyncStateStore:
+    """
+    On-disk store of the synchronized users, kept in SQLite
+    All records are loaded when the store is opened, lookups don't touch the database. Changes are collected and
+    written in a single SQLite transaction by commit(), once per sync cycle.
+
+    Attributes
+    ----------
+    __path : str
+        Path of the database file
+    __connection : sqlite3.Connection
+        Open database
+    __records : dict{str:SyncRecord}
+        Records by object ID
+    __byUsername : dict{str:SyncRecord}
+        Records by username
+    __changes : dict{str:SyncRecord}
+        Records not written yet by object ID, None for removed records
+    __fields : tuple(str)
+        Names of the attributes the fingerprints are taken of
+
+    Methods
+    -------
+    fingerprint(user)
+        Returns the fingerprint of an Azure AD user
+    get(objectId)
+        Returns the record of an Azure AD user
+    getByUsername(username)
+        Returns the record of a Linux user
+    getUsernames()
+        Returns the names of all recorded Linux users
+    put(record)
+        Adds or replaces a record
+    remove(objectId)
+        Removes a record
+    commit()
+        Writes all changed records at once
+    close()
+        Closes the database
+    """
+    __path = STATE_FILE
+    __connection = None
+    __records = {}
+    __byUsername = {}
+    __changes = {}
+    __fields = SYNCED_FIELDS
+
+    def __init__(self, path=STATE_FILE, fields=SYNCED_FIELDS):
+        """
+        Constructor
+        Creates the database if it doesn't exist, it is only readable by root
+
+        Parameters
+        ----------
+        path : str
+            Path of the database file, defaults to '/var/adsyncd/state.db'
+        fields : tuple(str)
+            Names of the attributes the fingerprints are taken of, defaults to principal and display name.
+            Users recorded with other attributes are updated once on the next sync.
+
+        Raises
+        ------
+        sqlite3.Error
+            The database could not be opened
+        """
+        self.__path = path
+        self.__fields = tuple(fields)
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.__connection = sqlite3.connect(path)
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS users (objectId TEXT PRIMARY KEY, username TEXT NOT NULL, "
+                                      "uid INTEGER NOT NULL, home TEXT NOT NULL, fingerprint TEXT NOT NULL)")
+        self.__records = {}
+        self.__byUsername = {}
+        self.__changes = {}
+        for row in self.__connection.execute("SELECT objectId, username, uid, home, fingerprint FROM users"):
+            record = SyncRecord(row[0], internName(row[1]), row[2], row[3], row[4])
+            self.__records[record.objectId] = record
+            self.__byUsername[record.username] = record
+        logging.info("Loaded state of " + str(len(self.__records)) + " users from " + path)
+
+    def fingerprint(self, user):
+        """
+        Returns the fingerprint of an Azure AD user, taken of the attributes of this store
+
+        Parameters
+        ----------
+        user : AzureAD.DirectoryUser
+            Azure AD user
+
+        Returns
+        -------
+        str
+            Hex digest
+        """
+        return fingerprint(user, self.__fields)
+
+    def get(self, objectId):
+        """
+        Returns the record of an Azure AD user
+
+        Parameters
+        ----------
+        objectId : str
+            Object ID
+
+        Returns
+        -------
+        SyncRecord
+            Record, None if the user isn't recorded
+        """
+        return self.__records.get(objectId)
+
+    def getByUsername(self, username):
+        """
+        Returns the record of a Linux user
+
+        Parameters
+        ----------
+        username : str
+            Username
+
+        Returns
+        -------
+        SyncRecord
+            Record, None if the user isn't recorded
+        """
+        return self.__byUsername.get(username)
+
+    def getUsernames(self):
+        """
+        Returns the names of all recorded Linux users
+
+        Returns
+        -------
+        list[str]
+            Usernames
+        """
+        return list(self.__byUsername)
+
+    def put(self, record):
+        """
+        Adds or replaces a record, written on commit()
+
+        Parameters
+        ----------
+        record : SyncRecord
+            Record
+
+        Returns
+        -------
+        None
+        """
+        previous = self.__records.get(record.objectId)
+        if previous == record:
+            return
+        if previous is not None and self.__byUsername.get(previous.username) is previous:
+            del self.__byUsername[previous.username]
+        self.__records[record.objectId] = record
+        self.__byUsername[record.username] = record
+        self.__changes[record.objectId] = record
+
+    def remove(self, objectId):
+        """
+        Removes a record, written on commit()
+
+        Parameters
+        ----------
+        objectId : str
+            Object ID
+
+        Returns
+        -------
+        None
+        """
+        record = self.__records.pop(objectId, None)
+        if record is None:
+            return
+        if self.__byUsername.get(record.username) is record:
+            del self.__byUsername[record.username]
+        self.__changes[objectId] = None
+
+    def commit(self):
+        """
+        Writes all changed records in a single transaction
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        sqlite3.Error
+            The changes could not be written, they are kept for the next commit
+        """
+        if not self.__changes:
+            return
+        with self.__connection:
+            self.__connection.executemany("DELETE FROM users WHERE objectId = ?",
+                                          [(i,) for i, r in self.__changes.items() if r is None])
+            self.__connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)",
+                                          [r.toTuple() for r in self.__changes.values() if r is not None])
+        logging.info("Saved state of " + str(len(self.__changes)) + " users to " + self.__path)
+        self.__changes = {}
+
+    def close(self):
+        """
+        Closes the database, changes not committed are lost
+
+        Returns
+        -------
+        None
+        """
+        self.__connection.close()
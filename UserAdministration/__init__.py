@@ -5,7 +5,116 @@ Interface to add other sources of usernames in the future
 
 Classes:
     UserAdministration
+    Record - Compact immutable record, base for user and group entries
+
+Functions:
+    internName(name) - Interns a user or group name
 """
+import sys
+
+
+class Record:
+    """
+    Compact immutable record, base for user and group entries
+    Subclasses list their fields in __slots__, so records carry no per-object __dict__.
+    Fields can be accessed by name, records compare and hash by their field values.
+
+    Methods
+    -------
+    replace(**changes)
+        Returns a copy with some fields replaced
+    toTuple()
+        Returns the field values as tuple
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor
+        Fields are set from positional arguments in the order of __slots__, then from keyword arguments
+
+        Raises
+        ------
+        TypeError
+            Too many arguments, unknown or missing fields
+        """
+        if len(args) > len(self.__slots__):
+            raise TypeError(type(self).__name__ + " takes at most " + str(len(self.__slots__)) + " fields")
+        values = dict(zip(self.__slots__, args))
+        for name, value in kwargs.items():
+            if name not in self.__slots__ or name in values:
+                raise TypeError("Unknown or duplicate field " + name)
+            values[name] = value
+        if len(values) != len(self.__slots__):
+            raise TypeError("Missing fields for " + type(self).__name__)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(type(self).__name__ + " is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(type(self).__name__ + " is immutable")
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.toTuple() == other.toTuple()
+
+    def __hash__(self):
+        return hash(self.toTuple())
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(name + "=" + repr(getattr(self, name)) for name in self.__slots__) + ")"
+
+    def __reduce__(self):
+        return (type(self), self.toTuple())
+
+    def replace(self, **changes):
+        """
+        Returns a copy with some fields replaced
+
+        Parameters
+        ----------
+        **changes
+            New field values by field name
+
+        Returns
+        -------
+        Record
+            New record of the same type
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return type(self)(**values)
+
+    def toTuple(self):
+        """
+        Returns the field values as tuple
+
+        Returns
+        -------
+        tuple
+            Field values in the order of __slots__
+        """
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+def internName(name):
+    """
+    Interns a user or group name, so all records referring to the same name share one string
+
+    Parameters
+    ----------
+    name : str
+        Name, may be None
+
+    Returns
+    -------
+    str
+        Interned name
+    """
+    return sys.intern(name) if name is not None else None
+
+
 class UserAdministration:
     """
     Interface to add other sources of usernames in the future
@@ -57,6 +57,8 @@ logging.info("Pre-daemonization setup successful")
 # Adding termination handler
 def terminate(signum, frame):
     logging.info("Terminating daemon with SIGTERM")
+    if "handler" in globals():
+        handler.close()
     sys.exit(0)
 
 
@@ -0,0 +1,11 @@
+"""
+Tests of adsyncd
+
+The tests work on temporary copies of the account files, never on the files of the system.
+The bundled libraries are looked up in lib/, like the daemon does in /var/adsyncd/lib.
+"""
+import os
+import sys
+
+# Appending Python path to ./lib folder
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
@@ -0,0 +1,92 @@
+"""
+Fake Graph API for the tests of the Azure AD connection
+
+Replaces the requests session of AzureAD.DomainUserAdministration, token requests are answered with a fixed token and
+all other requests are passed to a handler of the test.
+"""
+import os
+import tempfile
+import itertools
+import threading
+from unittest import mock
+
+import simplejson as json
+
+from AzureAD import DomainUserAdministration
+from AzureAD.retry import RetryPolicy
+
+#Every issued token is distinct, also across sessions
+TOKEN_NUMBERS = itertools.count(1)
+
+
+class FakeResponse:
+    """
+    Response of the fake Graph API with the parts of requests.Response that are used
+    """
+
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunkSize):
+        for i in range(0, len(self.content), chunkSize):
+            yield self.content[i:i + chunkSize]
+
+    def close(self):
+        pass
+
+
+class FakeGraphSession:
+    """
+    Session answering token requests itself and passing all other requests to handler(method, url, kwargs)
+    The request headers are passed in kwargs["headers"], issued tokens are recorded in .tokens
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.headers = {}
+        self.requests = []
+        self.tokens = []
+        self.lock = threading.Lock()
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        if url.startswith("https://login.microsoftonline.com/"):
+            with self.lock:
+                self.tokens.append("token" + str(next(TOKEN_NUMBERS)))
+                return FakeResponse(200, {"access_token": self.tokens[-1], "expires_in": 3600})
+        with self.lock:
+            self.requests.append((method, url))
+        response = self.handler(method, url, dict(kwargs, headers=headers or {}))
+        return response if isinstance(response, FakeResponse) else FakeResponse(200, response)
+
+    def close(self):
+        pass
+
+
+def createAdmin(test, handler, **kwargs):
+    """
+    Creates a connection to the fake Graph API, its state files are kept in a temporary directory of the test
+
+    Returns
+    -------
+    tuple(AzureAD.DomainUserAdministration, FakeGraphSession, str)
+        Connection, fake session and the temporary directory
+    """
+    temporaryDirectory = tempfile.TemporaryDirectory()
+    test.addCleanup(temporaryDirectory.cleanup)
+    directory = temporaryDirectory.name
+    session = FakeGraphSession(handler)
+    kwargs.setdefault("delta_state_file", os.path.join(directory, "deltaLink.json"))
+    kwargs.setdefault("retry_policy", RetryPolicy(baseDelay=0))
+    with mock.patch("AzureAD.requests.Session", return_value=session):
+        admin = DomainUserAdministration("client", "secret", **kwargs)
+    test.addCleanup(admin.close)
+    return admin, session, directory
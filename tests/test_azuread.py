@@ -0,0 +1,309 @@
+"""
+Tests of the connection to Azure AD (AzureAD.DomainUserAdministration)
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+
+import simplejson as json
+
+from AzureAD import DirectoryUser
+from AzureAD.retry import RetryPolicy, CircuitBreaker, GraphRequestError, CircuitOpenError
+from tests.graph import FakeResponse, createAdmin
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+
+def user(number, **extra):
+    u = {"id": "id-" + str(number), "displayName": "User " + str(number), "userPrincipalName": "user" + str(number) + "@example.com",
+         "accountEnabled": True}
+    u.update(extra)
+    return u
+
+
+class UserPagingTest(unittest.TestCase):
+    """
+    Users enumerated page by page following @odata.nextLink
+    """
+
+    def setUp(self):
+        self.pages = {
+            "/users": {"value": [user(1, mail="user1@example.com", manager={"id": "id-2"}), user(2)],
+                       "@odata.nextLink": GRAPH_URL + "/users?$skiptoken=2"},
+            "/users?$skiptoken=2": {"value": [user(3, userPrincipalName="ignored@example.com"), user(4)],
+                                    "@odata.nextLink": GRAPH_URL + "/users?$skiptoken=4"},
+            "/users?$skiptoken=4": {"value": [user(5)]},
+        }
+
+    def handle(self, method, url, kwargs):
+        path = url[len(GRAPH_URL):]
+        return self.pages.get(path) or self.pages[path.split("?")[0]]
+
+    def test_pagesAreFollowedWhileIterating(self):
+        admin, session, directory = createAdmin(self, self.handle, page_size=2, ignore_list=["ignored@example.com"])
+        users = admin.iterUsers()
+        self.assertEqual(next(users), DirectoryUser("id-1", "User 1", "user1@example.com", True))
+        #Only the first page has been requested so far
+        self.assertEqual(len(session.requests), 1)
+        query = parse_qs(urlsplit(session.requests[0][1]).query)
+        self.assertEqual((query["$top"], query["$select"]), (["2"], ["id,displayName,userPrincipalName,accountEnabled"]))
+        self.assertEqual([u.id for u in users], ["id-2", "id-4", "id-5"])
+        self.assertEqual(len(session.requests), 3)
+
+    def test_filterIsAnAdvancedQuery(self):
+        admin, session, directory = createAdmin(self, self.handle, user_filter="accountEnabled eq true")
+        self.assertEqual(len(list(admin.iterUsers())), 5)
+        query = parse_qs(urlsplit(session.requests[0][1]).query)
+        self.assertEqual((query["$filter"], query["$count"]), (["accountEnabled eq true"], ["true"]))
+
+    def test_truncatedPageFails(self):
+        self.pages["/users?$skiptoken=2"] = FakeResponse(200, b'{"value": [{"id": "id-3", "userPrin')
+        admin, session, directory = createAdmin(self, self.handle)
+        users = admin.iterUsers()
+        self.assertEqual([next(users).id, next(users).id], ["id-1", "id-2"])
+        with self.assertRaises(GraphRequestError):
+            next(users)
+
+
+class DeltaSyncTest(unittest.TestCase):
+    """
+    Delta rounds, the persisted deltaLink and the fallback to a full enumeration
+    """
+
+    def setUp(self):
+        self.pages = {
+            "/users/delta": {"value": [user(1), user(2)], "@odata.nextLink": GRAPH_URL + "/users/delta?$skiptoken=2"},
+            "/users/delta?$skiptoken=2": {"value": [user(3)], "@odata.deltaLink": GRAPH_URL + "/users/delta?$deltatoken=1"},
+            "/users/delta?$deltatoken=1": {"value": [{"id": "id-1", "userPrincipalName": "renamed1@example.com"},
+                                                     {"id": "id-2", "@removed": {"reason": "changed"}},
+                                                     {"id": "id-3", "displayName": "Changed 3"}],
+                                           "@odata.deltaLink": GRAPH_URL + "/users/delta?$deltatoken=2"},
+        }
+
+    def handle(self, method, url, kwargs):
+        path = url[len(GRAPH_URL):]
+        return self.pages.get(path) or self.pages[path.split("?")[0]]
+
+    def assertState(self, directory, deltaLink):
+        path = os.path.join(directory, "deltaLink.json")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path, "r") as f:
+            self.assertEqual(json.load(f)["deltaLink"], deltaLink)
+
+    def test_deltaLinkIsPersistedOnCommit(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        changed, removed, full = admin.syncDelta()
+        self.assertEqual(([u.id for u in changed], removed, full), (["id-1", "id-2", "id-3"], [], True))
+        self.assertTrue(session.requests[0][1].startswith(GRAPH_URL + "/users/delta?$select="))
+        #Not applied yet, the next round starts over
+        self.assertFalse(os.path.exists(os.path.join(directory, "deltaLink.json")))
+        admin.commitDelta()
+        self.assertState(directory, GRAPH_URL + "/users/delta?$deltatoken=1")
+
+        #A restarted daemon continues with the persisted deltaLink and known users
+        restarted, session, directory = createAdmin(self, self.handle, delta_state_file=os.path.join(directory, "deltaLink.json"))
+        changed, removed, full = restarted.syncDelta()
+        self.assertEqual(session.requests, [("GET", GRAPH_URL + "/users/delta?$deltatoken=1")])
+        self.assertFalse(full)
+        self.assertEqual(changed, [DirectoryUser("id-1", "User 1", "renamed1@example.com", True),
+                                   DirectoryUser("id-3", "Changed 3", "user3@example.com", True)])
+        #Renamed users are also reported as removed under their previous principal
+        self.assertEqual(sorted(u.userPrincipalName for u in removed), ["user1@example.com", "user2@example.com"])
+
+    def test_uncommittedRoundIsFetchedAgain(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        admin.syncDelta()
+        admin.commitDelta()
+        admin.syncDelta()
+        changed, removed, full = admin.syncDelta()
+        self.assertEqual([url for method, url in session.requests[-2:]], [GRAPH_URL + "/users/delta?$deltatoken=1"] * 2)
+        self.assertEqual(len(changed), 2)
+        self.assertState(directory, GRAPH_URL + "/users/delta?$deltatoken=1")
+
+    def test_expiredDeltaLinkFallsBackToFullEnumeration(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        admin.syncDelta()
+        admin.commitDelta()
+        self.pages["/users/delta?$deltatoken=1"] = FakeResponse(410, {"error": {"code": "syncStateNotFound"}})
+        changed, removed, full = admin.syncDelta()
+        self.assertTrue(full)
+        self.assertEqual(([u.id for u in changed], removed), (["id-1", "id-2", "id-3"], []))
+
+    def test_pageWithoutLinksFails(self):
+        self.pages["/users/delta?$skiptoken=2"] = {"value": [user(3)]}
+        admin, session, directory = createAdmin(self, self.handle)
+        with self.assertRaises(GraphRequestError):
+            admin.syncDelta()
+        admin.commitDelta()
+        self.assertFalse(os.path.exists(os.path.join(directory, "deltaLink.json")))
+
+
+class TokenCacheTest(unittest.TestCase):
+    """
+    API token reused across requests and restarts, refreshed when rejected
+    """
+
+    def setUp(self):
+        self.authorizations = []
+        #Rejected tokens, reject is 'first' to reject the first token used, 'all' to reject every token
+        self.rejected = set()
+        self.reject = None
+
+    def handle(self, method, url, kwargs):
+        authorization = kwargs["headers"]["Authorization"]
+        if self.reject == "all" or (self.reject == "first" and not self.authorizations):
+            self.rejected.add(authorization)
+        self.authorizations.append(authorization)
+        if authorization in self.rejected:
+            return FakeResponse(401, {"error": {"code": "InvalidAuthenticationToken"}})
+        return {"value": [user(1)]}
+
+    def test_persistedTokenIsReusedAfterRestart(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cacheFile = os.path.join(directory.name, "token.json")
+        admin, session, directory = createAdmin(self, self.handle, token_cache_file=cacheFile)
+        list(admin.iterUsers())
+        list(admin.iterUsers())
+        admin.close()
+        self.assertEqual(os.stat(cacheFile).st_mode & 0o777, 0o600)
+        with open(cacheFile, "r") as f:
+            token = json.load(f)["token"]
+        self.assertIn(token, session.tokens)
+        restarted, session, directory = createAdmin(self, self.handle, token_cache_file=cacheFile)
+        list(restarted.iterUsers())
+        self.assertEqual(session.tokens, [])
+        self.assertEqual(self.authorizations[-1], "Bearer " + token)
+        self.assertEqual(len(set(self.authorizations)), 1)
+
+    def test_rejectedTokenIsRefreshedOnce(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        self.reject = "first"
+        self.assertEqual(len(list(admin.iterUsers())), 1)
+        self.assertEqual(len(self.authorizations), 2)
+        self.assertNotIn(self.authorizations[1], self.rejected)
+        #A new token that is rejected as well isn't refreshed again
+        self.reject = "all"
+        self.authorizations = []
+        with self.assertRaises(GraphRequestError) as raised:
+            list(admin.iterUsers())
+        self.assertEqual(raised.exception.statusCode, 401)
+        self.assertEqual(len(self.authorizations), 2)
+
+
+class RetryTest(unittest.TestCase):
+    """
+    Retries with backoff and Retry-After, and the circuit breaker pausing requests
+    """
+
+    def setUp(self):
+        #Responses returned before the users page, in order
+        self.failures = []
+        sleep = mock.patch("AzureAD.time.sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def handle(self, method, url, kwargs):
+        if self.failures:
+            return self.failures.pop(0)
+        return {"value": [user(1)]}
+
+    def test_throttledRequestWaitsForRetryAfter(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        self.failures = [FakeResponse(429, {}, {"Retry-After": "7"}), FakeResponse(503, b"unavailable")]
+        self.assertEqual(len(list(admin.iterUsers())), 1)
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(self.sleep.call_args_list[0], mock.call(7.0))
+        self.assertTrue(admin.isAvailable())
+
+    def test_clientErrorIsNotRetried(self):
+        admin, session, directory = createAdmin(self, self.handle, circuit_breaker=CircuitBreaker(failureThreshold=1))
+        self.failures = [FakeResponse(400, {"error": {"code": "BadRequest"}})]
+        with self.assertRaises(GraphRequestError) as raised:
+            list(admin.iterUsers())
+        self.assertEqual((raised.exception.statusCode, raised.exception.errorCode), (400, "BadRequest"))
+        self.assertEqual(len(session.requests), 1)
+        #The service answered, so it's still available
+        self.assertTrue(admin.isAvailable())
+
+    def test_circuitOpensAfterRepeatedFailures(self):
+        admin, session, directory = createAdmin(self, self.handle, retry_policy=RetryPolicy(maxAttempts=3, baseDelay=0),
+                                                circuit_breaker=CircuitBreaker(failureThreshold=2))
+        self.failures = [FakeResponse(500, b"error")] * 6
+        for _ in range(2):
+            with self.assertRaises(GraphRequestError):
+                list(admin.iterUsers())
+        self.assertEqual(len(session.requests), 6)
+        self.assertFalse(admin.isAvailable())
+        #Requests are skipped without contacting Azure AD
+        with self.assertRaises(CircuitOpenError):
+            list(admin.iterUsers())
+        self.assertEqual(len(session.requests), 6)
+
+    def test_successfulTrialRequestClosesTheCircuit(self):
+        admin, session, directory = createAdmin(self, self.handle, retry_policy=RetryPolicy(maxAttempts=1),
+                                                circuit_breaker=CircuitBreaker(failureThreshold=1, resetTimeout=0))
+        self.failures = [FakeResponse(502, b"bad gateway")]
+        with self.assertRaises(GraphRequestError):
+            list(admin.iterUsers())
+        self.assertEqual(len(list(admin.iterUsers())), 1)
+        self.assertTrue(admin.isAvailable())
+
+
+class AllowedGroupsTest(unittest.TestCase):
+    """
+    Users enumerated from the transitive members of allowed groups
+    """
+
+    def setUp(self):
+        self.pages = {
+            "/groups/g1/transitiveMembers/microsoft.graph.user": {"value": [user(1), user(2)],
+                                                                  "@odata.nextLink": GRAPH_URL + "/groups/g1/page2"},
+            "/groups/g1/page2": {"value": [user(3), user(1)]},
+            "/groups/g2/transitiveMembers/microsoft.graph.user": {"value": [user(2), user(4)]},
+        }
+
+    def handle(self, method, url, kwargs):
+        return self.pages[url[len(GRAPH_URL):].split("?")[0]]
+
+    def test_membersOfSeveralGroupsAreYieldedOnce(self):
+        admin, session, directory = createAdmin(self, self.handle, allowed_groups=["g1", "g2"])
+        self.assertEqual([u.id for u in admin.iterUsers()], ["id-1", "id-2", "id-3", "id-4"])
+        self.assertEqual([urlsplit(url).path for method, url in session.requests],
+                         ["/v1.0/groups/g1/transitiveMembers/microsoft.graph.user", "/v1.0/groups/g1/page2",
+                          "/v1.0/groups/g2/transitiveMembers/microsoft.graph.user"])
+
+
+class GroupMembersTest(unittest.TestCase):
+    """
+    Transitive members of mapped groups requested in $batch requests without a group closure
+    """
+
+    def handle(self, method, url, kwargs):
+        if url.endswith("/$batch"):
+            responses = []
+            for r in kwargs["json"]["requests"]:
+                groupId = r["url"].split("/")[2]
+                if groupId == "missing":
+                    responses.append({"id": r["id"], "status": 404, "body": {"error": {"code": "Request_ResourceNotFound"}}})
+                    continue
+                body = {"value": [{"id": "id-1", "userPrincipalName": "user1@example.com"}]}
+                if groupId == "g1":
+                    body["@odata.nextLink"] = GRAPH_URL + "/groups/g1/page2"
+                responses.append({"id": r["id"], "status": 200, "body": body})
+            return {"responses": responses}
+        #Second page of g1, user1 is listed again
+        return {"value": [{"id": "id-1", "userPrincipalName": "user1@example.com"}, {"id": "id-2", "userPrincipalName": "user2@example.com"},
+                          {"id": "id-3", "userPrincipalName": None}]}
+
+    def test_pagesAreFollowedAndMembersDeduplicated(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        self.assertEqual(admin.getGroupMembers(["g1", "g2", "missing"]),
+                         {"g1": {"user1@example.com", "user2@example.com"}, "g2": {"user1@example.com"}})
+        self.assertEqual([url[len(GRAPH_URL):] for method, url in session.requests], ["/$batch", "/groups/g1/page2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
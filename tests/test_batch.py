@@ -0,0 +1,57 @@
+"""
+Tests of the Graph API JSON batching (AzureAD.batch)
+"""
+import unittest
+
+from AzureAD.retry import CircuitBreaker, GraphRequestError
+from tests.graph import FakeResponse, createAdmin
+
+
+class GraphBatchClientTest(unittest.TestCase):
+    """
+    Splitting into $batch requests, retries of failed sub-requests and malformed batch responses
+    """
+
+    def setUp(self):
+        self.batches = []
+        self.throttled = {"7", "33"}
+
+    def handle(self, method, url, kwargs):
+        if url.endswith("/$batch"):
+            chunk = kwargs["json"]["requests"]
+            self.batches.append([r["id"] for r in chunk])
+            responses = []
+            for r in chunk:
+                if r["id"] in self.throttled:
+                    responses.append({"id": r["id"], "status": 429, "headers": {"Retry-After": "0"}, "body": {}})
+                elif r["id"] != "12":
+                    responses.append({"id": r["id"], "status": 200, "body": {"url": r["url"]}})
+            return {"responses": responses}
+        return {"url": url.split("/v1.0", 1)[1], "single": True}
+
+    def test_requestsAreSplitAndFailedOnesRetriedIndividually(self):
+        admin, session, directory = createAdmin(self, self.handle)
+        requests = [{"id": str(i), "method": "GET", "url": "/users/" + str(i)} for i in range(45)]
+        responses = admin.batch(requests)
+        self.assertEqual(sorted(len(b) for b in self.batches), [5, 20, 20])
+        self.assertEqual(sorted(responses), sorted(str(i) for i in range(45)))
+        self.assertEqual(responses["0"]["body"], {"url": "/users/0"})
+        #Throttled and missing sub-requests are sent on their own
+        for requestId in ("7", "12", "33"):
+            self.assertEqual(responses[requestId]["status"], 200)
+            self.assertEqual(responses[requestId]["body"], {"url": "/users/" + requestId, "single": True})
+        self.assertEqual(sorted(url for method, url in session.requests if not url.endswith("/$batch")),
+                         sorted("https://graph.microsoft.com/v1.0/users/" + i for i in ("12", "33", "7")))
+
+    def test_malformedBatchResponseFails(self):
+        for body in (b'{"responses": [{"id": "0", "sta', b'{"error": "no responses"}', b'[]'):
+            admin, session, directory = createAdmin(self, lambda method, url, kwargs: FakeResponse(200, body),
+                                                    circuit_breaker=CircuitBreaker(failureThreshold=1))
+            with self.assertRaises(GraphRequestError):
+                admin.batch([{"id": "0", "method": "GET", "url": "/users/0"}])
+            #Counted as failure, the next sync is skipped
+            self.assertFalse(admin.isAvailable())
+
+
+if __name__ == "__main__":
+    unittest.main()
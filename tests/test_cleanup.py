@@ -0,0 +1,109 @@
+"""
+Tests of the background home directory cleanup (HomeDirectories.cleanup) and its I/O throttle
+"""
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+import simplejson as json
+
+from HomeDirectories import HomeCleanupQueue, TokenBucket
+
+
+class HomeCleanupQueueTest(unittest.TestCase):
+    """
+    Moving homes to the trash, deleting them in the background, stopping and resuming
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.trash = os.path.join(self.dir, "trash")
+
+    def createHome(self, name, files, uid=1000):
+        home = os.path.join(self.dir, name)
+        os.makedirs(os.path.join(home, "sub"))
+        for i in range(files):
+            with open(os.path.join(home, "sub" if i % 2 else "", "file" + str(i)), "w") as f:
+                f.write("x" * 100)
+        os.chown(home, uid, uid)
+        return home
+
+    def createQueue(self, **kwargs):
+        cleanup = HomeCleanupQueue(self.trash, **kwargs)
+        self.addCleanup(cleanup.stop)
+        return cleanup
+
+    def pending(self):
+        with open(os.path.join(self.trash, ".queue.json"), "r") as f:
+            return json.load(f)
+
+    def test_homeIsMovedAndDeletedInTheBackground(self):
+        cleanup = self.createQueue()
+        home = self.createHome("alice", 10)
+        cleanup.enqueue(home, 1000)
+        self.assertFalse(os.path.exists(home))
+        cleanup.join()
+        self.assertEqual(os.listdir(self.trash), [".queue.json"])
+        self.assertEqual(self.pending(), [])
+
+    def test_homesNotOwnedByTheUserAreKept(self):
+        cleanup = self.createQueue()
+        home = self.createHome("bob", 1, uid=1001)
+        cleanup.enqueue(home, 1000)
+        cleanup.enqueue("/home", 0)
+        cleanup.enqueue("relative", 1000)
+        self.assertTrue(os.path.isdir(home))
+        self.assertFalse(os.path.exists(self.trash))
+
+    def test_stopInterruptsThrottledDeletionAndIsResumed(self):
+        cleanup = self.createQueue(iops=5)
+        home = self.createHome("carol", 100)
+        cleanup.enqueue(home, 1000)
+        start = time.monotonic()
+        cleanup.stop()
+        self.assertLess(time.monotonic() - start, 5)
+        [target] = self.pending()
+        self.assertTrue(os.path.isdir(target))
+        #Homes removed after stopping are only queued
+        cleanup.enqueue(self.createHome("dave", 1), 1000)
+        self.assertEqual(len(self.pending()), 2)
+        resumed = self.createQueue()
+        resumed.join()
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(os.listdir(self.trash), [".queue.json"])
+
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Burst, debt and interrupted waits of TokenBucket
+    """
+
+    def test_burstIsFreeAndDebtIsSleptOff(self):
+        bucket = TokenBucket(100)
+        start = time.monotonic()
+        bucket.consume(100)
+        self.assertLess(time.monotonic() - start, 0.1)
+        bucket.consume(30)
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+    def test_noLimit(self):
+        bucket = TokenBucket(0)
+        start = time.monotonic()
+        bucket.consume(10 ** 9)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_interruptEndsTheWait(self):
+        bucket = TokenBucket(1)
+        interrupt = threading.Event()
+        interrupt.set()
+        start = time.monotonic()
+        bucket.consume(60, interrupt)
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
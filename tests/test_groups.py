@@ -0,0 +1,80 @@
+"""
+Tests of the group hierarchy resolved from group delta rounds (AzureAD.groups)
+"""
+import os
+import tempfile
+import unittest
+
+import simplejson as json
+
+from AzureAD.retry import CircuitBreaker, GraphRequestError
+from tests.graph import FakeResponse, createAdmin
+
+USER = "#microsoft.graph.user"
+GROUP = "#microsoft.graph.group"
+
+
+def member(objectId, objectType, removed=False):
+    m = {"@odata.type": objectType, "id": objectId}
+    if removed: m["@removed"] = {"reason": "deleted"}
+    return m
+
+
+class GroupClosureTest(unittest.TestCase):
+    """
+    Nested and cyclic groups, delta rounds and malformed delta pages
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.stateFile = os.path.join(directory.name, "groupDelta.json")
+        #A contains B, B and C contain each other
+        self.pages = {
+            "/groups/delta": {"value": [{"id": "A", "members@delta": [member("u1", USER), member("B", GROUP)]},
+                                        {"id": "B", "members@delta": [member("u2", USER), member("C", GROUP)]}],
+                              "@odata.nextLink": "https://graph.microsoft.com/v1.0/groups/page2"},
+            "/groups/page2": {"value": [{"id": "C", "members@delta": [member("u3", USER), member("B", GROUP)]},
+                                        {"id": "B", "members@delta": [member("u4", USER)]}],
+                              "@odata.deltaLink": "https://graph.microsoft.com/v1.0/groups/delta1"},
+        }
+
+    def handle(self, method, url, kwargs):
+        path = url.split("/v1.0", 1)[1].split("?")[0]
+        if path == "/directoryObjects/getByIds":
+            return {"value": [{"id": i, "userPrincipalName": i + "@example.com"} for i in kwargs["json"]["ids"]]}
+        page = self.pages[path]
+        return page if isinstance(page, FakeResponse) else dict(page)
+
+    def test_nestedAndCyclicGroupsAreResolved(self):
+        admin, session, directory = createAdmin(self, self.handle, group_state_file=self.stateFile)
+        self.assertEqual(admin.getGroupMembers(["A", "C", "unknown"]),
+                         {"A": {"u1@example.com", "u2@example.com", "u3@example.com", "u4@example.com"},
+                          "C": {"u2@example.com", "u3@example.com", "u4@example.com"}})
+
+    def test_deltaRoundInvalidatesAncestors(self):
+        admin, session, directory = createAdmin(self, self.handle, group_state_file=self.stateFile)
+        admin.getGroupMembers(["A"])
+        with open(self.stateFile, "r") as f:
+            self.assertEqual(json.load(f)["deltaLink"], "https://graph.microsoft.com/v1.0/groups/delta1")
+        self.pages["/groups/delta1"] = {"value": [{"id": "C", "members@delta": [member("u3", USER, removed=True)]}],
+                                        "@odata.deltaLink": "https://graph.microsoft.com/v1.0/groups/delta2"}
+        self.assertEqual(admin.getGroupMembers(["A"]),
+                         {"A": {"u1@example.com", "u2@example.com", "u4@example.com"}})
+
+    def test_malformedDeltaPageKeepsKnownMemberships(self):
+        admin, session, directory = createAdmin(self, self.handle, group_state_file=self.stateFile,
+                                                circuit_breaker=CircuitBreaker(failureThreshold=1))
+        admin.getGroupMembers(["A"])
+        for page in ({"value": []}, FakeResponse(200, b'{"value": [{"id": "C", "members@de')):
+            self.pages["/groups/delta1"] = page
+            with self.assertRaises(GraphRequestError):
+                admin.getGroupMembers(["A"])
+        #The truncated page counted as failure
+        self.assertFalse(admin.isAvailable())
+        with open(self.stateFile, "r") as f:
+            self.assertEqual(json.load(f)["deltaLink"], "https://graph.microsoft.com/v1.0/groups/delta1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Tests of the warm pool of home directories (HomeDirectories.pool)
+"""
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+from HomeDirectories import HomePool, HomeProvisioner
+
+
+class HomePoolTest(unittest.TestCase):
+    """
+    Filling the pool, claiming pooled homes and falling back to the skeleton
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.base = os.path.join(self.dir, "home")
+        self.skel = os.path.join(self.dir, "skel")
+        os.makedirs(os.path.join(self.skel, "sub"))
+        os.mkdir(self.base)
+        with open(os.path.join(self.skel, "sub", "file"), "w") as f:
+            f.write("skeleton")
+        self.pool = HomePool(HomeProvisioner(), 2)
+        self.addCleanup(self.pool.stop)
+
+    def pooled(self):
+        try:
+            poolDir = os.path.join(self.base, ".adsyncd-pool")
+            [key] = os.listdir(poolDir)
+        except (FileNotFoundError, ValueError):
+            return []
+        return sorted(n for n in os.listdir(os.path.join(poolDir, key)) if not n.startswith("."))
+
+    def waitForPool(self, size):
+        deadline = time.monotonic() + 10
+        while len(self.pooled()) != size:
+            self.assertLess(time.monotonic(), deadline, "Pool wasn't refilled")
+            time.sleep(0.01)
+
+    def home(self, username, uid):
+        return os.path.join(self.base, username), self.skel, uid, 100, 0o750
+
+    def assertHome(self, username, uid):
+        home = os.path.join(self.base, username)
+        st = os.stat(home)
+        self.assertEqual((st.st_uid, st.st_gid, st.st_mode & 0o7777), (uid, 100, 0o750))
+        self.assertEqual(os.stat(os.path.join(home, "sub", "file")).st_uid, uid)
+        with open(os.path.join(home, "sub", "file"), "r") as f:
+            self.assertEqual(f.read(), "skeleton")
+
+    def test_homesAreClaimedFromThePoolAndRefilled(self):
+        self.pool.register(self.base, self.skel, 0o750)
+        self.waitForPool(2)
+        pooled = self.pooled()
+        #Pooled homes are only accessible by root until claimed
+        self.assertEqual(os.stat(os.path.join(self.base, ".adsyncd-pool")).st_mode & 0o777, 0o700)
+        self.pool.provision([self.home("alice", 1000), self.home("bob", 1001), self.home("carol", 1002)])
+        for username, uid in (("alice", 1000), ("bob", 1001), ("carol", 1002)):
+            self.assertHome(username, uid)
+        self.waitForPool(2)
+        self.assertFalse(set(pooled) & set(self.pooled()))
+
+    def test_failedClaimFallsBackToTheSkeleton(self):
+        self.pool.register(self.base, self.skel, 0o750)
+        self.waitForPool(2)
+        self.pool.stop()
+        with mock.patch.object(HomePool, "_HomePool__chown", side_effect=OSError(1, "Operation not permitted")):
+            self.pool.provision([self.home("alice", 1000)])
+        self.assertHome("alice", 1000)
+        #The pooled home was moved back as a leftover build
+        poolDir = os.path.join(self.base, ".adsyncd-pool", os.listdir(os.path.join(self.base, ".adsyncd-pool"))[0])
+        self.assertEqual(len(self.pooled()), 1)
+        self.assertEqual(len([n for n in os.listdir(poolDir) if n.startswith(".build-failed-")]), 1)
+
+    def test_existingHomesAreLeftUntouched(self):
+        os.mkdir(os.path.join(self.base, "alice"))
+        self.pool.provision([self.home("alice", 1000)])
+        self.assertEqual(os.listdir(os.path.join(self.base, "alice")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
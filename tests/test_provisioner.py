@@ -0,0 +1,94 @@
+"""
+Tests of the parallel home directory provisioning (HomeDirectories.provisioner)
+"""
+import os
+import errno
+import tempfile
+import unittest
+from unittest import mock
+
+from HomeDirectories import HomeProvisioner
+from HomeDirectories import provisioner
+
+
+class HomeProvisionerTest(unittest.TestCase):
+    """
+    Homes created from a skeleton with every copy method, hard links and failed homes
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.skel = os.path.join(self.dir, "skel")
+        os.makedirs(os.path.join(self.skel, ".config", "app"))
+        self.write(".profile", "profile", 0o644)
+        self.write(os.path.join(".config", "app", "settings"), "x" * 100000, 0o600)
+        self.write(".empty", "", 0o644)
+        self.write("readonly", "read only", 0o444)
+        os.chmod(os.path.join(self.skel, ".config"), 0o750)
+        os.symlink(".profile", os.path.join(self.skel, ".bashrc"))
+
+    def write(self, name, data, mode):
+        path = os.path.join(self.skel, name)
+        with open(path, "w") as f:
+            f.write(data)
+        os.chmod(path, mode)
+
+    def homes(self, *names):
+        return [(os.path.join(self.dir, "home", n), self.skel, 1000 + i, 100, 0o750) for i, n in enumerate(names)]
+
+    def assertHome(self, home, uid, hardlinked=False):
+        st = os.stat(home)
+        self.assertEqual((st.st_uid, st.st_gid, st.st_mode & 0o7777), (uid, 100, 0o750))
+        for name, mode in ((".profile", 0o644), (".config/app/settings", 0o600), (".empty", 0o644), (".config", 0o750)):
+            st = os.lstat(os.path.join(home, name))
+            self.assertEqual((st.st_uid, st.st_mode & 0o7777), (uid, mode), name)
+        with open(os.path.join(home, ".config", "app", "settings"), "r") as f:
+            self.assertEqual(f.read(), "x" * 100000)
+        self.assertEqual(os.readlink(os.path.join(home, ".bashrc")), ".profile")
+        self.assertEqual(os.lstat(os.path.join(home, ".bashrc")).st_uid, uid)
+        readonly = os.stat(os.path.join(home, "readonly"))
+        self.assertEqual(readonly.st_ino == os.stat(os.path.join(self.skel, "readonly")).st_ino, hardlinked)
+
+    def test_homesAreCopiedFromTheSkeleton(self):
+        homes = self.homes("alice", "bob", "carol")
+        os.makedirs(homes[2][0])
+        HomeProvisioner(workers=2).provision(homes + [(os.path.join(self.dir, "home", "empty"), None, 1005, 100, 0o700)])
+        self.assertHome(homes[0][0], 1000)
+        self.assertHome(homes[1][0], 1001)
+        #Existing homes are left untouched
+        self.assertEqual(os.listdir(homes[2][0]), [])
+        self.assertEqual(os.listdir(os.path.join(self.dir, "home", "empty")), [])
+
+    def test_plainCopyIfReflinkAndCopyFileRangeAreUnsupported(self):
+        unsupported = OSError(errno.EOPNOTSUPP, "Operation not supported")
+        with mock.patch.object(provisioner.fcntl, "ioctl", side_effect=unsupported) as ioctl, \
+                mock.patch.object(provisioner.os, "copy_file_range", side_effect=OSError(errno.EXDEV, "Cross-device link"), create=True) as copyFileRange:
+            HomeProvisioner().provision(self.homes("alice"))
+        self.assertTrue(ioctl.called)
+        self.assertTrue(copyFileRange.called)
+        self.assertHome(self.homes("alice")[0][0], 1000)
+
+    def test_readOnlyFilesAreHardLinked(self):
+        HomeProvisioner(hardlinkReadOnly=True).provision(self.homes("alice"))
+        self.assertHome(self.homes("alice")[0][0], 1000, hardlinked=True)
+
+    def test_failedHomeIsRemoved(self):
+        homes = self.homes("alice", "bob")
+        copyFileRange = os.copy_file_range
+
+        def failForBob(src, dst, count):
+            if "/bob/" in os.readlink("/proc/self/fd/" + str(dst)):
+                raise OSError(errno.EIO, "Input/output error")
+            return copyFileRange(src, dst, count)
+
+        with mock.patch.object(provisioner.fcntl, "ioctl", side_effect=OSError(errno.ENOTTY, "Not supported")), \
+                mock.patch.object(provisioner.os, "copy_file_range", side_effect=failForBob):
+            HomeProvisioner().provision(homes)
+        self.assertHome(homes[0][0], 1000)
+        self.assertFalse(os.path.lexists(homes[1][0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Tests of the user reconciliation (AzureSyncHandler.reconcile)
+"""
+import gc
+import os
+import tempfile
+import unittest
+
+from AzureAD import DirectoryUser
+from SyncState import SyncStateStore, SyncRecord, SYNCED_FIELDS, fingerprint
+from AzureSyncHandler.reconcile import UserReconciler, MergeJoinReconciler
+
+LOCK_FIELDS = SYNCED_FIELDS + ("accountEnabled",)
+
+
+class ReconcileStateTest(unittest.TestCase):
+    """
+    Updates found by fingerprint, depending on the attributes that are applied
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "state.db")
+        self.alice = DirectoryUser("id-alice", "Alice", "alice", True)
+        self.bob = DirectoryUser("id-bob", "Bob", "bob", False)
+        self.managed = {"alice": "Alice", "bob": "Bob"}
+
+    def openStore(self, fields, recordedFields):
+        state = SyncStateStore(self.path, fields)
+        self.addCleanup(state.close)
+        for u, uid in ((self.alice, 1000), (self.bob, 1001)):
+            state.put(SyncRecord(u.id, u.userPrincipalName, uid, "/home/" + u.userPrincipalName, fingerprint(u, recordedFields)))
+        return state
+
+    def diff(self, reconciler, users, state):
+        return reconciler.diff(users, list(self.managed), self.managed, state)
+
+    def test_enabledStateIsIgnoredUnlessApplied(self):
+        state = self.openStore(SYNCED_FIELDS, SYNCED_FIELDS)
+        disabled = self.alice.replace(accountEnabled=False)
+        for reconciler in (UserReconciler(), MergeJoinReconciler(chunkSize=1)):
+            self.assertTrue(self.diff(reconciler, [disabled, self.bob], state).isEmpty())
+
+    def test_recordedUsersAreUpdatedOnceWhenLockingIsSwitchedOn(self):
+        #Recorded while lockDisabledUsers was off, bob was already disabled back then
+        state = self.openStore(LOCK_FIELDS, SYNCED_FIELDS)
+        for reconciler in (UserReconciler(), MergeJoinReconciler(chunkSize=1)):
+            changeset = self.diff(reconciler, [self.alice, self.bob], state)
+            self.assertEqual(sorted(u.id for u in changeset.updated), ["id-alice", "id-bob"])
+            self.assertEqual((changeset.added, changeset.removed, changeset.renamed), ((), (), ()))
+        for u in (self.alice, self.bob):
+            state.put(state.get(u.id).replace(fingerprint=state.fingerprint(u)))
+        self.assertTrue(self.diff(UserReconciler(), [self.alice, self.bob], state).isEmpty())
+
+    def test_enabledStateChangeIsFoundWhenApplied(self):
+        state = self.openStore(LOCK_FIELDS, LOCK_FIELDS)
+        changeset = self.diff(UserReconciler(), [self.alice, self.bob.replace(accountEnabled=True)], state)
+        self.assertEqual([u.id for u in changeset.updated], ["id-bob"])
+
+
+class ReconcileRenameTest(unittest.TestCase):
+    """
+    Changed principals without a state store
+    """
+
+    def setUp(self):
+        self.alice = DirectoryUser("id-alice", "Alice", "alice", True)
+        self.bob = DirectoryUser("id-bob", "Bob", "bob", True)
+        self.managed = {"alice": "Alice", "bob": "Bob"}
+
+    def test_deltaRoundRenamesByObjectId(self):
+        renamed = self.alice.replace(userPrincipalName="alice.a")
+        #Like DomainUserAdministration.syncDelta, the previous user is reported as removed
+        changeset = UserReconciler().diffDelta([renamed], [self.alice, self.bob], ["root", "alice", "bob"], self.managed)
+        self.assertEqual(changeset.renamed, (("alice", renamed),))
+        self.assertEqual((changeset.added, changeset.removed, changeset.updated), ((), ("bob",), ()))
+
+    def test_fullSyncCannotFollowRenames(self):
+        renamed = self.alice.replace(userPrincipalName="alice.a")
+        for reconciler in (UserReconciler(), MergeJoinReconciler(chunkSize=1)):
+            changeset = reconciler.diff([renamed, self.bob], ["root", "alice", "bob"], self.managed)
+            self.assertEqual((changeset.renamed, changeset.added, changeset.removed), ((), (renamed,), ("alice",)))
+
+
+class MergeJoinChunkTest(unittest.TestCase):
+    """
+    Changes of a merge join handed out in chunks of bounded size
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "state.db")
+        #user000 - user099 are managed, every third of them has a new display name, user100 - user199 are new
+        self.managed = {"user" + str(i).zfill(3): "User " + str(i) for i in range(100)}
+        self.managed["gone"] = "Gone"
+        self.consumed = 0
+
+    def iterUsers(self, count=200):
+        #Users are created on demand, like the pages of DomainUserAdministration.iterUsers
+        for i in reversed(range(count)):
+            self.consumed += 1
+            yield DirectoryUser("id-" + str(i), "User " + str(i) + ("!" if i % 3 == 0 else ""), "user" + str(i).zfill(3), True)
+
+    def liveUsers(self):
+        return sum(1 for o in gc.get_objects() if isinstance(o, DirectoryUser))
+
+    def test_changesAreYieldedInChunks(self):
+        localUsers = ["root"] + list(self.managed)
+        baseline = self.liveUsers()
+        live = []
+        changesets = []
+        for changeset in MergeJoinReconciler(chunkSize=10).iterChangesets(self.iterUsers(), localUsers, self.managed):
+            #The whole input is sorted before the first chunk
+            self.assertEqual(self.consumed, 200)
+            self.assertLessEqual(len(changeset.added) + len(changeset.updated), 10)
+            live.append(self.liveUsers() - baseline)
+            changesets.append((sorted(u.userPrincipalName for u in changeset.added),
+                               sorted(u.userPrincipalName for u in changeset.updated), changeset.removed))
+            del changeset
+        #134 of 200 users change, only the heads of the spilled chunks and one changeset are held at once
+        self.assertEqual(len(changesets), 14)
+        self.assertLess(max(live), 40)
+        added = [n for a, _, _ in changesets for n in a]
+        updated = [n for _, u, _ in changesets for n in u]
+        self.assertEqual(sorted(added), ["user" + str(i) for i in range(100, 200)])
+        self.assertEqual(sorted(updated), ["user" + str(i).zfill(3) for i in range(0, 100, 3)])
+        self.assertEqual([r for _, _, r in changesets], [()] * 13 + [("gone",)])
+
+    def test_renamesAreResolvedInTheLastChunk(self):
+        state = SyncStateStore(self.path, SYNCED_FIELDS)
+        self.addCleanup(state.close)
+        users = list(self.iterUsers(100))
+        for u in users:
+            state.put(SyncRecord(u.id, u.userPrincipalName, 1000, "/home/" + u.userPrincipalName, state.fingerprint(u)))
+        #user010 is renamed to a name sorted before and user020 to one sorted after its own,
+        #user031 is renamed while user030 takes its name
+        users[-11] = users[-11].replace(userPrincipalName="a.user010")
+        users[-21] = users[-21].replace(userPrincipalName="z.user020")
+        users[-31] = users[-31].replace(userPrincipalName="user031")
+        users[-32] = users[-32].replace(userPrincipalName="b.user031")
+        changesets = list(MergeJoinReconciler(chunkSize=1).iterChangesets(users, list(self.managed), self.managed, state))
+        self.assertTrue(all(c.renamed == () and c.removed == () for c in changesets[:-1]))
+        last = changesets[-1]
+        self.assertEqual(sorted((previous, u.userPrincipalName) for previous, u in last.renamed),
+                         [("user010", "a.user010"), ("user020", "z.user020")])
+        #The name of user031 is taken, so its user is added under the new name
+        self.assertEqual([u.userPrincipalName for u in last.added], ["b.user031"])
+        self.assertEqual(last.removed, ("gone", "user030"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""
+Tests of the home directory requests served on a Unix socket (HomeDirectories.service)
+"""
+import os
+import socket
+import tempfile
+import unittest
+
+from HomeDirectories import HomeRequestServer
+
+
+class HomeRequestServerTest(unittest.TestCase):
+    """
+    Answers to home directory requests depending on the outcome of the callback
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socketPath = os.path.join(directory.name, "adsyncd.sock")
+        self.requested = []
+        server = HomeRequestServer(self.createHome, self.socketPath)
+        server.start()
+        self.addCleanup(server.stop)
+
+    def createHome(self, username):
+        self.requested.append(username)
+        if username == "missing":
+            raise ValueError("no such user")
+        return username != "nohome"
+
+    def request(self, username):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socketPath)
+            client.sendall((username + "\n").encode("utf-8"))
+            with client.makefile("rb") as answer:
+                return answer.readline().decode("utf-8")
+
+    def test_answers(self):
+        self.assertEqual(os.stat(self.socketPath).st_mode & 0o777, 0o600)
+        self.assertEqual(self.request("alice"), "OK\n")
+        self.assertEqual(self.request("nohome"), "ERROR no home directory created\n")
+        self.assertEqual(self.request("missing"), "ERROR no such user\n")
+        self.assertEqual(self.requested, ["alice", "nohome", "missing"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+"""
+Tests of creating, renaming and removing users with the native backend (LinuxUsers.SystemUserAdministration)
+"""
+import os
+import time
+import tempfile
+import unittest
+
+from AzureAD import DirectoryUser
+from LinuxUsers import SystemUserAdministration, UserNotExistingError, UserAlreadyExistsError
+
+LOGIN_DEFS = "UID_MIN 1000\nUID_MAX 60000\nGID_MIN 1000\nGID_MAX 60000\nUSERGROUPS_ENAB yes\n"
+
+
+class SystemUserAdministrationTest(unittest.TestCase):
+    """
+    Creation, renames and removals of natively managed users on temporary account files
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.homes = self.path("home")
+        os.mkdir(self.homes)
+        self.write("passwd", "root:x:0:0:root:/root:/bin/sh\n"
+                             "alice:x:1000:1000:Alice:" + self.home("alice") + ":/bin/sh\n"
+                             "bob:x:1001:1001:Bob:" + self.home("bob") + ":/bin/sh\n"
+                             "carol:x:1002:1001:Carol:" + self.home("carol") + ":/bin/sh\n")
+        self.write("shadow", "root:*:19000:0:99999:7:::\nalice:!hash:19000:0:99999:7:::\n"
+                             "bob:!hash:19000:0:99999:7:::\ncarol:!hash:19000:0:99999:7:::\n")
+        self.write("group", "root:x:0:\nalice:x:1000:\nbob:x:1001:\nusers:x:100:carol,alice,bob\nstaff:x:50:alice\n")
+        self.write("gshadow", "root:*::\nalice:!::\nbob:!::\nusers:!::carol,alice,bob\nstaff:!:alice:alice\n")
+        self.write("login.defs", LOGIN_DEFS)
+        for username, uid in (("alice", 1000), ("bob", 1001), ("carol", 1002)):
+            os.mkdir(self.home(username))
+            self.write(os.path.join(self.home(username), "notes"), username)
+            os.chown(self.home(username), uid, 1000)
+        self.admin = SystemUserAdministration(self.path("passwd"), self.path("shadow"), self.path("group"),
+                                              userBackend="native", loginDefsFile=self.path("login.defs"),
+                                              trashDir=self.path("trash"))
+        #Cleanups run in reverse order, the cleanup worker is stopped before the directory is removed
+        self.addCleanup(self.admin.close)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def home(self, username):
+        return os.path.join(self.homes, username)
+
+    def write(self, name, data):
+        with open(self.path(name), "w") as f:
+            f.write(data)
+
+    def lines(self, name):
+        with open(self.path(name), "r") as f:
+            return f.read().splitlines()
+
+    def test_createUsersInOneTransaction(self):
+        os.mkdir(self.path("skel"))
+        self.write(os.path.join("skel", ".profile"), "profile")
+        config = {"-m": None, "-k": self.path("skel"), "-b": self.homes, "-s": "/bin/bash", "-G": "staff,missing"}
+        with self.admin.transaction():
+            self.admin.addUser(DirectoryUser("id-dave", "Dave", "dave", True), config)
+            self.admin.addUser(DirectoryUser("id-erin", "Erin", "erin", True), dict(config, **{"-g": "users"}))
+            #Queued, but not written yet
+            with self.assertRaises(UserAlreadyExistsError):
+                self.admin.addUser(DirectoryUser("id-dave", "Dave", "dave", True), config)
+            self.assertEqual(self.lines("passwd")[-1].split(":")[0], "carol")
+        #UIDs above the highest one in use, a private group with the same ID unless a group is given
+        self.assertEqual(self.lines("passwd")[-2:], ["dave:x:1003:1003:Dave:" + self.home("dave") + ":/bin/bash",
+                                                     "erin:x:1004:100:Erin:" + self.home("erin") + ":/bin/bash"])
+        today = str(int(time.time() // 86400))
+        self.assertEqual(self.lines("shadow")[-2:], ["dave:!:" + today + ":0:99999:7:::", "erin:!:" + today + ":0:99999:7:::"])
+        self.assertEqual(self.lines("group")[-3:], ["users:x:100:carol,alice,bob", "staff:x:50:alice,dave,erin", "dave:x:1003:"])
+        self.assertEqual(self.lines("gshadow")[-2:], ["staff:!:alice:alice,dave,erin", "dave:!::"])
+        for username, uid, gid in (("dave", 1003, 1003), ("erin", 1004, 100)):
+            st = os.stat(self.home(username))
+            self.assertEqual((st.st_uid, st.st_gid, st.st_mode & 0o7777), (uid, gid, 0o755))
+            with open(os.path.join(self.home(username), ".profile"), "r") as f:
+                self.assertEqual(f.read(), "profile")
+            self.assertEqual(os.stat(os.path.join(self.home(username), ".profile")).st_uid, uid)
+
+    def test_gecosCannotBreakThePasswdFile(self):
+        config = {"-b": self.homes, "-s": "/bin/sh", "-M": None}
+        with self.admin.transaction():
+            self.admin.addUser(DirectoryUser("id-eve", "Eve\nmallory:x:0:0::/root:/bin/sh", "eve", True), config)
+            self.admin.renameUser("alice", "alice.a", "Doe, Alice")
+            self.admin.setUserGecos("bob", "Bob:\tB.")
+        self.assertEqual([l.split(":")[0] for l in self.lines("passwd")], ["root", "alice.a", "bob", "carol", "eve"])
+        self.assertEqual([l.split(":")[4] for l in self.lines("passwd")[1:]],
+                         ["Doe Alice", "Bob B.", "Carol", "Eve mallory x 0 0 /root /bin/sh"])
+
+    def test_renameKeepsUidHomeAndGroupMemberships(self):
+        with self.admin.transaction():
+            self.admin.renameUser("alice", "alice.a", "Alice A.")
+        self.assertIn("alice.a:x:1000:1000:Alice A.:" + self.home("alice.a") + ":/bin/sh", self.lines("passwd"))
+        self.assertNotIn("alice", [l.split(":")[0] for l in self.lines("passwd")])
+        self.assertIn("alice.a:!hash:19000:0:99999:7:::", self.lines("shadow"))
+        #Private group renamed in place, supplementary memberships keep their position
+        self.assertEqual(self.lines("group"), ["root:x:0:", "alice.a:x:1000:", "bob:x:1001:",
+                                               "users:x:100:carol,alice.a,bob", "staff:x:50:alice.a"])
+        self.assertEqual(self.lines("gshadow"), ["root:*::", "alice.a:!::", "bob:!::",
+                                                 "users:!::carol,alice.a,bob", "staff:!:alice.a:alice.a"])
+        self.assertFalse(os.path.exists(self.home("alice")))
+        with open(os.path.join(self.home("alice.a"), "notes"), "r") as f:
+            self.assertEqual(f.read(), "alice")
+        self.assertEqual(self.admin.getGroupsForUser("alice.a"), ["users", "staff"])
+
+    def test_renameToExistingOrFromMissingUser(self):
+        with self.assertRaises(UserAlreadyExistsError):
+            self.admin.renameUser("alice", "bob")
+        with self.assertRaises(UserNotExistingError):
+            self.admin.renameUser("dave", "dave.d")
+        self.assertEqual(self.lines("passwd")[1].split(":")[0], "alice")
+
+    def test_renameKeepsPrivateGroupIfNewNameIsTaken(self):
+        with self.admin.transaction():
+            self.admin.renameUser("alice", "staff")
+        self.assertIn("staff:x:1000:1000:Alice:" + self.home("staff") + ":/bin/sh", self.lines("passwd"))
+        self.assertIn("alice:x:1000:", self.lines("group"))
+        self.assertIn("staff:x:50:staff", self.lines("group"))
+
+    def test_removeDropsPrivateGroupAndMemberships(self):
+        self.admin.removeUsers(["alice"])
+        self.assertEqual([l.split(":")[0] for l in self.lines("passwd")], ["root", "bob", "carol"])
+        self.assertEqual([l.split(":")[0] for l in self.lines("shadow")], ["root", "bob", "carol"])
+        self.assertEqual(self.lines("group"), ["root:x:0:", "bob:x:1001:", "users:x:100:carol,bob", "staff:x:50:"])
+        self.assertEqual(self.lines("gshadow"), ["root:*::", "bob:!::", "users:!::carol,bob", "staff:!::"])
+        self.assertFalse(os.path.exists(self.home("alice")))
+        self.assertTrue(os.path.isdir(self.home("bob")))
+
+    def test_removeKeepsPrivateGroupStillInUse(self):
+        #carol's primary group is bob's private group
+        self.admin.removeUsers(["bob"])
+        self.assertIn("bob:x:1001:", self.lines("group"))
+        self.assertIn("bob:!::", self.lines("gshadow"))
+        self.assertIn("users:x:100:carol,alice", self.lines("group"))
+        self.assertNotIn("bob", [l.split(":")[0] for l in self.lines("passwd")])
+
+    def test_removeDropsPrivateGroupWithItsLastUser(self):
+        #Like userdel, the group goes once the user who owns it and everyone sharing it are removed at once
+        self.admin.removeUsers(["bob", "carol"])
+        self.assertEqual([l.split(":")[0] for l in self.lines("group")], ["root", "alice", "users", "staff"])
+        self.assertEqual([l.split(":")[0] for l in self.lines("gshadow")], ["root", "alice", "users", "staff"])
+        self.assertIn("users:x:100:alice", self.lines("group"))
+
+    def test_lockAndUnlockPassword(self):
+        self.write("shadow", "root:*:19000:0:99999:7:::\nalice:$6$hash:19000:0:99999:7:::\n"
+                             "bob:!$6$hash:19000:0:99999:7:::\ncarol:!:19000:0:99999:7:::\n")
+        with self.admin.transaction():
+            self.admin.setUserLocked("alice", True)
+            self.admin.setUserLocked("bob", False)
+            #No password to unlock, stays locked
+            self.admin.setUserLocked("carol", False)
+        self.assertEqual(self.lines("shadow")[1:], ["alice:!$6$hash:19000:0:99999:7:::", "bob:$6$hash:19000:0:99999:7:::",
+                                                    "carol:!:19000:0:99999:7:::"])
+        with self.assertRaises(UserNotExistingError):
+            self.admin.setUserLocked("dave", True)
+
+    def test_lockInUnchangedStateWritesNothing(self):
+        shadow = "root:*:19000:0:99999:7:::\nalice:!$6$hash:19000:0:99999:7:::\n"
+        self.write("shadow", shadow)
+        os.utime(self.path("shadow"), (0, 0))
+        with self.admin.transaction():
+            self.admin.setUserLocked("alice", True)
+        with open(self.path("shadow"), "r") as f:
+            self.assertEqual(f.read(), shadow)
+        self.assertEqual(os.stat(self.path("shadow")).st_mtime, 0)
+
+    def test_lockAfterSettingPasswordInSameTransaction(self):
+        with self.admin.transaction():
+            self.admin.setUserPassword("alice", "secret")
+            self.admin.setUserLocked("alice", True)
+            #Unlocking bob's password and locking it again within the sync leaves it locked
+            self.admin.setUserLocked("bob", False)
+            self.admin.setUserLocked("bob", True)
+        password = self.lines("shadow")[1].split(":")[1]
+        self.assertTrue(password.startswith("!$6$"), password)
+        self.assertEqual(self.lines("shadow")[2], "bob:!hash:19000:0:99999:7:::")
+
+    def test_removeSkipsMissingUsers(self):
+        self.admin.removeUsers(["dave", "alice"])
+        self.assertEqual([l.split(":")[0] for l in self.lines("passwd")], ["root", "bob", "carol"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Tests of the batched account file writes (LinuxUsers.transaction)
+"""
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+
+from LinuxUsers.records import PasswdEntry, GroupEntry
+from LinuxUsers.transaction import AccountTransaction, AccountLockError, PASSWD, SHADOW, GROUP, GSHADOW
+
+PASSWD_LINES = "root:x:0:0:root:/root:/bin/sh\nalice:x:1000:1000:Alice:/home/alice:/bin/sh\n"
+SHADOW_LINES = "root:*:19000:0:99999:7:::\nalice:$6$hash:19000:0:99999:7:::\n"
+GROUP_LINES = "root:x:0:\nalice:x:1000:\nusers:x:100:alice\n"
+
+
+class AccountTransactionTest(unittest.TestCase):
+    """
+    Writes, lock handling and failed writes of AccountTransaction
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.files = {PASSWD: self.path("passwd"), SHADOW: self.path("shadow"), GROUP: self.path("group"), GSHADOW: self.path("gshadow")}
+        self.write("passwd", PASSWD_LINES)
+        self.write("shadow", SHADOW_LINES)
+        self.write("group", GROUP_LINES)
+        os.chmod(self.path("shadow"), 0o640)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, data):
+        with open(self.path(name), "w") as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(self.path(name), "r") as f:
+            return f.read()
+
+    def assertNoLeftovers(self):
+        #.pwd.lock is kept like lckpwdf does, it is only locked with fcntl
+        leftovers = [n for n in os.listdir(self.dir) if n != ".pwd.lock" and (n.endswith(".lock") or n.endswith("+") or n.split(".")[-1].isdigit())]
+        self.assertEqual(leftovers, [])
+
+    def test_commitAppliesChangesOnceKeepingOtherLines(self):
+        transaction = AccountTransaction(self.files)
+        transaction.put(PASSWD, PasswdEntry("bob", "x", 1001, 100, "Bob", "/home/bob", "/bin/sh"))
+        transaction.update(PASSWD, "alice", gecos="Alice A.")
+        transaction.update(PASSWD, "alice", shell="/bin/bash")
+        transaction.remove(SHADOW, "alice")
+        transaction.modify(GROUP, "users", lambda e: e.replace(members=e.members + ("bob",)))
+        transaction.update(GROUP, "missing", gid=5)
+        self.assertEqual(transaction.commit(), [self.path("passwd"), self.path("shadow"), self.path("group")])
+        self.assertTrue(transaction.isEmpty())
+        self.assertEqual(self.read("passwd"), "root:x:0:0:root:/root:/bin/sh\nalice:x:1000:1000:Alice A.:/home/alice:/bin/bash\n"
+                                              "bob:x:1001:100:Bob:/home/bob:/bin/sh\n")
+        self.assertEqual(self.read("shadow"), "root:*:19000:0:99999:7:::\n")
+        self.assertEqual(self.read("group"), "root:x:0:\nalice:x:1000:\nusers:x:100:alice,bob\n")
+        self.assertEqual(os.stat(self.path("shadow")).st_mode & 0o7777, 0o640)
+        self.assertNoLeftovers()
+
+    def test_unchangedFilesAreNotRewritten(self):
+        os.utime(self.path("passwd"), (0, 0))
+        transaction = AccountTransaction(self.files)
+        transaction.update(PASSWD, "alice", gecos="Alice")
+        transaction.modify(PASSWD, "missing", lambda e: e.replace(gecos="Missing"))
+        transaction.update(GROUP, "users", gid=101)
+        self.assertEqual(transaction.commit(), [self.path("group")])
+        self.assertEqual(os.stat(self.path("passwd")).st_mtime, 0)
+        self.assertNoLeftovers()
+
+    def test_missingGshadowIsNotCreated(self):
+        transaction = AccountTransaction(self.files)
+        transaction.put(GROUP, GroupEntry("staff", "x", 50, ()))
+        transaction.update(GSHADOW, "staff", password="!")
+        self.assertEqual(transaction.commit(), [self.path("group")])
+        self.assertFalse(os.path.exists(self.path("gshadow")))
+
+    def test_staleLockFileIsRemoved(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.write("passwd.lock", str(process.pid))
+        transaction = AccountTransaction(self.files, lockTimeout=1)
+        transaction.update(PASSWD, "alice", gecos="Alice A.")
+        transaction.commit()
+        self.assertIn("Alice A.", self.read("passwd"))
+        self.assertNoLeftovers()
+
+    def test_lockFileHeldByRunningProcess(self):
+        self.write("passwd.lock", str(os.getppid()))
+        transaction = AccountTransaction(self.files, lockTimeout=0.3)
+        transaction.update(PASSWD, "alice", gecos="Alice A.")
+        transaction.update(GROUP, "users", gid=101)
+        with self.assertRaises(AccountLockError):
+            transaction.commit()
+        self.assertTrue(transaction.isEmpty())
+        self.assertEqual(self.read("passwd"), PASSWD_LINES)
+        self.assertEqual(self.read("group"), GROUP_LINES)
+        #The lock of the other process is kept, only our own files are removed
+        self.assertEqual(self.read("passwd.lock"), str(os.getppid()))
+        self.assertEqual(sorted(n for n in os.listdir(self.dir) if "." in n and n != ".pwd.lock"), ["passwd.lock"])
+
+    def test_pwdLockHeldByOtherProcess(self):
+        holder = subprocess.Popen([sys.executable, "-c", "import os, sys, fcntl, time\n"
+                                   "fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT, 0o600)\n"
+                                   "fcntl.lockf(fd, fcntl.LOCK_EX)\nprint('locked', flush=True)\ntime.sleep(30)",
+                                   self.path(".pwd.lock")], stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.kill)
+        self.assertEqual(holder.stdout.readline().strip(), b"locked")
+        holder.stdout.close()
+        transaction = AccountTransaction(self.files, lockTimeout=0.3)
+        transaction.update(PASSWD, "alice", gecos="Alice A.")
+        with self.assertRaises(AccountLockError):
+            transaction.commit()
+        self.assertEqual(self.read("passwd"), PASSWD_LINES)
+        self.assertNoLeftovers()
+
+    def test_failedWriteKeepsWrittenFilesAndReleasesLocks(self):
+        #The temporary file of the group file can't be created
+        os.mkdir(self.path("group+"))
+        transaction = AccountTransaction(self.files)
+        transaction.update(PASSWD, "alice", gecos="Alice A.")
+        transaction.update(GROUP, "users", gid=101)
+        with self.assertRaises(OSError):
+            transaction.commit()
+        self.assertTrue(transaction.isEmpty())
+        #Every file is replaced atomically on its own, passwd was written before group failed
+        self.assertIn("Alice A.", self.read("passwd"))
+        self.assertEqual(self.read("group"), GROUP_LINES)
+        os.rmdir(self.path("group+"))
+        self.assertNoLeftovers()
+        #The locks were released, the next transaction goes through
+        transaction.update(GROUP, "users", gid=101)
+        transaction.commit()
+        self.assertIn("users:x:101:alice", self.read("group"))
+
+
+if __name__ == "__main__":
+    unittest.main()